@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""Benchmark incremental reads of api.knack against the local docker-compose stack.
+
+Synthetic records are loaded to a throwaway app ID in increasing amounts. At each
+table size, a small batch of records is then updated and the incremental select
+which the publishers issue (app_id, container_id, updated_at >= <date>, ordered by
+id) is timed. Compare the results before and after applying a migration in
+dev/migrations to see how latency scales with table size.
+
+$ python dev/benchmark_incremental_reads.py --sizes 10000 50000 100000
+
+Requires PGREST_ENDPOINT and PGREST_JWT (see dev/readme.md). All benchmark records
+are deleted when the script finishes.
+"""
+import argparse
+import datetime
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services"))
+import utils  # noqa: E402
+
+PGREST_JWT = os.getenv("PGREST_JWT")
+PGREST_ENDPOINT = os.getenv("PGREST_ENDPOINT")
+APP_ID = "benchmark_incremental_reads"
+# records are spread across this many containers, like a real app
+CONTAINERS = [f"view_{i}" for i in range(10)]
+INSERT_CHUNK_SIZE = 1000
+
+
+def make_record(record_id, num_fields):
+    record = {"id": record_id}
+    for i in range(num_fields):
+        record[f"field_{i}"] = f"value {i} of {record_id}"
+        record[f"field_{i}_raw"] = {"identifier": record_id, "value": i}
+    return record
+
+
+def load_records(client, start, stop, num_fields):
+    payload = []
+    for i in range(start, stop):
+        record_id = uuid.uuid4().hex
+        payload.append(
+            {
+                "record_id": record_id,
+                "app_id": APP_ID,
+                "container_id": CONTAINERS[i % len(CONTAINERS)],
+                "record": make_record(record_id, num_fields),
+            }
+        )
+        if len(payload) == INSERT_CHUNK_SIZE:
+            client.upsert("knack", payload)
+            payload = []
+    if payload:
+        client.upsert("knack", payload)
+
+
+def incremental_select(client, container, since):
+    return client.select(
+        "knack",
+        params={
+            "select": "record",
+            "app_id": f"eq.{APP_ID}",
+            "container_id": f"eq.{container}",
+            "updated_at": f"gte.{since}",
+        },
+        order_by="id",
+    )
+
+
+def main(args):
+    client = utils.postgrest.Postgrest(PGREST_ENDPOINT, token=PGREST_JWT)
+    container = CONTAINERS[0]
+    loaded = 0
+    if args.partitioned:
+        for container_id in CONTAINERS:
+            client.rpc(
+                "ensure_knack_partition",
+                {"app_id": APP_ID, "container_id": container_id},
+            )
+    print("table size\tdelta rows\tmedian ms\tmin ms\tmax ms")
+    try:
+        for size in sorted(args.sizes):
+            load_records(client, loaded, size, args.fields)
+            loaded = size
+            # updated_at is set by trigger, so the delta is loaded after the cutoff
+            time.sleep(1)
+            since = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            time.sleep(1)
+            load_records(
+                client, loaded, loaded + args.delta * len(CONTAINERS), args.fields
+            )
+            loaded += args.delta * len(CONTAINERS)
+
+            timings = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                data = incremental_select(client, container, since)
+                timings.append((time.perf_counter() - start) * 1000)
+            print(
+                f"{loaded}\t{len(data)}\t{statistics.median(timings):.1f}"
+                f"\t{min(timings):.1f}\t{max(timings):.1f}"
+            )
+    finally:
+        client.delete("knack", params={"app_id": f"eq.{APP_ID}"})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10000, 50000, 100000, 250000],
+        help="int: The table sizes (number of records) to benchmark",
+    )
+
+    parser.add_argument(
+        "--delta",
+        type=int,
+        default=100,
+        help="int: The number of updated records per container at each size",
+    )
+
+    parser.add_argument(
+        "--fields",
+        type=int,
+        default=20,
+        help="int: The number of fields per synthetic record",
+    )
+
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help="Create the benchmark's partitions first. Required after migration 003.",
+    )
+
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=10,
+        help="int: The number of times to time the select at each size",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -53,13 +53,18 @@ SET default_table_access_method = heap;
 -- Name: knack; Type: TABLE; Schema: api; Owner: postgres
 --
 
+-- partitioned by app, and then by container. see api.ensure_knack_partition
 CREATE TABLE api.knack (
+    id bigserial NOT NULL,
     record_id text NOT NULL,
     app_id text NOT NULL,
     container_id text NOT NULL,
-    record json NOT NULL,
-    updated_at timestamp with time zone DEFAULT now() NOT NULL
-);
+    -- null when the record body is stored in knack_record_body
+    record jsonb,
+    record_hash text,
+    updated_at timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT knack_record_check CHECK (record IS NOT NULL OR record_hash IS NOT NULL)
+) PARTITION BY LIST (app_id);
 
 
 ALTER TABLE api.knack OWNER TO postgres;
@@ -70,7 +75,9 @@ ALTER TABLE api.knack OWNER TO postgres;
 
 CREATE TABLE api.knack_metadata (
     app_id text NOT NULL,
-    metadata json NOT NULL
+    metadata json NOT NULL,
+    version_hash text,
+    container_fingerprints json
 );
 
 
@@ -88,15 +95,30 @@ ALTER TABLE ONLY api.knack_metadata
 -- Name: knack knack_pkey; Type: CONSTRAINT; Schema: api; Owner: postgres
 --
 
-ALTER TABLE ONLY api.knack
+ALTER TABLE api.knack
     ADD CONSTRAINT knack_pkey PRIMARY KEY (record_id, app_id, container_id);
 
 
 --
--- Name: knack_container_id_idx; Type: INDEX; Schema: api; Owner: postgres
+-- Name: knack_app_id_container_id_updated_at_id_idx; Type: INDEX; Schema: api; Owner: postgres
+--
+
+CREATE INDEX knack_app_id_container_id_updated_at_id_idx ON api.knack USING btree (app_id, container_id, updated_at, id);
+
+
+--
+-- Name: knack_app_id_container_id_id_idx; Type: INDEX; Schema: api; Owner: postgres
+--
+
+CREATE INDEX knack_app_id_container_id_id_idx ON api.knack USING btree (app_id, container_id, id);
+
+
+--
+-- Name: knack_record_hash_idx; Type: INDEX; Schema: api; Owner: postgres
 --
 
-CREATE INDEX knack_container_id_idx ON api.knack USING btree (container_id);
+CREATE INDEX knack_record_hash_idx ON api.knack USING btree (record_hash);
+
 
 
 --
@@ -106,6 +128,56 @@ CREATE INDEX knack_container_id_idx ON api.knack USING btree (container_id);
 CREATE TRIGGER set_updated_at BEFORE INSERT OR UPDATE ON api.knack FOR EACH ROW EXECUTE FUNCTION public.trigger_set_updated_at();
 
 
+--
+-- Name: ensure_knack_partition(text, text); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE FUNCTION api.ensure_knack_partition(app_id text, container_id text) RETURNS text
+    LANGUAGE plpgsql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+DECLARE
+    app_partition text := left('knack_' || app_id, 63);
+    container_partition text := left('knack_' || app_id || '_' || container_id, 63);
+BEGIN
+    -- serialize concurrent calls, which would otherwise race to create the same table
+    PERFORM pg_advisory_xact_lock(hashtext('api.knack partitions'));
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS api.%I PARTITION OF api.knack FOR VALUES IN (%L) PARTITION BY LIST (container_id)',
+        app_partition, app_id
+    );
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS api.%I PARTITION OF api.%I FOR VALUES IN (%L)',
+        container_partition, app_partition, container_id
+    );
+    RETURN container_partition;
+END; $$;
+
+
+ALTER FUNCTION api.ensure_knack_partition(text, text) OWNER TO postgres;
+
+--
+-- Name: truncate_knack_partition(text, text); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE FUNCTION api.truncate_knack_partition(app_id text, container_id text) RETURNS void
+    LANGUAGE plpgsql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+BEGIN
+    EXECUTE format(
+        'TRUNCATE TABLE api.%I',
+        api.ensure_knack_partition(app_id, container_id)
+    );
+END; $$;
+
+
+ALTER FUNCTION api.truncate_knack_partition(text, text) OWNER TO postgres;
+
+GRANT EXECUTE ON FUNCTION api.ensure_knack_partition(text, text) TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.truncate_knack_partition(text, text) TO my_api_user;
+
+
 --
 -- Name: SCHEMA api; Type: ACL; Schema: -; Owner: postgres
 --
@@ -129,6 +201,7 @@ GRANT USAGE ON SCHEMA public TO my_api_user;
 --
 
 GRANT ALL ON TABLE api.knack TO my_api_user;
+GRANT USAGE ON SEQUENCE api.knack_id_seq TO my_api_user;
 
 
 --
@@ -137,6 +210,345 @@ GRANT ALL ON TABLE api.knack TO my_api_user;
 
 GRANT ALL ON TABLE api.knack_metadata TO my_api_user;
 
+--
+-- Name: knack_record_body; Type: TABLE; Schema: api; Owner: postgres
+--
+
+CREATE TABLE api.knack_record_body (
+    record_hash text NOT NULL,
+    record jsonb NOT NULL,
+    updated_at timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT knack_record_body_pkey PRIMARY KEY (record_hash)
+);
+
+
+ALTER TABLE api.knack_record_body OWNER TO postgres;
+
+--
+-- Name: knack_records; Type: VIEW; Schema: api; Owner: postgres
+--
+
+CREATE VIEW api.knack_records AS
+SELECT
+    k.id,
+    k.record_id,
+    k.app_id,
+    k.container_id,
+    COALESCE(k.record, b.record) AS record,
+    k.record_hash,
+    k.updated_at,
+    -- compared to the hash last published to each destination. see knack_sync_state
+    md5(COALESCE(k.record, b.record)::text) AS sync_hash
+FROM api.knack k
+LEFT JOIN api.knack_record_body b ON b.record_hash = k.record_hash;
+
+
+ALTER VIEW api.knack_records OWNER TO postgres;
+
+--
+-- Name: upsert_knack_record_bodies(jsonb); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE FUNCTION api.upsert_knack_record_bodies(bodies jsonb) RETURNS void
+    LANGUAGE sql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+    -- bodies are immutable, so a stored body only has its updated_at touched, which
+    -- protects it from a concurrent orphan sweep until it is referenced
+    INSERT INTO api.knack_record_body AS b (record_hash, record)
+    SELECT x.record_hash, x.record
+    FROM jsonb_to_recordset(bodies) AS x(record_hash text, record jsonb)
+    ON CONFLICT (record_hash) DO UPDATE SET updated_at = now();
+$$;
+
+
+ALTER FUNCTION api.upsert_knack_record_bodies(jsonb) OWNER TO postgres;
+
+--
+-- Name: delete_orphaned_knack_record_bodies(interval); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE FUNCTION api.delete_orphaned_knack_record_bodies(grace interval DEFAULT '1 hour') RETURNS integer
+    LANGUAGE sql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+    -- bodies written within the grace period are kept, because a concurrent load
+    -- may have written them but not yet upserted the records which reference them
+    WITH deleted AS (
+        DELETE FROM api.knack_record_body b
+        WHERE b.updated_at < now() - grace
+            AND NOT EXISTS (
+                SELECT 1 FROM api.knack k WHERE k.record_hash = b.record_hash
+            )
+        RETURNING 1
+    )
+    SELECT count(*)::integer FROM deleted;
+$$;
+
+
+ALTER FUNCTION api.delete_orphaned_knack_record_bodies(interval) OWNER TO postgres;
+
+GRANT ALL ON TABLE api.knack_record_body TO my_api_user;
+GRANT SELECT ON TABLE api.knack_records TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.upsert_knack_record_bodies(jsonb) TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.delete_orphaned_knack_record_bodies(interval) TO my_api_user;
+
+--
+-- Name: knack_flat_views; Type: TABLE; Schema: api; Owner: postgres
+--
+
+CREATE TABLE api.knack_flat_views (
+    app_id text NOT NULL,
+    container_id text NOT NULL,
+    view_name text NOT NULL,
+    refreshed_at timestamp with time zone
+);
+
+
+ALTER TABLE api.knack_flat_views OWNER TO postgres;
+
+ALTER TABLE ONLY api.knack_flat_views
+    ADD CONSTRAINT knack_flat_views_pkey PRIMARY KEY (app_id, container_id);
+
+
+--
+-- Name: refresh_knack_flat_views(text, text); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE FUNCTION api.refresh_knack_flat_views(app_id text, container_id text) RETURNS integer
+    LANGUAGE plpgsql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+DECLARE
+    flat_view record;
+    refreshed integer := 0;
+BEGIN
+    FOR flat_view IN
+        SELECT v.view_name FROM api.knack_flat_views v
+        WHERE v.app_id = refresh_knack_flat_views.app_id
+            AND v.container_id = refresh_knack_flat_views.container_id
+    LOOP
+        EXECUTE format('REFRESH MATERIALIZED VIEW CONCURRENTLY api.%I', flat_view.view_name);
+        UPDATE api.knack_flat_views v SET refreshed_at = now()
+        WHERE v.app_id = refresh_knack_flat_views.app_id
+            AND v.container_id = refresh_knack_flat_views.container_id;
+        refreshed := refreshed + 1;
+    END LOOP;
+    RETURN refreshed;
+END; $$;
+
+
+ALTER FUNCTION api.refresh_knack_flat_views(text, text) OWNER TO postgres;
+
+GRANT SELECT ON TABLE api.knack_flat_views TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.refresh_knack_flat_views(text, text) TO my_api_user;
+
+--
+-- Name: knack_checkpoints; Type: TABLE; Schema: api; Owner: postgres
+--
+
+CREATE TABLE api.knack_checkpoints (
+    service text NOT NULL,
+    app_id text NOT NULL,
+    container_id text NOT NULL,
+    destination text DEFAULT '' NOT NULL,
+    watermark timestamp with time zone NOT NULL,
+    updated_at timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT knack_checkpoints_pkey PRIMARY KEY (service, app_id, container_id, destination)
+);
+
+
+ALTER TABLE api.knack_checkpoints OWNER TO postgres;
+
+--
+-- Name: advance_knack_checkpoint(text, text, text, text, timestamp with time zone); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE FUNCTION api.advance_knack_checkpoint(service text, app_id text, container_id text, destination text, watermark timestamp with time zone) RETURNS timestamp with time zone
+    LANGUAGE sql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+    -- a checkpoint never moves backwards, e.g. after a backfill of an earlier date
+    INSERT INTO api.knack_checkpoints AS c (service, app_id, container_id, destination, watermark)
+        VALUES (service, app_id, container_id, destination, watermark)
+    ON CONFLICT (service, app_id, container_id, destination) DO UPDATE
+        SET watermark = GREATEST(c.watermark, excluded.watermark), updated_at = now()
+    RETURNING c.watermark;
+$$;
+
+
+ALTER FUNCTION api.advance_knack_checkpoint(text, text, text, text, timestamp with time zone) OWNER TO postgres;
+
+GRANT SELECT ON TABLE api.knack_checkpoints TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.advance_knack_checkpoint(text, text, text, text, timestamp with time zone) TO my_api_user;
+
+--
+-- Name: knack_sync_state; Type: TABLE; Schema: api; Owner: postgres
+--
+
+CREATE TABLE api.knack_sync_state (
+    app_id text NOT NULL,
+    container_id text NOT NULL,
+    record_id text NOT NULL,
+    destination text NOT NULL,
+    sync_hash text NOT NULL,
+    synced_at timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT knack_sync_state_pkey PRIMARY KEY (app_id, container_id, destination, record_id)
+);
+
+
+ALTER TABLE api.knack_sync_state OWNER TO postgres;
+
+--
+-- Name: select_unsynced_knack_records(text, text, text, bigint, integer); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE FUNCTION api.select_unsynced_knack_records(app_id text, container_id text, destination text, after_id bigint DEFAULT 0, max_rows integer DEFAULT 1000) RETURNS SETOF api.knack_records
+    LANGUAGE sql STABLE SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+    -- paged by id rather than by offset, so that each page only hashes the records
+    -- from after_id until max_rows unsynced records are found
+    SELECT r.* FROM api.knack_records r
+    WHERE r.app_id = select_unsynced_knack_records.app_id
+        AND r.container_id = select_unsynced_knack_records.container_id
+        AND r.id > select_unsynced_knack_records.after_id
+        AND NOT EXISTS (
+            SELECT 1 FROM api.knack_sync_state s
+            WHERE s.app_id = r.app_id
+                AND s.container_id = r.container_id
+                AND s.destination = select_unsynced_knack_records.destination
+                AND s.record_id = r.record_id
+                AND s.sync_hash = r.sync_hash
+        )
+    ORDER BY r.id
+    LIMIT select_unsynced_knack_records.max_rows;
+$$;
+
+
+ALTER FUNCTION api.select_unsynced_knack_records(text, text, text, bigint, integer) OWNER TO postgres;
+
+GRANT ALL ON TABLE api.knack_sync_state TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.select_unsynced_knack_records(text, text, text, bigint, integer) TO my_api_user;
+
+--
+-- Name: knack_tombstones; Type: TABLE; Schema: api; Owner: postgres
+--
+
+CREATE TABLE api.knack_tombstones (
+    app_id text NOT NULL,
+    container_id text NOT NULL,
+    record_id text NOT NULL,
+    -- the last version of the record before it was deleted
+    record jsonb,
+    deleted_at timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT knack_tombstones_pkey PRIMARY KEY (app_id, container_id, record_id)
+);
+
+
+ALTER TABLE api.knack_tombstones OWNER TO postgres;
+
+CREATE INDEX knack_tombstones_app_id_container_id_deleted_at_idx ON api.knack_tombstones USING btree (app_id, container_id, deleted_at);
+
+--
+-- Name: tombstone_knack_records(text, text, text[], numeric); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE FUNCTION api.tombstone_knack_records(app_id text, container_id text, record_ids text[], max_fraction numeric DEFAULT 0.25) RETURNS integer
+    LANGUAGE plpgsql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+DECLARE
+    total integer;
+    missing integer;
+    tombstoned integer;
+BEGIN
+    -- an empty or truncated list of IDs, e.g. from a misconfigured view, would
+    -- otherwise tombstone the whole container. nothing is tombstoned, and null is
+    -- returned, if more than max_fraction of the container's records (and more
+    -- than 10 records) are missing from record_ids
+    SELECT
+        count(*),
+        count(*) FILTER (
+            WHERE NOT EXISTS (
+                SELECT 1 FROM unnest(record_ids) AS ids(record_id)
+                WHERE ids.record_id = k.record_id
+            )
+        )
+    INTO total, missing
+    FROM api.knack k
+    WHERE k.app_id = tombstone_knack_records.app_id
+        AND k.container_id = tombstone_knack_records.container_id;
+
+    IF missing > GREATEST(10, total * max_fraction) THEN
+        RAISE WARNING 'Refusing to tombstone % of % records of %/%',
+            missing, total, tombstone_knack_records.app_id,
+            tombstone_knack_records.container_id;
+        RETURN NULL;
+    END IF;
+
+    -- records which are back in the container, e.g. in a view, are no longer deleted
+    DELETE FROM api.knack_tombstones t
+    WHERE t.app_id = tombstone_knack_records.app_id
+        AND t.container_id = tombstone_knack_records.container_id
+        AND t.record_id IN (SELECT unnest(record_ids));
+
+    WITH deleted AS (
+        DELETE FROM api.knack k
+        WHERE k.app_id = tombstone_knack_records.app_id
+            AND k.container_id = tombstone_knack_records.container_id
+            AND NOT EXISTS (
+                SELECT 1 FROM unnest(record_ids) AS ids(record_id)
+                WHERE ids.record_id = k.record_id
+            )
+        RETURNING k.record_id, k.record, k.record_hash
+    )
+    INSERT INTO api.knack_tombstones (app_id, container_id, record_id, record)
+    SELECT
+        tombstone_knack_records.app_id,
+        tombstone_knack_records.container_id,
+        d.record_id,
+        COALESCE(d.record, b.record)
+    FROM deleted d
+    LEFT JOIN api.knack_record_body b ON b.record_hash = d.record_hash
+    ON CONFLICT ON CONSTRAINT knack_tombstones_pkey DO UPDATE
+        SET record = excluded.record, deleted_at = now();
+
+    GET DIAGNOSTICS tombstoned = ROW_COUNT;
+    RETURN tombstoned;
+END; $$;
+
+
+ALTER FUNCTION api.tombstone_knack_records(text, text, text[], numeric) OWNER TO postgres;
+
+--
+-- Name: select_unsynced_knack_tombstones(text, text, text); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE FUNCTION api.select_unsynced_knack_tombstones(app_id text, container_id text, destination text) RETURNS SETOF api.knack_tombstones
+    LANGUAGE sql STABLE SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+    -- tombstones of records which are still published to the destination
+    SELECT t.* FROM api.knack_tombstones t
+    WHERE t.app_id = select_unsynced_knack_tombstones.app_id
+        AND t.container_id = select_unsynced_knack_tombstones.container_id
+        AND EXISTS (
+            SELECT 1 FROM api.knack_sync_state s
+            WHERE s.app_id = t.app_id
+                AND s.container_id = t.container_id
+                AND s.destination = select_unsynced_knack_tombstones.destination
+                AND s.record_id = t.record_id
+        );
+$$;
+
+
+ALTER FUNCTION api.select_unsynced_knack_tombstones(text, text, text) OWNER TO postgres;
+
+GRANT SELECT ON TABLE api.knack_tombstones TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.tombstone_knack_records(text, text, text[], numeric) TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.select_unsynced_knack_tombstones(text, text, text) TO my_api_user;
+
 --
 -- PostgreSQL database dump complete
 --
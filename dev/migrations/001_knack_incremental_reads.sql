@@ -0,0 +1,26 @@
+-- Speed up incremental reads of api.knack.
+--
+-- Publishers select records by app_id, container_id, and updated_at >= <date>,
+-- ordered by id. This adds a composite index which serves that query, and converts
+-- `record` to jsonb so that it is stored pre-parsed and supports json path
+-- operators and indexes.
+--
+-- Converting `record` rewrites the table and holds an exclusive lock for the
+-- duration, so run this when no services are scheduled.
+--
+-- $ psql -v ON_ERROR_STOP=1 -f dev/migrations/001_knack_incremental_reads.sql
+
+BEGIN;
+
+-- publishers order by id, which may not exist in older deployments
+ALTER TABLE api.knack ADD COLUMN IF NOT EXISTS id bigserial NOT NULL;
+GRANT USAGE ON SEQUENCE api.knack_id_seq TO my_api_user;
+
+ALTER TABLE api.knack ALTER COLUMN record TYPE jsonb USING record::jsonb;
+
+CREATE INDEX IF NOT EXISTS knack_app_id_container_id_updated_at_id_idx
+    ON api.knack USING btree (app_id, container_id, updated_at, id);
+
+COMMIT;
+
+ANALYZE api.knack;
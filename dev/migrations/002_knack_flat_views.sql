@@ -0,0 +1,56 @@
+-- Add the registry of flattened container views and the function which refreshes
+-- them. Views are created with services/generate_flat_views.py.
+--
+-- $ psql -v ON_ERROR_STOP=1 -f dev/migrations/002_knack_flat_views.sql
+
+BEGIN;
+
+--
+-- Name: knack_flat_views; Type: TABLE; Schema: api; Owner: postgres
+--
+
+CREATE TABLE IF NOT EXISTS api.knack_flat_views (
+    app_id text NOT NULL,
+    container_id text NOT NULL,
+    view_name text NOT NULL,
+    refreshed_at timestamp with time zone,
+    CONSTRAINT knack_flat_views_pkey PRIMARY KEY (app_id, container_id)
+);
+
+
+ALTER TABLE api.knack_flat_views OWNER TO postgres;
+
+
+--
+-- Name: refresh_knack_flat_views(text, text); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE OR REPLACE FUNCTION api.refresh_knack_flat_views(app_id text, container_id text) RETURNS integer
+    LANGUAGE plpgsql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+DECLARE
+    flat_view record;
+    refreshed integer := 0;
+BEGIN
+    FOR flat_view IN
+        SELECT v.view_name FROM api.knack_flat_views v
+        WHERE v.app_id = refresh_knack_flat_views.app_id
+            AND v.container_id = refresh_knack_flat_views.container_id
+    LOOP
+        EXECUTE format('REFRESH MATERIALIZED VIEW CONCURRENTLY api.%I', flat_view.view_name);
+        UPDATE api.knack_flat_views v SET refreshed_at = now()
+        WHERE v.app_id = refresh_knack_flat_views.app_id
+            AND v.container_id = refresh_knack_flat_views.container_id;
+        refreshed := refreshed + 1;
+    END LOOP;
+    RETURN refreshed;
+END; $$;
+
+
+ALTER FUNCTION api.refresh_knack_flat_views(text, text) OWNER TO postgres;
+
+GRANT SELECT ON TABLE api.knack_flat_views TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.refresh_knack_flat_views(text, text) TO my_api_user;
+
+COMMIT;
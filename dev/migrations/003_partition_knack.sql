@@ -0,0 +1,111 @@
+-- Partition api.knack by app_id, and then by container_id.
+--
+-- Each container's records are stored in their own table, so a full replace is a
+-- truncate of that table (see api.truncate_knack_partition) rather than a DELETE
+-- which bloats the whole table, and incremental reads only scan one small table.
+-- records_to_postgrest.py creates partitions as needed with
+-- api.ensure_knack_partition.
+--
+-- Requires Postgres 13 or later, for row triggers on partitioned tables, and
+-- migration 001. The table is copied in full, so run this when no services are
+-- scheduled. Flattened views (see generate_flat_views.py) are dropped with the old
+-- table and must be regenerated afterwards.
+--
+-- $ psql -v ON_ERROR_STOP=1 -f dev/migrations/003_partition_knack.sql
+
+BEGIN;
+
+ALTER TABLE api.knack RENAME TO knack_unpartitioned;
+ALTER INDEX api.knack_pkey RENAME TO knack_unpartitioned_pkey;
+ALTER INDEX api.knack_app_id_container_id_updated_at_id_idx
+    RENAME TO knack_unpartitioned_app_id_container_id_updated_at_id_idx;
+DROP TRIGGER set_updated_at ON api.knack_unpartitioned;
+
+CREATE TABLE api.knack (
+    id bigint DEFAULT nextval('api.knack_id_seq'::regclass) NOT NULL,
+    record_id text NOT NULL,
+    app_id text NOT NULL,
+    container_id text NOT NULL,
+    record jsonb NOT NULL,
+    updated_at timestamp with time zone DEFAULT now() NOT NULL
+) PARTITION BY LIST (app_id);
+
+ALTER TABLE api.knack OWNER TO postgres;
+
+ALTER TABLE api.knack
+    ADD CONSTRAINT knack_pkey PRIMARY KEY (record_id, app_id, container_id);
+
+CREATE INDEX knack_app_id_container_id_updated_at_id_idx
+    ON api.knack USING btree (app_id, container_id, updated_at, id);
+
+--
+-- Name: ensure_knack_partition(text, text); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE OR REPLACE FUNCTION api.ensure_knack_partition(app_id text, container_id text) RETURNS text
+    LANGUAGE plpgsql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+DECLARE
+    app_partition text := left('knack_' || app_id, 63);
+    container_partition text := left('knack_' || app_id || '_' || container_id, 63);
+BEGIN
+    -- serialize concurrent calls, which would otherwise race to create the same table
+    PERFORM pg_advisory_xact_lock(hashtext('api.knack partitions'));
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS api.%I PARTITION OF api.knack FOR VALUES IN (%L) PARTITION BY LIST (container_id)',
+        app_partition, app_id
+    );
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS api.%I PARTITION OF api.%I FOR VALUES IN (%L)',
+        container_partition, app_partition, container_id
+    );
+    RETURN container_partition;
+END; $$;
+
+
+ALTER FUNCTION api.ensure_knack_partition(text, text) OWNER TO postgres;
+
+--
+-- Name: truncate_knack_partition(text, text); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE OR REPLACE FUNCTION api.truncate_knack_partition(app_id text, container_id text) RETURNS void
+    LANGUAGE plpgsql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+BEGIN
+    EXECUTE format(
+        'TRUNCATE TABLE api.%I',
+        api.ensure_knack_partition(app_id, container_id)
+    );
+END; $$;
+
+
+ALTER FUNCTION api.truncate_knack_partition(text, text) OWNER TO postgres;
+
+GRANT EXECUTE ON FUNCTION api.ensure_knack_partition(text, text) TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.truncate_knack_partition(text, text) TO my_api_user;
+
+SELECT api.ensure_knack_partition(p.app_id, p.container_id)
+FROM (SELECT DISTINCT app_id, container_id FROM api.knack_unpartitioned) AS p;
+
+-- the updated_at trigger is created after the copy so that timestamps are preserved
+INSERT INTO api.knack (id, record_id, app_id, container_id, record, updated_at)
+SELECT id, record_id, app_id, container_id, record, updated_at
+FROM api.knack_unpartitioned;
+
+CREATE TRIGGER set_updated_at BEFORE INSERT OR UPDATE ON api.knack
+    FOR EACH ROW EXECUTE FUNCTION public.trigger_set_updated_at();
+
+ALTER SEQUENCE api.knack_id_seq OWNED BY api.knack.id;
+
+-- flattened views select from the old table, so they are dropped with it
+DROP TABLE api.knack_unpartitioned CASCADE;
+DELETE FROM api.knack_flat_views;
+
+GRANT ALL ON TABLE api.knack TO my_api_user;
+
+COMMIT;
+
+ANALYZE api.knack;
@@ -0,0 +1,76 @@
+-- Content-addressed storage of Knack record bodies.
+--
+-- With `records_to_postgrest.py --dedupe`, each distinct record body is stored once
+-- in api.knack_record_body, keyed by its sha256 hash, and api.knack rows reference
+-- it by record_hash with a null record. Readers select from the api.knack_records
+-- view, which resolves either kind of row to its record.
+--
+-- $ psql -v ON_ERROR_STOP=1 -f dev/migrations/004_knack_record_body.sql
+
+BEGIN;
+
+ALTER TABLE api.knack ALTER COLUMN record DROP NOT NULL;
+ALTER TABLE api.knack ADD COLUMN IF NOT EXISTS record_hash text;
+ALTER TABLE api.knack ADD CONSTRAINT knack_record_check
+    CHECK (record IS NOT NULL OR record_hash IS NOT NULL);
+CREATE INDEX IF NOT EXISTS knack_record_hash_idx
+    ON api.knack USING btree (record_hash);
+
+--
+-- Name: knack_record_body; Type: TABLE; Schema: api; Owner: postgres
+--
+
+CREATE TABLE IF NOT EXISTS api.knack_record_body (
+    record_hash text NOT NULL,
+    record jsonb NOT NULL,
+    CONSTRAINT knack_record_body_pkey PRIMARY KEY (record_hash)
+);
+
+
+ALTER TABLE api.knack_record_body OWNER TO postgres;
+
+--
+-- Name: knack_records; Type: VIEW; Schema: api; Owner: postgres
+--
+
+CREATE OR REPLACE VIEW api.knack_records AS
+SELECT
+    k.id,
+    k.record_id,
+    k.app_id,
+    k.container_id,
+    COALESCE(k.record, b.record) AS record,
+    k.record_hash,
+    k.updated_at
+FROM api.knack k
+LEFT JOIN api.knack_record_body b ON b.record_hash = k.record_hash;
+
+
+ALTER VIEW api.knack_records OWNER TO postgres;
+
+--
+-- Name: delete_orphaned_knack_record_bodies(); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE OR REPLACE FUNCTION api.delete_orphaned_knack_record_bodies() RETURNS integer
+    LANGUAGE sql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+    WITH deleted AS (
+        DELETE FROM api.knack_record_body b
+        WHERE NOT EXISTS (
+            SELECT 1 FROM api.knack k WHERE k.record_hash = b.record_hash
+        )
+        RETURNING 1
+    )
+    SELECT count(*)::integer FROM deleted;
+$$;
+
+
+ALTER FUNCTION api.delete_orphaned_knack_record_bodies() OWNER TO postgres;
+
+GRANT ALL ON TABLE api.knack_record_body TO my_api_user;
+GRANT SELECT ON TABLE api.knack_records TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.delete_orphaned_knack_record_bodies() TO my_api_user;
+
+COMMIT;
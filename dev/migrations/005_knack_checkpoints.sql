@@ -0,0 +1,50 @@
+-- Persisted high-water-mark checkpoints.
+--
+-- With `--checkpoint`, services read the watermark of their last successful run from
+-- api.knack_checkpoints instead of an externally supplied `--date`, and advance it
+-- with api.advance_knack_checkpoint once the run succeeds.
+--
+-- $ psql -v ON_ERROR_STOP=1 -f dev/migrations/005_knack_checkpoints.sql
+
+BEGIN;
+
+--
+-- Name: knack_checkpoints; Type: TABLE; Schema: api; Owner: postgres
+--
+
+CREATE TABLE IF NOT EXISTS api.knack_checkpoints (
+    service text NOT NULL,
+    app_id text NOT NULL,
+    container_id text NOT NULL,
+    destination text DEFAULT '' NOT NULL,
+    watermark timestamp with time zone NOT NULL,
+    updated_at timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT knack_checkpoints_pkey PRIMARY KEY (service, app_id, container_id, destination)
+);
+
+
+ALTER TABLE api.knack_checkpoints OWNER TO postgres;
+
+--
+-- Name: advance_knack_checkpoint(text, text, text, text, timestamp with time zone); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE OR REPLACE FUNCTION api.advance_knack_checkpoint(service text, app_id text, container_id text, destination text, watermark timestamp with time zone) RETURNS timestamp with time zone
+    LANGUAGE sql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+    -- a checkpoint never moves backwards, e.g. after a backfill of an earlier date
+    INSERT INTO api.knack_checkpoints AS c (service, app_id, container_id, destination, watermark)
+        VALUES (service, app_id, container_id, destination, watermark)
+    ON CONFLICT (service, app_id, container_id, destination) DO UPDATE
+        SET watermark = GREATEST(c.watermark, excluded.watermark), updated_at = now()
+    RETURNING c.watermark;
+$$;
+
+
+ALTER FUNCTION api.advance_knack_checkpoint(text, text, text, text, timestamp with time zone) OWNER TO postgres;
+
+GRANT SELECT ON TABLE api.knack_checkpoints TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.advance_knack_checkpoint(text, text, text, text, timestamp with time zone) TO my_api_user;
+
+COMMIT;
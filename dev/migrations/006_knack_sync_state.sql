@@ -0,0 +1,70 @@
+-- Per-destination sync state of Knack records.
+--
+-- With `--sync-state`, the publishers select only the records whose current hash
+-- differs from the hash they last published to their destination, and record the
+-- hash of each record once it has been published.
+--
+-- $ psql -v ON_ERROR_STOP=1 -f dev/migrations/006_knack_sync_state.sql
+
+BEGIN;
+
+CREATE OR REPLACE VIEW api.knack_records AS
+SELECT
+    k.id,
+    k.record_id,
+    k.app_id,
+    k.container_id,
+    COALESCE(k.record, b.record) AS record,
+    k.record_hash,
+    k.updated_at,
+    -- compared to the hash last published to each destination. see knack_sync_state
+    md5(COALESCE(k.record, b.record)::text) AS sync_hash
+FROM api.knack k
+LEFT JOIN api.knack_record_body b ON b.record_hash = k.record_hash;
+
+
+--
+-- Name: knack_sync_state; Type: TABLE; Schema: api; Owner: postgres
+--
+
+CREATE TABLE IF NOT EXISTS api.knack_sync_state (
+    app_id text NOT NULL,
+    container_id text NOT NULL,
+    record_id text NOT NULL,
+    destination text NOT NULL,
+    sync_hash text NOT NULL,
+    synced_at timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT knack_sync_state_pkey PRIMARY KEY (app_id, container_id, destination, record_id)
+);
+
+
+ALTER TABLE api.knack_sync_state OWNER TO postgres;
+
+--
+-- Name: select_unsynced_knack_records(text, text, text); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE OR REPLACE FUNCTION api.select_unsynced_knack_records(app_id text, container_id text, destination text) RETURNS SETOF api.knack_records
+    LANGUAGE sql STABLE SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+    SELECT r.* FROM api.knack_records r
+    WHERE r.app_id = select_unsynced_knack_records.app_id
+        AND r.container_id = select_unsynced_knack_records.container_id
+        AND NOT EXISTS (
+            SELECT 1 FROM api.knack_sync_state s
+            WHERE s.app_id = r.app_id
+                AND s.container_id = r.container_id
+                AND s.destination = select_unsynced_knack_records.destination
+                AND s.record_id = r.record_id
+                AND s.sync_hash = r.sync_hash
+        );
+$$;
+
+
+ALTER FUNCTION api.select_unsynced_knack_records(text, text, text) OWNER TO postgres;
+
+GRANT ALL ON TABLE api.knack_sync_state TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.select_unsynced_knack_records(text, text, text) TO my_api_user;
+
+COMMIT;
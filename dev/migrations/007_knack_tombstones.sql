@@ -0,0 +1,103 @@
+-- Tombstones of deleted Knack records.
+--
+-- With `records_to_postgrest.py --tombstones`, records which are no longer in their
+-- Knack container are moved from api.knack to api.knack_tombstones, and the
+-- publishers delete them from their destinations with `--tombstones`.
+--
+-- $ psql -v ON_ERROR_STOP=1 -f dev/migrations/007_knack_tombstones.sql
+
+BEGIN;
+
+--
+-- Name: knack_tombstones; Type: TABLE; Schema: api; Owner: postgres
+--
+
+CREATE TABLE IF NOT EXISTS api.knack_tombstones (
+    app_id text NOT NULL,
+    container_id text NOT NULL,
+    record_id text NOT NULL,
+    -- the last version of the record before it was deleted
+    record jsonb,
+    deleted_at timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT knack_tombstones_pkey PRIMARY KEY (app_id, container_id, record_id)
+);
+
+
+ALTER TABLE api.knack_tombstones OWNER TO postgres;
+
+CREATE INDEX IF NOT EXISTS knack_tombstones_app_id_container_id_deleted_at_idx ON api.knack_tombstones USING btree (app_id, container_id, deleted_at);
+
+--
+-- Name: tombstone_knack_records(text, text, text[]); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE OR REPLACE FUNCTION api.tombstone_knack_records(app_id text, container_id text, record_ids text[]) RETURNS integer
+    LANGUAGE plpgsql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+DECLARE
+    tombstoned integer;
+BEGIN
+    -- records which are back in the container, e.g. in a view, are no longer deleted
+    DELETE FROM api.knack_tombstones t
+    WHERE t.app_id = tombstone_knack_records.app_id
+        AND t.container_id = tombstone_knack_records.container_id
+        AND t.record_id IN (SELECT unnest(record_ids));
+
+    WITH deleted AS (
+        DELETE FROM api.knack k
+        WHERE k.app_id = tombstone_knack_records.app_id
+            AND k.container_id = tombstone_knack_records.container_id
+            AND NOT EXISTS (
+                SELECT 1 FROM unnest(record_ids) AS ids(record_id)
+                WHERE ids.record_id = k.record_id
+            )
+        RETURNING k.record_id, k.record, k.record_hash
+    )
+    INSERT INTO api.knack_tombstones (app_id, container_id, record_id, record)
+    SELECT
+        tombstone_knack_records.app_id,
+        tombstone_knack_records.container_id,
+        d.record_id,
+        COALESCE(d.record, b.record)
+    FROM deleted d
+    LEFT JOIN api.knack_record_body b ON b.record_hash = d.record_hash
+    ON CONFLICT ON CONSTRAINT knack_tombstones_pkey DO UPDATE
+        SET record = excluded.record, deleted_at = now();
+
+    GET DIAGNOSTICS tombstoned = ROW_COUNT;
+    RETURN tombstoned;
+END; $$;
+
+
+ALTER FUNCTION api.tombstone_knack_records(text, text, text[]) OWNER TO postgres;
+
+--
+-- Name: select_unsynced_knack_tombstones(text, text, text); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE OR REPLACE FUNCTION api.select_unsynced_knack_tombstones(app_id text, container_id text, destination text) RETURNS SETOF api.knack_tombstones
+    LANGUAGE sql STABLE SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+    -- tombstones of records which are still published to the destination
+    SELECT t.* FROM api.knack_tombstones t
+    WHERE t.app_id = select_unsynced_knack_tombstones.app_id
+        AND t.container_id = select_unsynced_knack_tombstones.container_id
+        AND EXISTS (
+            SELECT 1 FROM api.knack_sync_state s
+            WHERE s.app_id = t.app_id
+                AND s.container_id = t.container_id
+                AND s.destination = select_unsynced_knack_tombstones.destination
+                AND s.record_id = t.record_id
+        );
+$$;
+
+
+ALTER FUNCTION api.select_unsynced_knack_tombstones(text, text, text) OWNER TO postgres;
+
+GRANT SELECT ON TABLE api.knack_tombstones TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.tombstone_knack_records(text, text, text[]) TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.select_unsynced_knack_tombstones(text, text, text) TO my_api_user;
+
+COMMIT;
@@ -0,0 +1,16 @@
+-- Versioned Knack app metadata.
+--
+-- metadata_to_postgrest.py stores a sha256 hash of each app's metadata in
+-- api.knack_metadata.version_hash, which utils.postgrest.get_metadata uses to serve
+-- metadata from its local cache, and a fingerprint of each container's field set in
+-- api.knack_metadata.container_fingerprints. metadata_to_postgrest.py fails until
+-- this migration is applied, because it writes both columns.
+--
+-- $ psql -v ON_ERROR_STOP=1 -f dev/migrations/008_knack_metadata_version_hash.sql
+
+BEGIN;
+
+ALTER TABLE api.knack_metadata ADD COLUMN IF NOT EXISTS version_hash text;
+ALTER TABLE api.knack_metadata ADD COLUMN IF NOT EXISTS container_fingerprints json;
+
+COMMIT;
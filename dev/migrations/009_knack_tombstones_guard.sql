@@ -0,0 +1,85 @@
+-- Guard tombstone_knack_records against empty or truncated lists of record IDs.
+--
+-- The function now refuses to tombstone, and returns null, when more than
+-- `max_fraction` of a container's records would be tombstoned.
+--
+-- $ psql -v ON_ERROR_STOP=1 -f dev/migrations/009_knack_tombstones_guard.sql
+
+BEGIN;
+
+DROP FUNCTION IF EXISTS api.tombstone_knack_records(text, text, text[]);
+
+--
+-- Name: tombstone_knack_records(text, text, text[], numeric); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE OR REPLACE FUNCTION api.tombstone_knack_records(app_id text, container_id text, record_ids text[], max_fraction numeric DEFAULT 0.25) RETURNS integer
+    LANGUAGE plpgsql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+DECLARE
+    total integer;
+    missing integer;
+    tombstoned integer;
+BEGIN
+    -- an empty or truncated list of IDs, e.g. from a misconfigured view, would
+    -- otherwise tombstone the whole container. nothing is tombstoned, and null is
+    -- returned, if more than max_fraction of the container's records (and more
+    -- than 10 records) are missing from record_ids
+    SELECT
+        count(*),
+        count(*) FILTER (
+            WHERE NOT EXISTS (
+                SELECT 1 FROM unnest(record_ids) AS ids(record_id)
+                WHERE ids.record_id = k.record_id
+            )
+        )
+    INTO total, missing
+    FROM api.knack k
+    WHERE k.app_id = tombstone_knack_records.app_id
+        AND k.container_id = tombstone_knack_records.container_id;
+
+    IF missing > GREATEST(10, total * max_fraction) THEN
+        RAISE WARNING 'Refusing to tombstone % of % records of %/%',
+            missing, total, tombstone_knack_records.app_id,
+            tombstone_knack_records.container_id;
+        RETURN NULL;
+    END IF;
+
+    -- records which are back in the container, e.g. in a view, are no longer deleted
+    DELETE FROM api.knack_tombstones t
+    WHERE t.app_id = tombstone_knack_records.app_id
+        AND t.container_id = tombstone_knack_records.container_id
+        AND t.record_id IN (SELECT unnest(record_ids));
+
+    WITH deleted AS (
+        DELETE FROM api.knack k
+        WHERE k.app_id = tombstone_knack_records.app_id
+            AND k.container_id = tombstone_knack_records.container_id
+            AND NOT EXISTS (
+                SELECT 1 FROM unnest(record_ids) AS ids(record_id)
+                WHERE ids.record_id = k.record_id
+            )
+        RETURNING k.record_id, k.record, k.record_hash
+    )
+    INSERT INTO api.knack_tombstones (app_id, container_id, record_id, record)
+    SELECT
+        tombstone_knack_records.app_id,
+        tombstone_knack_records.container_id,
+        d.record_id,
+        COALESCE(d.record, b.record)
+    FROM deleted d
+    LEFT JOIN api.knack_record_body b ON b.record_hash = d.record_hash
+    ON CONFLICT ON CONSTRAINT knack_tombstones_pkey DO UPDATE
+        SET record = excluded.record, deleted_at = now();
+
+    GET DIAGNOSTICS tombstoned = ROW_COUNT;
+    RETURN tombstoned;
+END; $$;
+
+
+ALTER FUNCTION api.tombstone_knack_records(text, text, text[], numeric) OWNER TO postgres;
+
+GRANT EXECUTE ON FUNCTION api.tombstone_knack_records(text, text, text[], numeric) TO my_api_user;
+
+COMMIT;
@@ -0,0 +1,66 @@
+-- Scope the sweep of orphaned Knack record bodies.
+--
+-- Bodies are written with api.upsert_knack_record_bodies, which touches the
+-- updated_at of bodies that are already stored. api.delete_orphaned_knack_record_bodies
+-- only sweeps the given bodies (those a container referenced before a full replace),
+-- and only once they have not been written for a grace period, so that a concurrent
+-- load's bodies are never deleted before its rows reference them.
+--
+-- $ psql -v ON_ERROR_STOP=1 -f dev/migrations/010_knack_record_body_sweep.sql
+
+BEGIN;
+
+ALTER TABLE api.knack_record_body
+    ADD COLUMN IF NOT EXISTS updated_at timestamp with time zone DEFAULT now() NOT NULL;
+
+DROP FUNCTION IF EXISTS api.delete_orphaned_knack_record_bodies();
+
+--
+-- Name: upsert_knack_record_bodies(jsonb); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE OR REPLACE FUNCTION api.upsert_knack_record_bodies(bodies jsonb) RETURNS void
+    LANGUAGE sql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+    -- bodies are immutable, so a stored body only has its updated_at touched, which
+    -- protects it from a concurrent orphan sweep until it is referenced
+    INSERT INTO api.knack_record_body AS b (record_hash, record)
+    SELECT x.record_hash, x.record
+    FROM jsonb_to_recordset(bodies) AS x(record_hash text, record jsonb)
+    ON CONFLICT (record_hash) DO UPDATE SET updated_at = now();
+$$;
+
+
+ALTER FUNCTION api.upsert_knack_record_bodies(jsonb) OWNER TO postgres;
+
+--
+-- Name: delete_orphaned_knack_record_bodies(text[], interval); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE OR REPLACE FUNCTION api.delete_orphaned_knack_record_bodies(record_hashes text[], grace interval DEFAULT '1 hour') RETURNS integer
+    LANGUAGE sql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+    -- only the given bodies are swept, and only if they have not been written within
+    -- the grace period, so that bodies which a concurrent load has written but not
+    -- yet referenced are kept
+    WITH deleted AS (
+        DELETE FROM api.knack_record_body b
+        WHERE b.record_hash IN (SELECT unnest(record_hashes))
+            AND b.updated_at < now() - grace
+            AND NOT EXISTS (
+                SELECT 1 FROM api.knack k WHERE k.record_hash = b.record_hash
+            )
+        RETURNING 1
+    )
+    SELECT count(*)::integer FROM deleted;
+$$;
+
+
+ALTER FUNCTION api.delete_orphaned_knack_record_bodies(text[], interval) OWNER TO postgres;
+
+GRANT EXECUTE ON FUNCTION api.upsert_knack_record_bodies(jsonb) TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.delete_orphaned_knack_record_bodies(text[], interval) TO my_api_user;
+
+COMMIT;
@@ -0,0 +1,39 @@
+-- Sweep every orphaned Knack record body, not only those of the replaced container.
+--
+-- Bodies are also orphaned by incremental loads which change a record, and by
+-- tombstoning, so api.delete_orphaned_knack_record_bodies now considers every body
+-- which no record references, and which has not been written within the grace period.
+--
+-- $ psql -v ON_ERROR_STOP=1 -f dev/migrations/011_knack_record_body_global_sweep.sql
+
+BEGIN;
+
+DROP FUNCTION IF EXISTS api.delete_orphaned_knack_record_bodies(text[], interval);
+
+--
+-- Name: delete_orphaned_knack_record_bodies(interval); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE OR REPLACE FUNCTION api.delete_orphaned_knack_record_bodies(grace interval DEFAULT '1 hour') RETURNS integer
+    LANGUAGE sql SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+    -- bodies written within the grace period are kept, because a concurrent load
+    -- may have written them but not yet upserted the records which reference them
+    WITH deleted AS (
+        DELETE FROM api.knack_record_body b
+        WHERE b.updated_at < now() - grace
+            AND NOT EXISTS (
+                SELECT 1 FROM api.knack k WHERE k.record_hash = b.record_hash
+            )
+        RETURNING 1
+    )
+    SELECT count(*)::integer FROM deleted;
+$$;
+
+
+ALTER FUNCTION api.delete_orphaned_knack_record_bodies(interval) OWNER TO postgres;
+
+GRANT EXECUTE ON FUNCTION api.delete_orphaned_knack_record_bodies(interval) TO my_api_user;
+
+COMMIT;
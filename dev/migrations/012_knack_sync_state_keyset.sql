@@ -0,0 +1,48 @@
+-- Page api.select_unsynced_knack_records by id.
+--
+-- The function is paged by an `after_id` and `max_rows` rather than by an offset,
+-- which re-ran the function, hashing every record of the container, for each page.
+-- An index on (app_id, container_id, id) lets each page scan the container's records
+-- in id order from `after_id`.
+--
+-- $ psql -v ON_ERROR_STOP=1 -f dev/migrations/012_knack_sync_state_keyset.sql
+
+BEGIN;
+
+CREATE INDEX IF NOT EXISTS knack_app_id_container_id_id_idx
+    ON api.knack USING btree (app_id, container_id, id);
+
+DROP FUNCTION IF EXISTS api.select_unsynced_knack_records(text, text, text);
+
+--
+-- Name: select_unsynced_knack_records(text, text, text, bigint, integer); Type: FUNCTION; Schema: api; Owner: postgres
+--
+
+CREATE OR REPLACE FUNCTION api.select_unsynced_knack_records(app_id text, container_id text, destination text, after_id bigint DEFAULT 0, max_rows integer DEFAULT 1000) RETURNS SETOF api.knack_records
+    LANGUAGE sql STABLE SECURITY DEFINER
+    SET search_path = api, pg_temp
+    AS $$
+    -- paged by id rather than by offset, so that each page only hashes the records
+    -- from after_id until max_rows unsynced records are found
+    SELECT r.* FROM api.knack_records r
+    WHERE r.app_id = select_unsynced_knack_records.app_id
+        AND r.container_id = select_unsynced_knack_records.container_id
+        AND r.id > select_unsynced_knack_records.after_id
+        AND NOT EXISTS (
+            SELECT 1 FROM api.knack_sync_state s
+            WHERE s.app_id = r.app_id
+                AND s.container_id = r.container_id
+                AND s.destination = select_unsynced_knack_records.destination
+                AND s.record_id = r.record_id
+                AND s.sync_hash = r.sync_hash
+        )
+    ORDER BY r.id
+    LIMIT select_unsynced_knack_records.max_rows;
+$$;
+
+
+ALTER FUNCTION api.select_unsynced_knack_records(text, text, text, bigint, integer) OWNER TO postgres;
+
+GRANT EXECUTE ON FUNCTION api.select_unsynced_knack_records(text, text, text, bigint, integer) TO my_api_user;
+
+COMMIT;
@@ -10,8 +10,13 @@ This script:
 - Extracts each records street segment IDs, and fetches the segment geometries from the
 canonical COA AGOL layer
 - Updates each record in AGOL with the complete geometry from all of its segments
+
+Multiple layers can be processed in one run (`-l <name> <name>` or `--all-layers`),
+sharing a single login and a single download of street segments.
 """
 import argparse
+import itertools
+from multiprocessing.dummy import Pool
 import os
 import re
 
@@ -30,6 +35,10 @@ APP_ID = os.getenv("KNACK_APP_ID")
 PGREST_JWT = os.getenv("PGREST_JWT")
 PGREST_ENDPOINT = os.getenv("PGREST_ENDPOINT")
 CHUNK_SIZE = 500
+# the number of segment IDs per street segment query, and the number of queries to
+# run concurrently
+SEGMENT_QUERY_CHUNK_SIZE = 1000
+SEGMENT_QUERY_THREADS = 4
 CONFIG = {
     "layers": {
         "markings_jobs": {
@@ -71,7 +80,21 @@ def parse_segment_strings(segments_string):
     return [int(segment_id) for segment_id in matches]
 
 
-def get_segment_features(segment_ids, gis):
+def get_segment_features(segment_ids, gis, max_allowable_offset=None):
+    """Fetch the street segment features for the given segment IDs. IDs are queried
+    in batches, concurrently, so that large requests stay below the service's URL
+    size and max record count limits.
+
+    Args:
+        segment_ids (list): street segment IDs (ints)
+        gis (arcgis.GIS): an authenticated GIS
+        max_allowable_offset (float, optional): if provided, segment geometries are
+            generalized to this tolerance, in the units of the segment layer's
+            spatial reference (feet)
+
+    Returns:
+        list: arcgis Feature's, de-duplicated by segment ID
+    """
     # COA transportation_street_segment service
     # https://austin.maps.arcgis.com/home/item.html?id=a78db5b7a72640bcbb181dcb88817652
     service_id = "a78db5b7a72640bcbb181dcb88817652"
@@ -79,27 +102,49 @@ def get_segment_features(segment_ids, gis):
     segment_id_field = "SEGMENT_ID"
     service = gis.content.get(service_id)
     layer = service.layers[layer_id]
-    where_part = ",".join([str(seg_id) for seg_id in segment_ids])
-    # have tested this with 4k+ segnment IDs, and it is performant. segnment IDs being
-    # integer types is probably clutch
-    where = f"{segment_id_field} in ({where_part})"
+
+    def query_segments(ids_chunk):
+        where_part = ",".join([str(seg_id) for seg_id in ids_chunk])
+        # segment IDs being integer types keeps these queries performant
+        where = f"{segment_id_field} in ({where_part})"
+        feature_set = layer.query(
+            where=where,
+            out_fields=[segment_id_field],
+            max_allowable_offset=max_allowable_offset,
+        )
+        return feature_set.features or []
+
     logger.info(f"Getting {len(segment_ids)} street segments...")
-    feature_set = layer.query(where=where, out_fields=["SEGMENT_ID"])
-    return feature_set.features or []
+    ids_chunks = list(chunks(sorted(segment_ids), SEGMENT_QUERY_CHUNK_SIZE))
+    with Pool(processes=SEGMENT_QUERY_THREADS) as pool:
+        results = pool.map(query_segments, ids_chunks)
 
+    segment_features = {}
+    for feature in itertools.chain.from_iterable(results):
+        segment_features.setdefault(feature.attributes.get(segment_id_field), feature)
+    return list(segment_features.values())
 
-def build_geometry(segment_ids, segment_features, match_field="SEGMENT_ID"):
-    """Finds and merges all segment geometry paths for the given list of segment IDs
+
+def index_segment_paths(segment_features, segment_paths, match_field="SEGMENT_ID"):
+    """Adds the geometry paths of each segment feature to the `segment_paths` dict,
+    keyed by segment ID"""
+    for feature in segment_features:
+        if not feature.geometry:
+            continue
+        segment_paths.setdefault(
+            feature.attributes.get(match_field), feature.geometry["paths"]
+        )
+    return segment_paths
+
+
+def build_geometry(segment_ids, segment_paths):
+    """Merges all segment geometry paths for the given list of segment IDs
 
     Of interest: https://developers.arcgis.com/documentation/common-data-types/geometry-objects.htm  # noqa: E501
     """
     paths = []
     for segment_id in segment_ids:
-        for feature in segment_features:
-            segment_id_current = feature.attributes.get(match_field)
-            if segment_id_current == int(segment_id):
-                paths += feature.geometry["paths"]
-                break
+        paths += segment_paths.get(int(segment_id), [])
     if not paths:
         return None
     return {"paths": paths, "spatialReference": {"wkid": 102739, "latestWkid": 2277}}
@@ -119,8 +164,15 @@ def cli_args():
             "name": "--layer-name",
             "flag": "-l",
             "type": str,
-            "required": True,
-            "help": "The name of layer to process.",
+            "nargs": "+",
+            "required": False,
+            "help": "The name(s) of the layer(s) to process.",
+        },
+        {
+            "name": "--all-layers",
+            "flag": "-A",
+            "action": "store_true",
+            "help": "Process every layer in the CONFIG.",
         },
         {
             "name": "--date",
@@ -129,6 +181,19 @@ def cli_args():
             "required": False,
             "help": "An ISO 8601-compliant date string which will be used to query records",
         },
+        {
+            "name": "--generalize",
+            "flag": "-g",
+            "type": float,
+            "required": False,
+            "help": "Generalize street segment geometries to this tolerance, in feet",
+        },
+        {
+            "name": "--segment-store",
+            "flag": "-s",
+            "action": "store_true",
+            "help": "Read segment geometries from the local street segment store, which is refreshed incrementally",
+        },
     ]
     parser = argparse.ArgumentParser()
     for arg in args:
@@ -136,18 +201,25 @@ def cli_args():
     return parser.parse_args()
 
 
-def main():
-    args = cli_args()
-    layer_name = args.layer_name
-    logger.info(args)
+def get_layer_features(layer_name, date, gis):
+    """Fetch the features of a layer which were modified on or after the given date,
+    and parse each feature's segment IDs string into a list of segment IDs.
+
+    Args:
+        layer_name (str): the layer name in CONFIG
+        date (str): the modified date filter from the CLI args
+        gis (arcgis.GIS): an authenticated GIS
+
+    Returns:
+        tuple: the arcgis FeatureLayer and a list of its Features
+    """
     service_id = CONFIG["layers"][layer_name]["service_id"]
     layer_id = CONFIG["layers"][layer_name]["id"]
     segment_id_field = CONFIG["layers"][layer_name]["segment_id_field"]
     modified_date_field = CONFIG["layers"][layer_name]["modified_date_field"]
-    gis = arcgis.GIS(url=URL, username=USERNAME, password=PASSWORD)
     service = gis.content.get(service_id)
     layer = service.layers[layer_id]
-    date_filter = format_filter_date(args.date)
+    date_filter = format_filter_date(date)
 
     logger.info(f"Getting {layer_name} features modified since {date_filter}")
 
@@ -157,32 +229,53 @@ def main():
         where=where, out_fields=["OBJECTID", modified_date_field, segment_id_field]
     )
 
-    logger.info(f"{len(features)} features to process")
-
-    if not features:
-        return
-
-    all_segment_ids = []
+    logger.info(f"{len(features)} {layer_name} features to process")
 
     for feature in features:
         # replace stringy segment ids with lists of segment IDs
         segments_string = feature.attributes.get(segment_id_field)
-        segments_as_ints = parse_segment_strings(segments_string)
-        feature.attributes[segment_id_field] = segments_as_ints
-        # collect all segment ids while we're at it
-        all_segment_ids += segments_as_ints
+        feature.attributes[segment_id_field] = parse_segment_strings(segments_string)
+
+    return layer, features
 
-    all_segment_ids = list(set(all_segment_ids))
 
-    # fetch all segment features for segment IDs we've collected
-    segment_features = get_segment_features(all_segment_ids, gis)
+def fetch_segment_paths(
+    segment_ids, gis, segment_paths, max_allowable_offset=None, segment_store=None
+):
+    """Add the geometry paths of any segment IDs which are missing from
+    `segment_paths`, so that segments are only downloaded once per run.
 
+    Args:
+        segment_ids (list): the segment IDs that are needed
+        gis (arcgis.GIS): an authenticated GIS
+        segment_paths (dict): segment geometry paths by segment ID
+        max_allowable_offset (float, optional): the tolerance to which segment
+            geometries are generalized
+        segment_store (utils.segments.SegmentStore, optional): a local segment store
+            from which to read segment geometries, instead of querying AGOL
+    """
+    missing_segment_ids = list(set(segment_ids) - set(segment_paths))
+    if not missing_segment_ids:
+        return segment_paths
+    if segment_store:
+        segment_paths.update(segment_store.get_paths(missing_segment_ids))
+    else:
+        segment_features = get_segment_features(
+            missing_segment_ids, gis, max_allowable_offset=max_allowable_offset
+        )
+        index_segment_paths(segment_features, segment_paths)
+    return segment_paths
+
+
+def update_geometries(layer_name, layer, features, segment_paths):
+    """Join segment geometries to a layer's features and upload them"""
+    segment_id_field = CONFIG["layers"][layer_name]["segment_id_field"]
     todos = []
 
     for feature in features:
         # join segment feature geometries to our features
         segment_ids = feature.attributes.get(segment_id_field)
-        feature_geom = build_geometry(segment_ids, segment_features)
+        feature_geom = build_geometry(segment_ids, segment_paths)
         if not feature_geom:
             """
             It is possible that we won't find a matching street segment feature given
@@ -194,14 +287,77 @@ def main():
         object_id = feature.attributes["OBJECTID"]
         todos.append({"attributes": {"OBJECTID": object_id}, "geometry": feature_geom})
 
-    logger.info(f"Updating geometries for {len(todos)} features...")
+    logger.info(f"Updating geometries for {len(todos)} {layer_name} features...")
 
     for features_chunk in chunks(todos, CHUNK_SIZE):
-        logger.info(f"Uploading {len(features_chunk)} records...")
+        logger.info(f"Uploading {len(features_chunk)} {layer_name} records...")
         res = layer.edit_features(updates=features_chunk, rollback_on_failure=False)
         utils.agol.handle_response(res)
 
 
+def process_layers(
+    layer_names, date, gis, max_allowable_offset=None, segment_store=None
+):
+    """Build and update the segment geometries of each layer's features. Segment IDs
+    are gathered across all layers so that segments are fetched once, then each
+    layer's updates are pushed concurrently."""
+    layers = {
+        layer_name: get_layer_features(layer_name, date, gis)
+        for layer_name in layer_names
+    }
+
+    all_segment_ids = set()
+    for layer_name, (layer, features) in layers.items():
+        segment_id_field = CONFIG["layers"][layer_name]["segment_id_field"]
+        for feature in features:
+            all_segment_ids.update(feature.attributes.get(segment_id_field))
+
+    if not all_segment_ids:
+        return
+
+    segment_paths = fetch_segment_paths(
+        all_segment_ids,
+        gis,
+        {},
+        max_allowable_offset=max_allowable_offset,
+        segment_store=segment_store,
+    )
+
+    def update_layer(layer_name):
+        layer, features = layers[layer_name]
+        if features:
+            update_geometries(layer_name, layer, features, segment_paths)
+
+    with Pool(processes=len(layer_names)) as pool:
+        pool.map(update_layer, layer_names)
+
+
+def main():
+    args = cli_args()
+    logger.info(args)
+
+    layer_names = (
+        list(CONFIG["layers"].keys()) if args.all_layers else args.layer_name
+    )
+    if not layer_names:
+        raise ValueError("Provide one or more --layer-name arguments or --all-layers")
+
+    # one login is shared by every layer
+    gis = arcgis.GIS(url=URL, username=USERNAME, password=PASSWORD)
+    segment_store = None
+    if args.segment_store:
+        segment_store = utils.segments.SegmentStore(token=gis._con.token)
+        refreshed = segment_store.refresh()
+        logger.info(f"Refreshed {refreshed} segments in the local segment store")
+    process_layers(
+        layer_names,
+        args.date,
+        gis,
+        max_allowable_offset=args.generalize,
+        segment_store=segment_store,
+    )
+
+
 if __name__ == "__main__":
     logger = utils.logging.getLogger(__file__)
     main()
@@ -1,13 +1,15 @@
 #!/usr/bin/env python
 import argparse
-import csv
 import datetime
-from io import StringIO
+import gzip
 import json
+from multiprocessing.dummy import Pool
 import os
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
+import arrow
 import boto3
 
 from config.knack import CONFIG
@@ -19,81 +21,451 @@ AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 SOCRATA_APP_TOKEN = os.getenv("SOCRATA_APP_TOKEN")
 SOCRATA_API_KEY_ID = os.getenv("SOCRATA_API_KEY_ID")
 SOCRATA_API_KEY_SECRET = os.getenv("SOCRATA_API_KEY_SECRET")
+# the number of rows per Socrata request
+PAGE_SIZE = 100000
+# the number of bytes read from a response at a time
+CHUNK_SIZE = 1024 * 1024
+# the number of backups kept per dataset
+RETENTION_COUNT = 30
+# the max number of keys per s3 delete_objects request
+DELETE_CHUNK_SIZE = 1000
+# delta mode files are stored in this folder within the dataset's folder
+DELTA_FOLDER = "delta"
+FULL_SUFFIX = "full.csv.gz"
+DELTA_SUFFIX = "delta.csv.gz"
+IDS_SUFFIX = "ids.csv.gz"
+# in delta mode, the max number of days between full snapshots
+FULL_SNAPSHOT_DAYS = 7
+DELTA_OVERLAP = datetime.timedelta(hours=1)
 
 
-def export_dataset(resource_id):
-    basic = HTTPBasicAuth(username=SOCRATA_API_KEY_ID, password=SOCRATA_API_KEY_SECRET)
-    keep_going = True
+def csv_pages(resource_id, session, params=None):
+    """Yield the raw bytes of a dataset's CSV export, page by page, ordered by the
+    Socrata row `:id` so that paging is stable. Only the first page's header line is
+    included. Each page is streamed from the response in chunks, so it is never held
+    in memory in full.
+
+    Args:
+        resource_id (str): the Socrata resource ID
+        session (requests.Session): an authenticated session
+        params (dict, optional): additional SoQL params, e.g. `$select` or `$where`
+    """
     offset = 0
-    data = []
-    while keep_going:
-        url = f"https://datahub.austintexas.gov/resource/{resource_id}.json?$limit=100000&$offset={offset}&$$app_token={SOCRATA_APP_TOKEN}"
-        res = requests.get(url, auth=basic, timeout=30)
+    while True:
+        page_params = {
+            **(params or {}),
+            "$limit": PAGE_SIZE,
+            "$offset": offset,
+            "$order": ":id",
+            "$$app_token": SOCRATA_APP_TOKEN,
+        }
+        url = f"https://datahub.austintexas.gov/resource/{resource_id}.csv"
+        res = session.get(url, params=page_params, stream=True, timeout=30)
         if res.status_code != 200:
             raise Exception(res.text)
-        offset += 100000
-        if not json.loads(res.text):
-            keep_going = False
-        else:
-            data = data + json.loads(res.text)
-
-    # Get column headers
-    url = f"https://datahub.austintexas.gov/resource/{resource_id}.csv?$limit=0&$$app_token={SOCRATA_APP_TOKEN}"
-    res = requests.get(url, auth=basic, timeout=30)
-    csv_file = StringIO(res.text)
-    csv_reader = csv.reader(csv_file)
-    for row in csv_reader:
-        headers = row
-
-    # Output to csv
-    csv_data = StringIO()
-    csv_writer = csv.DictWriter(csv_data, fieldnames=headers)
-    csv_writer.writeheader()
-    csv_writer.writerows(data)
-    return csv_data.getvalue()
 
-def main(args):
-    aws_s3_client = boto3.client(
-        "s3",
-        aws_access_key_id=AWS_ACCESS_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        # the header line is buffered until it is complete, then skipped for every
+        # page after the first
+        header = bytearray()
+        has_rows = False
+        for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+            if header is not None:
+                header += chunk
+                if b"\n" not in header:
+                    continue
+                end = header.index(b"\n") + 1
+                if offset == 0:
+                    yield bytes(header[:end])
+                chunk = bytes(header[end:])
+                header = None
+            if chunk:
+                has_rows = True
+                yield chunk
+
+        if header and offset == 0:
+            # an empty dataset whose header has no trailing newline
+            yield bytes(header) + b"\n"
+        if not has_rows:
+            return
+        offset += PAGE_SIZE
+
+
+def export_dataset(resource_id, fileobj, session=None, params=None):
+    """Stream a dataset's CSV export through a gzip compressor to a writable file
+    object. `params` are passed to `csv_pages`.
+
+    Returns:
+        int: the number of uncompressed bytes written
+    """
+    if not session:
+        session = get_session()
+    size = 0
+    with gzip.GzipFile(fileobj=fileobj, mode="wb") as gz:
+        for chunk in csv_pages(resource_id, session, params=params):
+            gz.write(chunk)
+            size += len(chunk)
+    return size
+
+
+def get_columns(resource_id, session):
+    """Fetch a dataset's column metadata from the Socrata views API"""
+    url = f"https://datahub.austintexas.gov/api/views/{resource_id}.json"
+    res = session.get(url, params={"$$app_token": SOCRATA_APP_TOKEN}, timeout=30)
+    if res.status_code != 200:
+        raise Exception(res.text)
+    return [
+        col
+        for col in res.json()["columns"]
+        # computed region and other hidden columns are not returned by the API
+        if not col["fieldName"].startswith(":@")
+    ]
+
+
+def parquet_schema(columns):
+    """Build an Arrow schema from Socrata column metadata. Types which Arrow has no
+    equivalent for, such as locations, are stored as JSON strings."""
+    import pyarrow as pa
+
+    types = {
+        "number": pa.float64(),
+        "double": pa.float64(),
+        "money": pa.float64(),
+        "percent": pa.float64(),
+        "checkbox": pa.bool_(),
+        "calendar_date": pa.timestamp("ms"),
+        "date": pa.timestamp("ms"),
+    }
+    return pa.schema(
+        [
+            pa.field(col["fieldName"], types.get(col["dataTypeName"], pa.string()))
+            for col in columns
+        ]
     )
 
+
+def parquet_value(value, type_):
+    import pyarrow as pa
+
+    if value is None:
+        return None
+    if pa.types.is_floating(type_):
+        return float(value)
+    if pa.types.is_boolean(type_):
+        return value if isinstance(value, bool) else value == "true"
+    if pa.types.is_timestamp(type_):
+        # fixed timestamps have a "Z" suffix, which fromisoformat cannot parse before
+        # python 3.11
+        return arrow.get(value).datetime
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def json_pages(resource_id, session):
+    """Yield pages of a dataset's rows as lists of dicts, ordered by :id"""
+    offset = 0
+    while True:
+        params = {
+            "$limit": PAGE_SIZE,
+            "$offset": offset,
+            "$order": ":id",
+            "$$app_token": SOCRATA_APP_TOKEN,
+        }
+        url = f"https://datahub.austintexas.gov/resource/{resource_id}.json"
+        res = session.get(url, params=params, timeout=30)
+        if res.status_code != 200:
+            raise Exception(res.text)
+        rows = res.json()
+        if not rows:
+            return
+        yield rows
+        offset += PAGE_SIZE
+
+
+def export_dataset_parquet(resource_id, fileobj, session=None):
+    """Write a dataset to a Parquet file object, one row group per page of rows, so
+    that only one page is held in memory at a time. Text columns are dictionary
+    encoded and the file is compressed with zstd.
+
+    Returns:
+        int: the number of rows written
+    """
+    # pyarrow is only needed for parquet backups, so it is imported here
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if not session:
+        session = get_session()
+    columns = get_columns(resource_id, session)
+    schema = parquet_schema(columns)
+    text_columns = [
+        field.name for field in schema if pa.types.is_string(field.type)
+    ]
+    num_rows = 0
+    with pq.ParquetWriter(
+        fileobj, schema, compression="zstd", use_dictionary=text_columns
+    ) as writer:
+        for rows in json_pages(resource_id, session):
+            arrays = [
+                pa.array(
+                    [parquet_value(row.get(field.name), field.type) for row in rows],
+                    type=field.type,
+                )
+                for field in schema
+            ]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            num_rows += len(rows)
+    return num_rows
+
+
+def get_session(pool_size=10):
+    """Return a requests session, authenticated with Socrata, which can be shared by
+    concurrent backups"""
+    session = requests.Session()
+    session.auth = HTTPBasicAuth(
+        username=SOCRATA_API_KEY_ID, password=SOCRATA_API_KEY_SECRET
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+def config_resource_ids():
+    """Return the unique socrata_resource_ids of every container in config/knack.py"""
+    resource_ids = []
+    for containers in CONFIG.values():
+        for container in containers.values():
+            resource_id = container.get("socrata_resource_id")
+            if resource_id and resource_id not in resource_ids:
+                resource_ids.append(resource_id)
+    return resource_ids
+
+
+def list_objects(client, prefix):
+    """Return every object directly under an s3 prefix, paging through
+    list_objects_v2. Objects in nested folders are excluded."""
+    objects = []
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=BUCKET, Prefix=prefix, Delimiter="/"):
+        objects += page.get("Contents", [])
+    return objects
+
+
+def delete_keys(client, keys):
+    # delete_objects accepts at most 1000 keys per request
+    for i in range(0, len(keys), DELETE_CHUNK_SIZE):
+        chunk = keys[i : i + DELETE_CHUNK_SIZE]
+        res = client.delete_objects(
+            Bucket=BUCKET,
+            Delete={"Objects": [{"Key": key} for key in chunk], "Quiet": True},
+        )
+        if res.get("Errors"):
+            raise Exception(f"Failed to delete backup files: {res['Errors']}")
+
+
+def enforce_retention(client, prefix, keep=RETENTION_COUNT):
+    """Delete all but the `keep` most recently modified objects under an s3 prefix.
+
+    Returns:
+        list: the deleted keys
+    """
+    objects = list_objects(client, prefix)
+    objects.sort(key=lambda obj: obj["LastModified"], reverse=True)
+    expired = [obj["Key"] for obj in objects[keep:]]
+    delete_keys(client, expired)
+    return expired
+
+
+def enforce_delta_retention(client, prefix, days=RETENTION_COUNT):
+    """Delete delta backup files which are not needed to restore any of the last
+    `days` days: everything older than the newest full snapshot taken before the
+    retention window.
+
+    Returns:
+        list: the deleted keys
+    """
+    objects = list_objects(client, prefix)
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+        days=days
+    )
+    base_snapshots = [
+        obj
+        for obj in objects
+        if obj["Key"].endswith(f"_{FULL_SUFFIX}") and obj["LastModified"] <= cutoff
+    ]
+    if not base_snapshots:
+        return []
+    base = max(obj["LastModified"] for obj in base_snapshots)
+    expired = [obj["Key"] for obj in objects if obj["LastModified"] < base]
+    delete_keys(client, expired)
+    return expired
+
+
+def backup_dataset(resource_id, session, client, output_format="csv"):
+    """Back up one dataset to a gzipped CSV or a Parquet file in s3 and enforce the
+    retention limit on its folder"""
+    # File name and get s3 folder
+    subdir = resource_id.replace("-", "_")  # folder name is resource ID
+    timestamp = datetime.datetime.now()
+    file_name = timestamp.strftime("%y_%m_%d")
+
+    if output_format == "parquet":
+        file_name = f"{subdir}/{file_name}.parquet"
+        with utils.s3.S3MultipartWriter(client, BUCKET, file_name) as writer:
+            num_rows = export_dataset_parquet(resource_id, writer, session=session)
+        logger.info(
+            f"created backup file: {file_name} ({num_rows} rows, {writer.bytes_written} bytes)"
+        )
+    else:
+        file_name = f"{subdir}/{file_name}.csv.gz"
+        # Stream data from Socrata to a gzipped CSV in s3
+        export_to_s3(resource_id, session, client, file_name)
+
+    # Keeping only the last 30 days of data
+    for key in enforce_retention(client, f"{subdir}/"):
+        logger.info(f"deleted backup file: {key}")
+    return file_name
+
+
+def get_watermark(client, objects):
+    """Return the watermark (a UTC datetime) stored with the most recent full or delta
+    backup file, or None"""
+    data_files = [
+        obj
+        for obj in objects
+        if obj["Key"].endswith((f"_{FULL_SUFFIX}", f"_{DELTA_SUFFIX}"))
+    ]
+    if not data_files:
+        return None
+    latest = max(data_files, key=lambda obj: obj["LastModified"])
+    metadata = client.head_object(Bucket=BUCKET, Key=latest["Key"])["Metadata"]
+    watermark = metadata.get("watermark")
+    return arrow.get(watermark).datetime if watermark else None
+
+
+def export_to_s3(resource_id, session, client, key, params=None, metadata=None):
+    """Stream a dataset's CSV export to a gzipped file in s3"""
+    with utils.s3.S3MultipartWriter(client, BUCKET, key, metadata=metadata) as writer:
+        size = export_dataset(resource_id, writer, session=session, params=params)
+    logger.info(
+        f"created backup file: {key} ({size} bytes, {writer.bytes_written} compressed)"
+    )
+
+
+def backup_dataset_delta(resource_id, session, client, full=False):
+    """Back up one dataset incrementally.
+
+    A full snapshot (including Socrata system fields) is written if `full` is True or
+    if none has been written for FULL_SNAPSHOT_DAYS. Otherwise, a delta of the rows
+    updated since the previous backup is written, along with a list of every current
+    row `:id` so that deleted rows can be dropped on restore. Each full or delta file
+    stores the time the backup started as its `watermark` metadata.
+    """
+    subdir = resource_id.replace("-", "_")  # folder name is resource ID
+    prefix = f"{subdir}/{DELTA_FOLDER}/"
+    objects = list_objects(client, prefix)
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    # delta mode can run more than once a day, so file names include the time
+    stamp = datetime.datetime.now().strftime("%y_%m_%d_%H%M%S")
+    metadata = {"watermark": started_at.isoformat()}
+
+    snapshot_dates = [
+        obj["LastModified"]
+        for obj in objects
+        if obj["Key"].endswith(f"_{FULL_SUFFIX}")
+    ]
+    watermark = get_watermark(client, objects)
+    if (
+        full
+        or not watermark
+        or not snapshot_dates
+        or started_at - max(snapshot_dates)
+        > datetime.timedelta(days=FULL_SNAPSHOT_DAYS)
+    ):
+        export_to_s3(
+            resource_id,
+            session,
+            client,
+            f"{prefix}{stamp}_{FULL_SUFFIX}",
+            {"$select": ":*, *"},
+            metadata=metadata,
+        )
+    else:
+        # socrata's clock and ours may disagree, so each delta overlaps the previous
+        # one slightly. rows in the overlap are de-duplicated on restore.
+        since = (watermark - DELTA_OVERLAP).strftime("%Y-%m-%dT%H:%M:%S")
+        export_to_s3(
+            resource_id,
+            session,
+            client,
+            f"{prefix}{stamp}_{DELTA_SUFFIX}",
+            {"$select": ":*, *", "$where": f":updated_at >= '{since}'"},
+            metadata=metadata,
+        )
+        export_to_s3(
+            resource_id,
+            session,
+            client,
+            f"{prefix}{stamp}_{IDS_SUFFIX}",
+            {"$select": ":id"},
+        )
+
+    for key in enforce_delta_retention(client, prefix):
+        logger.info(f"deleted backup file: {key}")
+
+
+def main(args):
     # Parse Arguments
     if args.app_name and args.container:
         app_name = args.app_name
         container = args.container
-        resource_id = CONFIG[app_name][container]["socrata_resource_id"]
+        resource_ids = [CONFIG[app_name][container]["socrata_resource_id"]]
     elif args.dataset:
-        resource_id = args.dataset
+        resource_ids = args.dataset
+    elif args.all:
+        resource_ids = config_resource_ids()
     else:
         raise Exception("No Socrata resource argument supplied.")
-    logger.info(resource_id)
+    logger.info(resource_ids)
 
-    # File name and get s3 folder
-    subdir = resource_id.replace("-", "_")  # folder name is resource ID
-    timestamp = datetime.datetime.now()
-    file_name = timestamp.strftime("%y_%m_%d")
-    file_name = f"{subdir}/{file_name}.csv"
+    if args.delta and args.format != "csv":
+        raise ValueError("Delta backups are only written as CSV")
 
-    # Get data from Socrata
-    body = export_dataset(resource_id)
+    # the session and the s3 client are shared by all backups. boto3 clients are
+    # thread-safe
+    session = get_session(pool_size=args.workers)
+    aws_s3_client = boto3.client(
+        "s3",
+        aws_access_key_id=AWS_ACCESS_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    )
 
-    # Upload CSV to s3
-    aws_s3_client.put_object(Body=body, Bucket=BUCKET, Key=file_name)
-    logger.info(f"created backup file: {file_name}")
+    def backup(resource_id):
+        try:
+            if args.delta:
+                backup_dataset_delta(
+                    resource_id, session, aws_s3_client, full=args.full
+                )
+            else:
+                backup_dataset(
+                    resource_id, session, aws_s3_client, output_format=args.format
+                )
+        except Exception as e:
+            # one failed dataset should not prevent the others from being backed up
+            logger.error(f"Failed to back up {resource_id}: {e}")
+            return resource_id
 
-    # Keeping only the last 30 days of data
-    s3_file_list = aws_s3_client.list_objects_v2(Bucket=BUCKET, Prefix=subdir)[
-        "Contents"
-    ]
-    if len(s3_file_list) > 30:
-        get_last_modified = lambda obj: int(obj["LastModified"].strftime("%s"))
-        oldest_file = [
-            obj["Key"] for obj in sorted(s3_file_list, key=get_last_modified)
-        ][0]
-        aws_s3_client.delete_object(Bucket=BUCKET, Key=oldest_file)
-        logger.info(f"deleted backup file: {oldest_file}")
+    with Pool(processes=min(args.workers, len(resource_ids))) as pool:
+        failed = [
+            resource_id
+            for resource_id in pool.map(backup, resource_ids)
+            if resource_id
+        ]
+
+    if failed:
+        raise Exception(f"Failed to back up datasets: {', '.join(failed)}")
 
 
 if __name__ == "__main__":
@@ -118,7 +490,42 @@ if __name__ == "__main__":
         "-f",
         "--dataset",
         type=str,
-        help="str: Alternatively to app name/container, the Socrata resource ID (AKA 4x4).",
+        nargs="+",
+        help="str: Alternatively to app name/container, one or more Socrata resource IDs (AKA 4x4).",
+    )
+
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Back up every socrata_resource_id in the knack.py config file",
+    )
+
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=["csv", "parquet"],
+        default="csv",
+        help="str: The backup file format. Defaults to csv (gzipped).",
+    )
+
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Write weekly full snapshots and daily deltas instead of daily full copies",
+    )
+
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="In delta mode, write a full snapshot even if a recent one exists",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=4,
+        help="int: The number of datasets to back up concurrently. Defaults to 4.",
     )
 
     args = parser.parse_args()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""Generate SQL which creates a flattened, typed materialized view of each configured
+Knack container in Postgres.
+
+Each view has one column per field of the container, derived from the app metadata in
+`api.knack_metadata`. Views are registered in `api.knack_flat_views` and refreshed by
+`records_to_postgrest.py` after each load.
+"""
+import argparse
+import os
+
+import knackpy
+
+from config.knack import CONFIG
+import utils
+
+APP_ID = os.getenv("KNACK_APP_ID")
+PGREST_JWT = os.getenv("PGREST_JWT")
+PGREST_ENDPOINT = os.getenv("PGREST_ENDPOINT")
+# postgres truncates identifiers longer than this
+MAX_IDENTIFIER_LENGTH = 63
+
+NUMERIC_TYPES = [
+    "auto_increment",
+    "average",
+    "count",
+    "currency",
+    "max",
+    "min",
+    "number",
+    "rating",
+    "sum",
+]
+# field types whose raw value is a dict, and the property which holds its value
+DICT_VALUE_TYPES = {
+    "email": "email",
+    "link": "url",
+    "phone": "full",
+    "image": "url",
+    "file": "url",
+}
+ADDRESS_PARTS = ["street", "street2", "city", "state", "zip"]
+
+
+def quote_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def quote_ident(value):
+    return '"' + value.replace('"', '""') + '"'
+
+
+def typed(raw, json_type, expression):
+    """Return `expression` if the raw JSON value is of `json_type`, otherwise null"""
+    return f"CASE WHEN jsonb_typeof({raw}) = '{json_type}' THEN {expression} END"
+
+
+def text_array(value):
+    """An expression which converts a JSON array or scalar to a text[]"""
+    return (
+        f"CASE jsonb_typeof({value}) "
+        f"WHEN 'array' THEN ARRAY(SELECT jsonb_array_elements_text({value})) "
+        f"WHEN 'string' THEN ARRAY[{value} #>> '{{}}'] END"
+    )
+
+
+def field_columns(field_def):
+    """Return a list of (column name suffix, SQL expression) tuples for a Knack field.
+    Most fields produce a single column, with an empty suffix."""
+    key = quote_literal(field_def.key)
+    raw = f"record -> {quote_literal(f'{field_def.key}_raw')}"
+    formatted = f"record ->> {key}"
+
+    if field_def.type in NUMERIC_TYPES:
+        return [("", typed(raw, "number", f"({raw})::numeric"))]
+    elif field_def.type == "boolean":
+        return [("", typed(raw, "boolean", f"({raw})::boolean"))]
+    elif field_def.type == "date_time":
+        return [
+            (
+                "",
+                typed(
+                    raw,
+                    "object",
+                    f"to_timestamp(({raw} ->> 'unix_timestamp')::numeric / 1000)",
+                ),
+            )
+        ]
+    elif field_def.type == "multiple_choice":
+        return [("", text_array(raw))]
+    elif field_def.type == "connection":
+        return [
+            (
+                "",
+                f"ARRAY(SELECT conn ->> 'identifier' FROM jsonb_array_elements("
+                f"CASE jsonb_typeof({raw}) WHEN 'array' THEN {raw} END) AS conn)",
+            ),
+            (
+                "_ids",
+                f"ARRAY(SELECT conn ->> 'id' FROM jsonb_array_elements("
+                f"CASE jsonb_typeof({raw}) WHEN 'array' THEN {raw} END) AS conn)",
+            ),
+        ]
+    elif field_def.type == "address":
+        columns = [
+            (f"_{part}", typed(raw, "object", f"{raw} ->> '{part}'"))
+            for part in ADDRESS_PARTS
+        ]
+        columns += [
+            (
+                f"_{coord}",
+                typed(raw, "object", f"nullif({raw} ->> '{coord}', '')::numeric"),
+            )
+            for coord in ["latitude", "longitude"]
+        ]
+        return columns
+    elif field_def.type in DICT_VALUE_TYPES:
+        prop = quote_literal(DICT_VALUE_TYPES[field_def.type])
+        value = typed(raw, "object", f"{raw} ->> {prop}")
+        # some of these types are sometimes stored as plain strings
+        return [("", f"COALESCE({value}, {formatted})")]
+    return [("", formatted)]
+
+
+def column_name(name, taken):
+    """Return a unique, truncated column name"""
+    name = name[:MAX_IDENTIFIER_LENGTH]
+    i = 1
+    while name in taken:
+        suffix = f"_{i}"
+        name = name[: MAX_IDENTIFIER_LENGTH - len(suffix)] + suffix
+        i += 1
+    taken.add(name)
+    return name
+
+
+def view_name(app_name, container):
+    return utils.shared.format_key(f"knack_flat_{app_name}_{container}")
+
+
+def flat_view_sql(app, app_name, container):
+    name = view_name(app_name, container)
+    taken = {"id", "record_id", "updated_at"}
+    columns = [
+        "k.id",
+        "k.record_id",
+        "k.updated_at",
+    ]
+    for field_def in utils.knack.container_field_defs(app, container):
+        base_name = utils.shared.format_key(field_def.name)
+        for suffix, expression in field_columns(field_def):
+            col = column_name(f"{base_name}{suffix}", taken)
+            columns.append(f"{expression} AS {quote_ident(col)}")
+
+    select_list = ",\n    ".join(columns)
+    return f"""DROP MATERIALIZED VIEW IF EXISTS api.{quote_ident(name)};
+CREATE MATERIALIZED VIEW api.{quote_ident(name)} AS
+SELECT
+    {select_list}
+FROM (
+    SELECT id, record_id, updated_at, record::jsonb AS record
+    FROM api.knack_records
+    WHERE app_id = {quote_literal(app.app_id)}
+        AND container_id = {quote_literal(container)}
+) AS k;
+-- a unique index is required to refresh the view concurrently
+CREATE UNIQUE INDEX ON api.{quote_ident(name)} (record_id);
+GRANT SELECT ON api.{quote_ident(name)} TO my_api_user;
+INSERT INTO api.knack_flat_views (app_id, container_id, view_name)
+    VALUES ({quote_literal(app.app_id)}, {quote_literal(container)}, {quote_literal(name)})
+    ON CONFLICT (app_id, container_id) DO UPDATE SET view_name = excluded.view_name;
+"""
+
+
+def main(args):
+    client_postgrest = utils.postgrest.Postgrest(PGREST_ENDPOINT, token=PGREST_JWT)
+    metadata_knack = utils.postgrest.get_metadata(client_postgrest, APP_ID)
+    app = knackpy.App(app_id=APP_ID, metadata=metadata_knack)
+
+    containers = args.container or list(CONFIG[args.app_name].keys())
+    statements = [
+        flat_view_sql(app, args.app_name, container) for container in containers
+    ]
+    sql = "BEGIN;\n\n" + "\n".join(statements) + "\nCOMMIT;\n"
+
+    if args.output:
+        with open(args.output, "w") as fout:
+            fout.write(sql)
+        logger.info(f"Wrote {len(statements)} view definitions to {args.output}")
+    else:
+        print(sql)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-a",
+        "--app-name",
+        type=str,
+        required=True,
+        help="str: Name of the Knack App in knack.py config file",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--container",
+        type=str,
+        nargs="+",
+        help="str: One or more object or view keys. Defaults to every container configured for the app.",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="str: The path to write the SQL to. Defaults to stdout.",
+    )
+
+    args = parser.parse_args()
+
+    logger = utils.logging.getLogger(__file__)
+
+    main(args)
@@ -2,9 +2,13 @@
 """ Fetch Knack records from Postgres(t) and update the location information """
 
 import argparse
+import collections
 import logging
+from multiprocessing.dummy import Pool
 import os
+import queue
 import requests
+import threading
 
 import arrow
 from config.knack import CONFIG, APP_TIMEZONE
@@ -18,6 +22,11 @@ PGREST_JWT = os.getenv("PGREST_JWT")
 PGREST_ENDPOINT = os.getenv("PGREST_ENDPOINT")
 AGOL_USER = os.getenv("AGOL_USERNAME")
 AGOL_PASS = os.getenv("AGOL_PASSWORD")
+# the number of threads which send record updates to Knack in --workers mode. the
+# Knack API allows roughly 10 requests per second
+KNACK_WRITERS = 3
+# the maximum number of memoized location lookups in --memo-precision mode
+MEMO_MAXSIZE = 50000
 
 
 def format_filter_date(date_from_args):
@@ -72,6 +81,51 @@ def point_in_poly(service_name, layer_id, params):
     return res.json()
 
 
+def query_layer(layer, service_name, point, token, cache=None, batch=None):
+    """
+    Query a single location layer for the features at a point, either from AGOL,
+    from the local reference layer cache, or from the features fetched for a batch
+    of points
+    """
+    # AGOL applies the configured distances in meters. See config/locations.py
+    if cache:
+        local_layer = cache.get_layer(service_name, layer["layer_id"], out_sr=4326)
+    elif batch:
+        local_layer = batch.get_layer(
+            service_name,
+            layer["layer_id"],
+            distance=layer.get("distance"),
+            units="esriSRUnit_Meter",
+        )
+    else:
+        params = get_params(layer, point, token)
+        return point_in_poly(service_name, layer["layer_id"], params)
+    features = local_layer.query(
+        point, distance=layer.get("distance"), units="esriSRUnit_Meter"
+    )
+    return {"features": features}
+
+
+def lookup_layer(layer, point, token, cache=None, batch=None):
+    """
+    Return the features of a location layer at a point. Some layers have a backup
+    secondary layer to check if no features are found.
+    """
+    res = query_layer(layer, layer["service_name"], point, token, cache, batch)
+    if not res.get("features") and "service_name_secondary" in layer:
+        res = query_layer(
+            layer, layer["service_name_secondary"], point, token, cache, batch
+        )
+    return res
+
+
+def get_point(record, loc_field):
+    return [
+        record[f"{loc_field}_raw"]["longitude"],
+        record[f"{loc_field}_raw"]["latitude"],
+    ]
+
+
 def format_stringify_list(input_list):
     """
     Function to format features when merging multiple feature attributes
@@ -227,6 +281,126 @@ def handle_features(changed, layer, record, res):
     return record, changed
 
 
+class LookupMemo(object):
+    """
+    An LRU memo of layer lookup results, keyed by layer and by the point rounded to
+    `precision` decimal places, so that records which share a location (e.g., assets
+    at the same intersection) share one set of layer queries.
+    """
+
+    def __init__(self, precision, maxsize=MEMO_MAXSIZE):
+        self.precision = precision
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, layer, point, lookup_func):
+        """Return the memoized result for a layer and point, or call `lookup_func`
+        and memoize its result. Errors are not memoized."""
+        key = (
+            layer["service_name"],
+            round(float(point[0]), self.precision),
+            round(float(point[1]), self.precision),
+        )
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return self._results[key]
+            self.misses += 1
+        res = lookup_func()
+        with self._lock:
+            self._results[key] = res
+            if len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+        return res
+
+
+def update_locations(
+    record, point, token, cache=None, batch=None, layer_pool=None, memo=None
+):
+    """
+    Query every location layer at a record's point and apply the results to the
+    record. Layers are queried concurrently when a thread pool is provided, and
+    results are re-used for nearby points when a memo is provided.
+
+    Returns
+    -------
+    record: dict
+        Edited knack record
+    changed: bool
+        Flag that tells us that we changed something in this record
+    matched: bool
+        False if any of the layer lookups failed
+    """
+
+    def checked_lookup(layer):
+        res = lookup_layer(layer, point, token, cache, batch)
+        if res.get("error"):
+            raise Exception(str(res))
+        return res
+
+    def lookup(layer):
+        try:
+            if memo:
+                return memo.get(layer, point, lambda: checked_lookup(layer))
+            return checked_lookup(layer)
+        except Exception as e:
+            return e
+
+    if layer_pool:
+        results = layer_pool.map(lookup, LAYER_CONFIG)
+    else:
+        results = [lookup(layer) for layer in LAYER_CONFIG]
+
+    changed = False
+    matched = True
+    for layer, res in zip(LAYER_CONFIG, results):
+        try:
+            if isinstance(res, Exception):
+                raise res
+            if not res["features"]:
+                # Case 1: we have no features found for our record
+                record, changed = handle_no_features(changed, layer, record)
+            else:
+                # Case 2: We did indeed find features for our record
+                record, changed = handle_features(changed, layer, record, res)
+        except Exception as e:
+            logger.info(f"Error handling location ID:{record['id']}")
+            logger.info(e)
+            matched = False
+    return record, changed, matched
+
+
+def update_record(record, obj):
+    try:
+        knackpy.api.record(
+            app_id=APP_ID, api_key=API_KEY, obj=obj, method="update", data=record,
+        )
+    except Exception as e:
+        response = getattr(e, "response", None)
+        logger.info(response.text if response is not None else e)
+
+
+def record_writer(write_queue, obj):
+    """
+    Update the Knack records from a queue, until a `None` is received
+    """
+    while True:
+        record = write_queue.get()
+        if record is None:
+            return
+        update_record(record, obj)
+
+
+def chunks(lst, n):
+    """Yield successive n-sized chunks from lst."""
+    for i in range(0, len(lst), n):
+        yield lst[i : i + n]
+
+
 def local_timestamp():
     """
     Create a "local" timestamp (in milliseconds), ie local time represented as a unix timestamp.
@@ -243,70 +417,101 @@ def main(args):
     logger.info(args)
 
     token = create_login_token()
+    cache = utils.agol.ReferenceLayerCache(token=token) if args.use_cache else None
 
     # Getting location data from Knack
     config = CONFIG[app_name][container]
     modified_date_field = config["modified_date_field"]
     kwargs = {"scene": config["scene"], "view": args.container}
     filters = utils.knack.date_filter_on_or_after(
-        args.date, modified_date_field, tzinfo=APP_TIMEZONE
+        args.date, modified_date_field, tzinfo=APP_TIMEZONE, use_time=True
     )
     data = knackpy.api.get(app_id=APP_ID, api_key=API_KEY, filters=filters, **kwargs)
     logger.info(f"Processing {len(data)} records")
 
+    if not data:
+        return
+
     object = config["object"]
     loc_field = config["location_field_id"]
     update_processed_field = config["update_processed_field"]
     output_keys = get_output_keys()
     unmatched_locations = []
-
-    for record in data:
-        if record[loc_field]:  # ignore records that have a null location record
-            point = [
-                record[f"{loc_field}_raw"]["longitude"],
-                record[f"{loc_field}_raw"]["latitude"],
-            ]
-            changed = False
-            for layer in LAYER_CONFIG:
-                params = get_params(layer, point, token)
-                try:
-                    res = point_in_poly(
-                        layer["service_name"], layer["layer_id"], params
-                    )
-                    if not res["features"] and "service_name_secondary" in layer:
-                        # Some layers have a backup secondary layer to check
-                        res = point_in_poly(
-                            layer["service_name_secondary"], layer["layer_id"], params
-                        )
-                    if res.get("error"):
-                        raise Exception(str(res))
-                    if not res["features"]:
-                        # Case 1: we have no features found for our record
-                        record, changed = handle_no_features(changed, layer, record)
-                    else:
-                        # Case 2: We did indeed find features for our record
-                        record, changed = handle_features(changed, layer, record, res)
-                except Exception as e:
-                    logger.info(f"Error handling location ID:{record['id']}")
-                    logger.info(e)
-                    unmatched_locations.append(record)
-                    continue
+    batch = None
+    batch_queries = 0
+    memo = LookupMemo(args.memo_precision) if args.memo_precision is not None else None
+
+    if args.workers:
+        # records are processed by a pool of workers, and Knack updates are handed
+        # off to writer threads through a bounded queue
+        write_queue = queue.Queue(maxsize=args.workers * 2)
+        writers = [
+            threading.Thread(target=record_writer, args=(write_queue, object))
+            for i in range(KNACK_WRITERS)
+        ]
+        for writer in writers:
+            writer.start()
+        record_pool = Pool(processes=args.workers)
+        # the layer pool is shared by the record workers, so it is sized to query
+        # every layer of every in-flight record at once
+        layer_pool = Pool(processes=args.workers * len(LAYER_CONFIG))
+        write = write_queue.put
+    else:
+        record_pool = layer_pool = None
+
+        def write(record):
+            update_record(record, object)
+
+    def process_record(record):
+        if not record[loc_field]:  # ignore records that have a null location record
+            return
+        point = get_point(record, loc_field)
+        record, changed, matched = update_locations(
+            record, point, token, cache, batch, layer_pool, memo
+        )
+        if not matched:
+            unmatched_locations.append(record)
         if changed:
             # Updating a record in Knack
             record = {key: record[key] for key in output_keys}
             # Two additional fields for every record:
             record[update_processed_field] = True
             record[modified_date_field] = local_timestamp()
-            try:
-                knackpy.api.record(
-                    app_id=APP_ID,
-                    api_key=API_KEY,
-                    obj=object,
-                    method="update",
-                    data=record,
+            write(record)
+
+    try:
+        for records_chunk in chunks(data, args.batch_size or len(data)):
+            if args.batch_size:
+                # query each layer once for all of the located records in this batch
+                batch = utils.agol.PointBatch(
+                    [get_point(r, loc_field) for r in records_chunk if r[loc_field]],
+                    4326,
+                    token=token,
                 )
-            except Exception as e:
-                logger.info(e.response.text)
+            if record_pool:
+                record_pool.map(process_record, records_chunk)
+            else:
+                for record in records_chunk:
+                    process_record(record)
+            if batch:
+                batch_queries += batch.query_count
+    finally:
+        if args.workers:
+            for writer in writers:
+                write_queue.put(None)
+            for writer in writers:
+                writer.join()
+            record_pool.close()
+            layer_pool.close()
+
+    if batch_queries:
+        logger.info(f"Batched layer queries: {batch_queries}")
+
+    if memo:
+        logger.info(f"Location lookup memo hits: {memo.hits}, misses: {memo.misses}")
+
+    if cache and cache.downloaded:
+        logger.info(f"Refreshed cached layers: {cache.downloaded}")
 
     logger.info(unmatched_locations)
 
@@ -337,6 +542,33 @@ if __name__ == "__main__":
         help="An ISO 8601-compliant date string which will be used to query records",
     )
 
+    parser.add_argument(
+        "--use-cache",
+        action="store_true",
+        help="Match locations against a local cache of the AGOL layers, which is only re-downloaded when a layer has been edited",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        required=False,
+        help="Query each AGOL layer once per batch of this many records, instead of once per record",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        required=False,
+        help="Process this many records concurrently, with each record's layers also queried concurrently",
+    )
+
+    parser.add_argument(
+        "--memo-precision",
+        type=int,
+        required=False,
+        help="Re-use layer lookups for records whose coordinates match when rounded to this many decimal places (6 is roughly 10cm)",
+    )
+
     args = parser.parse_args()
 
     logger = utils.logging.getLogger(__file__)
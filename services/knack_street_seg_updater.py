@@ -12,8 +12,13 @@ from config.knack import CONFIG, APP_TIMEZONE
 
 APP_ID = os.getenv("KNACK_APP_ID")
 API_KEY = os.getenv("KNACK_API_KEY")
+PGREST_JWT = os.getenv("PGREST_JWT")
+PGREST_ENDPOINT = os.getenv("PGREST_ENDPOINT")
 AGOL_USER = os.getenv("AGOL_USERNAME")
 AGOL_PASS = os.getenv("AGOL_PASSWORD")
+# the number of segment IDs per query in --bulk mode
+BULK_CHUNK_SIZE = 1000
+MAX_RETRIES = 3
 
 def create_login_token():
     """
@@ -51,6 +56,41 @@ def query_atx_street(segment_id, token):
 
     return res.json()
 
+def fetch_street_segments(segment_ids, token):
+    """
+    Fetch the attributes of many street segments with paged `SEGMENT_ID IN (...)`
+    queries, and index them by segment ID
+    """
+    segments = {}
+    for ids_chunk in chunks(segment_ids, BULK_CHUNK_SIZE):
+        ids_stringified = ",".join(str(segment_id) for segment_id in ids_chunk)
+        params = {"where": f"SEGMENT_ID IN ({ids_stringified})", "returnGeometry": False}
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                features = utils.agol.query_all_features(
+                    "TRANSPORTATION_street_segment", 0, params, token=token
+                )
+                break
+            except Exception as e:
+                # AGOL returns code 200 even for error queries, which we raise
+                if attempts == MAX_RETRIES:
+                    raise e
+                logger.info(f"Retrying segment query on attempt #{attempts}: {e}")
+                time.sleep(attempts)
+        for feature in features:
+            segments[feature["attributes"]["SEGMENT_ID"]] = feature["attributes"]
+    logger.info(f"Fetched {len(segments)} street segments")
+    return segments
+
+
+def chunks(lst, n):
+    """Yield successive n-sized chunks from lst."""
+    for i in range(0, len(lst), n):
+        yield lst[i : i + n]
+
+
 def are_equal(knack_dict, agol_dict):
     # Return True if field values from a knack dict match
     # values in reference ArcGIS Online dict. Only compare keys from the knack dict
@@ -118,6 +158,23 @@ def update_record(config, record, field_mapping):
     except Exception as e:
         raise Exception(e.response.text)
 
+def parse_segment_id(segment_id):
+    """Return a segment ID as an int, or None if it is empty or not numeric"""
+    try:
+        return int(segment_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_metadata():
+    """Fetch app metadata from Postgrest, which is cached locally, if an endpoint is
+    configured. Otherwise None is returned and knackpy fetches it from Knack."""
+    if not PGREST_ENDPOINT:
+        return None
+    client_postgrest = utils.postgrest.Postgrest(PGREST_ENDPOINT, token=PGREST_JWT)
+    return utils.postgrest.get_metadata(client_postgrest, APP_ID)
+
+
 def main(args):
     app_name = args.app_name
     container = args.container
@@ -131,7 +188,7 @@ def main(args):
     filters = utils.knack.date_filter_on_or_after(
         args.date, config['modified_date_field'], tzinfo=APP_TIMEZONE, use_time=True
     )
-    app = knackpy.App(app_id=APP_ID, api_key=API_KEY)
+    app = knackpy.App(app_id=APP_ID, api_key=API_KEY, metadata=get_metadata())
     records = app.get(container, filters=filters)
     records_formatted = [record.format() for record in records]
     if not records_formatted:
@@ -139,45 +196,67 @@ def main(args):
         return 0
     field_mapping = create_knack_field_mapping(records[0])
     
+    if args.segment_store:
+        # join to the knack records from the local copy of the segment layer
+        segment_store = utils.segments.SegmentStore(token=token)
+        refreshed = segment_store.refresh()
+        logger.info(f"Refreshed {refreshed} segments in the local segment store")
+    elif args.bulk:
+        # fetch every segment up front and join to the knack records in memory
+        segment_ids = set(
+            parse_segment_id(r[config["primary_key"]]) for r in records_formatted
+        )
+        segment_ids.discard(None)
+        segments = fetch_street_segments(list(segment_ids), token)
+
     unmatched_segments = []
     for street_segment in records_formatted:
-        features = query_atx_street(
-            street_segment[config["primary_key"]], token
-        )
-        if features.get("error"):
-            # AGOL returns code 200 even for error queries.
-            # Let's try the query again
-            features = query_atx_street(
-                street_segment[config["primary_key"]], token
-            )
+        segment_id = street_segment[config["primary_key"]]
+        if args.segment_store or args.bulk:
+            # a record with an empty or non-numeric segment ID is unmatched, as it
+            # would be by the per-segment query
+            segment_id_int = parse_segment_id(segment_id)
+            if segment_id_int is None:
+                segment_data = None
+            elif args.segment_store:
+                segment_data = segment_store.get_attributes(segment_id_int)
+            else:
+                segment_data = segments.get(segment_id_int)
+        else:
+            features = query_atx_street(segment_id, token)
             if features.get("error"):
-                raise Exception(str(features))
+                # AGOL returns code 200 even for error queries.
+                # Let's try the query again
+                features = query_atx_street(segment_id, token)
+                if features.get("error"):
+                    raise Exception(str(features))
+            segment_data = (
+                features["features"][0]["attributes"]
+                if features.get("features")
+                else None
+            )
 
         # handling returned segment features from AGOL
-        if features.get("features"):
-            if len(features["features"]) > 0:
-                segment_data = features["features"][0]["attributes"]
-                #  we don't want to compare modified dates
-                #  because we don't keep that value in sync with the source data on AGOL
-                #  because we use our own modified date set in the data tracker
-                segment_data.pop(config["modified_date_col_name"])
-                street_segment.pop(config["modified_date_col_name"])
-
-                #  compare new data (segment data) against old (street_segment)
-                #  we only want to upload values that have changed
-                if not are_equal(street_segment, segment_data):
-                    logger.info(f'Change detected for segment ID: {street_segment[config["primary_key"]]}')
-                    segment_data["id"] = street_segment["id"]
-                    segment_data[config["modified_date_col_name"]] = local_timestamp()
-                    # Uploading updated data back to Knack
-                    update_record(config, segment_data, field_mapping)
-            else:
-                unmatched_segments.append(street_segment[config["primary_key"]])
-                continue
-        else:
-            unmatched_segments.append(street_segment[config["primary_key"]])
+        if not segment_data:
+            unmatched_segments.append(segment_id)
             continue
 
+        #  we don't want to compare modified dates
+        #  because we don't keep that value in sync with the source data on AGOL
+        #  because we use our own modified date set in the data tracker
+        segment_data = dict(segment_data)
+        segment_data.pop(config["modified_date_col_name"])
+        street_segment.pop(config["modified_date_col_name"])
+
+        #  compare new data (segment data) against old (street_segment)
+        #  we only want to upload values that have changed
+        if not are_equal(street_segment, segment_data):
+            logger.info(f"Change detected for segment ID: {segment_id}")
+            segment_data["id"] = street_segment["id"]
+            segment_data[config["modified_date_col_name"]] = local_timestamp()
+            # Uploading updated data back to Knack
+            update_record(config, segment_data, field_mapping)
+
     if unmatched_segments:
         error_text = "Unmatched street segments: {}".format(
             ", ".join(str(x) for x in unmatched_segments)
@@ -209,6 +288,18 @@ if __name__ == "__main__":
         default="1970/01/01",
         help="Date to filter Knack records created/modified after this date. Format: YYYY/MM/DD HH:MM (UTC)",
     )
+
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="Fetch all street segments from AGOL in a few large queries, instead of one query per segment",
+    )
+
+    parser.add_argument(
+        "--segment-store",
+        action="store_true",
+        help="Compare records against the local street segment store, which is refreshed incrementally",
+    )
     args = parser.parse_args()
 
     logger = utils.logging.getLogger(__file__)
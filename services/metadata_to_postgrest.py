@@ -13,8 +13,38 @@ def main():
     PGREST_ENDPOINT = os.getenv("PGREST_ENDPOINT")
     metadata = knackpy.api.get_metadata(app_id=APP_ID)
     client = utils.postgrest.Postgrest(PGREST_ENDPOINT, token=PGREST_JWT)
-    client.upsert("knack_metadata", data={"app_id": APP_ID, "metadata": metadata})
+    version_hash = utils.postgrest.metadata_version_hash(metadata)
+    utils.postgrest.cache_metadata(APP_ID, version_hash, metadata)
+
+    fingerprints = utils.postgrest.container_fingerprints(metadata)
+    current = client.select(
+        "knack_metadata",
+        params={
+            "app_id": f"eq.{APP_ID}",
+            "select": "version_hash,container_fingerprints",
+            "limit": 1,
+        },
+        pagination=False,
+    )
+    if current and current[0] == {
+        "version_hash": version_hash,
+        "container_fingerprints": fingerprints,
+    }:
+        logger.info(f"Metadata is unchanged (version {version_hash}). Doing nothing.")
+        return
+
+    client.upsert(
+        "knack_metadata",
+        data={
+            "app_id": APP_ID,
+            "metadata": metadata,
+            "version_hash": version_hash,
+            "container_fingerprints": fingerprints,
+        },
+    )
+    logger.info(f"Metadata updated to version {version_hash}")
 
 
 if __name__ == "__main__":
+    logger = utils.logging.getLogger(__file__)
     main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import argparse
+from multiprocessing.dummy import Pool
 import os
 
 import knackpy
@@ -9,6 +10,12 @@ import utils
 
 APP_ID = os.getenv("KNACK_APP_ID")
 API_KEY = os.getenv("KNACK_API_KEY")
+PGREST_JWT = os.getenv("PGREST_JWT")
+PGREST_ENDPOINT = os.getenv("PGREST_ENDPOINT")
+# the max number of filter rules per Knack request, to keep request urls short
+FILTER_CHUNK_SIZE = 50
+# the number of purchase requests copied concurrently
+WORKERS = 4
 
 
 def handle_record_types(knack_record):
@@ -49,6 +56,93 @@ def assign_requester(data, requester_field_id, copied_by_field_id):
     return data
 
 
+def get_items_by_pr(app, items_config, unique_ids):
+    """
+    Fetch the PR items of many purchase requests with `is` filter rules combined
+    with `or`, and group them by their purchase request's unique ID (as a string)
+    """
+    items_by_pr = {}
+    for ids_chunk in chunks(unique_ids, FILTER_CHUNK_SIZE):
+        item_filter = {
+            "match": "or",
+            "rules": [
+                {"field": items_config["pr_field_id"], "operator": "is", "value": uid}
+                for uid in ids_chunk
+            ],
+        }
+        item_records = app.get(
+            items_config["object"], filters=item_filter, refresh=True
+        )
+        for item in item_records:
+            pr_id = str(item.get(items_config["pr_field_id"]))
+            items_by_pr.setdefault(pr_id, []).append(item)
+    return items_by_pr
+
+
+def get_metadata():
+    """Fetch app metadata from Postgrest, which is cached locally, if an endpoint is
+    configured. Otherwise None is returned and knackpy fetches it from Knack."""
+    if not PGREST_ENDPOINT:
+        return None
+    client_postgrest = utils.postgrest.Postgrest(PGREST_ENDPOINT, token=PGREST_JWT)
+    return utils.postgrest.get_metadata(client_postgrest, APP_ID)
+
+
+def chunks(lst, n):
+    """Yield successive n-sized chunks from lst."""
+    for i in range(0, len(lst), n):
+        yield lst[i : i + n]
+
+
+def write_record(limiter, obj, method, data):
+    limiter.wait()
+    return knackpy.api.record(
+        app_id=APP_ID, api_key=API_KEY, obj=obj, method=method, data=data
+    )
+
+
+def copy_purchase_request(purchase_request, item_records, config, limiter):
+    """Copy a purchase request and its items, in the order which keeps it from being
+    copied twice: create the copy, then clear the original's copy flag, then create
+    the copy's items"""
+    unique_id = purchase_request.get(config["unique_id_field_id"])
+    logger.info(f"Copying Purchase Request with ID: {unique_id}")
+    # Creating a copy of the purchase request and assigning it to person requesting the copy
+    data = handle_record_types(purchase_request)
+    data = assign_requester(
+        data, config["requester_field_id"], config["copied_by_field_id"]
+    )
+    # set copy PR to "No"
+    data[config["copy_field_id"]] = False
+    copied_record = write_record(limiter, config["object"], "create", data)
+    logger.info(
+        f"New Purchase Request record generated with ID: {copied_record.get(config['unique_id_field_id'])}"
+    )
+
+    # Update the original to remove it from our queue of requested copies
+    write_record(
+        limiter,
+        config["object"],
+        "update",
+        {"id": purchase_request.get("id"), config["copy_field_id"]: False},
+    )
+
+    # Copying over PR items to the newly created PR
+    logger.info(f"Copying {len(item_records)} Purchase Request items of PR {unique_id}")
+    for item in item_records:
+        item_data = handle_record_types(item)
+
+        # set item connection to copied purchase request record
+        item_data[config["pr_items"]["pr_connection_field_id"]] = [copied_record["id"]]
+        # set item unique ID to purchase request unique ID
+        item_data[config["pr_items"]["pr_field_id"]] = copied_record.get(
+            config["unique_id_field_id"]
+        )
+        item_data.pop("id")
+        # generates new PR items as child records to the copied PR
+        write_record(limiter, config["pr_items"]["object"], "create", item_data)
+
+
 def main(args):
     # Process arguments
     app_name = args.app_name
@@ -64,82 +158,40 @@ def main(args):
         return 0
 
     # If we have records to copy, get the full metadata of the app/records.
-    app = knackpy.App(app_id=APP_ID, api_key=API_KEY)
+    app = knackpy.App(app_id=APP_ID, api_key=API_KEY, metadata=get_metadata())
     records = app.get(container, filters=None)
 
     logger.info(f"Copying {len(records)} Purchase Requests")
-    # Creating a copy of the purchase request and assigning it to person requesting the copy
-    for purchase_request in records:
-        unique_id = purchase_request.get(config["unique_id_field_id"])
-        logger.info(f"Copying Purchase Request with ID: {unique_id}")
-        data = handle_record_types(purchase_request)
-        data = assign_requester(
-            data, config["requester_field_id"], config["copied_by_field_id"]
-        )
 
-        # set copy PR to "No"
-        data[config["copy_field_id"]] = False
+    # Get the PR items of every PR to copy, grouped by PR unique ID
+    unique_ids = [
+        purchase_request.get(config["unique_id_field_id"])
+        for purchase_request in records
+    ]
+    items_by_pr = get_items_by_pr(app, config["pr_items"], unique_ids)
 
-        # Create new record that was copied
-        copied_record = knackpy.api.record(
-            app_id=APP_ID,
-            api_key=API_KEY,
-            obj=config["object"],
-            method="create",
-            data=data,
-        )
-        logger.info(
-            f"New Purchase Request record generated with ID: {copied_record.get(config['unique_id_field_id'])}"
-        )
+    # each PR is copied as a unit, so a failure leaves other PRs unaffected. requests
+    # are shared between workers under the Knack API rate limit
+    limiter = utils.knack.RateLimiter(utils.knack.KNACK_RATE_LIMIT)
 
-        # Update the original copy to remove it from our queue of requested copies
-        old_record = {"id": purchase_request.get("id"), config["copy_field_id"]: False}
-        original_record = knackpy.api.record(
-            app_id=APP_ID,
-            api_key=API_KEY,
-            obj=config["object"],
-            method="update",
-            data=old_record,
-        )
+    def copy_wrapper(purchase_request):
+        unique_id = purchase_request.get(config["unique_id_field_id"])
+        try:
+            copy_purchase_request(
+                purchase_request,
+                items_by_pr.get(str(unique_id), []),
+                config,
+                limiter,
+            )
+        except Exception as e:
+            logger.error(f"Failed to copy Purchase Request {unique_id}: {e!r}")
+            return unique_id
 
-        # Get the Auto increment field ID, so we can search the PR items table
-        item_filter = {
-            "match": "and",
-            "rules": [
-                {
-                    "field": config["pr_items"]["pr_field_id"],
-                    "operator": "is",
-                    "value": unique_id,
-                }
-            ],
-        }
-        item_records = app.get(
-            config["pr_items"]["object"], filters=item_filter, refresh=True
-        )
+    with Pool(processes=WORKERS) as pool:
+        failed = [uid for uid in pool.map(copy_wrapper, records) if uid is not None]
 
-        logger.info(f"Copying {len(item_records)} Purchase Request items")
-        # Copying over PR items to the newly created PR
-        for item in item_records:
-            item_data = handle_record_types(item)
-
-            # set item connection to copied purchase request record
-            item_data[config["pr_items"]["pr_connection_field_id"]] = [
-                copied_record["id"]
-            ]
-            # set item unique ID to purchase request unique ID
-            item_data[config["pr_items"]["pr_field_id"]] = copied_record.get(
-                config["unique_id_field_id"]
-            )
-            item_data.pop("id")
-
-            # generates new PR item as a child record to the copied PR
-            new_item = knackpy.api.record(
-                app_id=APP_ID,
-                api_key=API_KEY,
-                obj=config["pr_items"]["object"],
-                method="create",
-                data=item_data,
-            )
+    if failed:
+        raise Exception(f"Failed to copy Purchase Requests: {failed}")
     return len(records)
 
 
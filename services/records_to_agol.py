@@ -18,6 +18,7 @@ APP_ID = os.getenv("KNACK_APP_ID")
 PGREST_JWT = os.getenv("PGREST_JWT")
 PGREST_ENDPOINT = os.getenv("PGREST_ENDPOINT")
 MAX_RETRIES = 3
+SERVICE_NAME = "records_to_agol"
 
 
 def chunks(lst, n):
@@ -56,8 +57,22 @@ def resilient_layer_request(func, args, max_retries=MAX_RETRIES):
             pass
 
 
+def delete_features(layer, record_ids):
+    """Delete features from the layer by their Knack record `id`"""
+    key = "id"
+    keys = [f"'{record_id}'" for record_id in record_ids]
+    for key_chunk in chunks(keys, 100):
+        key_list_stringified = ",".join(key_chunk)
+        res = resilient_layer_request(
+            layer.delete_features, {"where": f"{key} in ({key_list_stringified})"}
+        )
+        utils.agol.handle_response(res)
+
+
 def main():
-    args = utils.args.cli_args(["app-name", "container", "date"])
+    args = utils.args.cli_args(
+        ["app-name", "container", "date", "checkpoint", "sync-state", "tombstones"]
+    )
     logger.info(args)
     container = args.container
     config = CONFIG.get(args.app_name).get(container)
@@ -76,46 +91,100 @@ def main():
     metadata_knack = utils.postgrest.get_metadata(client_postgrest, APP_ID)
     app = knackpy.App(app_id=APP_ID, metadata=metadata_knack)
 
+    gis = arcgis.GIS(url=URL, username=USERNAME, password=PASSWORD)
+    service = gis.content.get(service_id)
+
+    if item_type == "layer":
+        layer = service.layers[layer_id]
+    elif item_type == "table":
+        layer = service.tables[layer_id]
+    else:
+        raise ValueError(f"Unknown item_type specified: {item_type}")
+
     logger.info(f"Downloading records from app {APP_ID}, container {container}.")
 
-    filter_iso_date_str = format_filter_date(args.date)
-
-    data = client_postgrest.select(
-        "knack",
-        params={
-            "select": "record",
-            "app_id": f"eq.{APP_ID}",
-            "container_id": f"eq.{container}",
-            "updated_at": f"gte.{filter_iso_date_str}",
-        },
-        order_by="id",
+    date = args.date
+    watermark = None
+    # checkpoints are kept per layer, since a container may publish to several
+    destination = f"{service_id}/{layer_id}"
+    if args.checkpoint:
+        # read before selecting records, so records updated while this runs are
+        # published by the next run
+        watermark = utils.postgrest.get_max_updated_at(
+            client_postgrest, APP_ID, container
+        )
+        if not date:
+            date = utils.postgrest.get_checkpoint(
+                client_postgrest, SERVICE_NAME, APP_ID, container, destination
+            )
+            logger.info(f"Processing records updated since checkpoint: {date}")
+
+    filter_iso_date_str = format_filter_date(date)
+
+    if args.tombstones and (date or args.sync_state):
+        # propagate records which have been deleted from Knack. a full replace of the
+        # layer removes them anyway
+        tombstones = utils.postgrest.select_tombstones(
+            client_postgrest,
+            APP_ID,
+            container,
+            deleted_since=filter_iso_date_str,
+            destination=destination if args.sync_state else None,
+        )
+        logger.info(f"Deleting {len(tombstones)} deleted records...")
+        delete_features(layer, [t["record_id"] for t in tombstones])
+        if args.sync_state:
+            utils.postgrest.clear_synced(
+                client_postgrest,
+                APP_ID,
+                container,
+                destination,
+                [t["record_id"] for t in tombstones],
+            )
+
+    # only select the fields which have a matching field in the layer, and the
+    # location field, which is used for geometry
+    field_keys = utils.knack.field_keys_by_name(
+        app, container, [field["name"] for field in layer.properties.fields]
     )
+    if location_field_id and location_field_id not in field_keys:
+        field_keys += [location_field_id, f"{location_field_id}_raw"]
+
+    if args.sync_state:
+        data, hashes = utils.postgrest.select_unsynced_records(
+            client_postgrest, APP_ID, container, destination, field_keys=field_keys
+        )
+    else:
+        data = utils.postgrest.select_records(
+            client_postgrest,
+            APP_ID,
+            container,
+            updated_since=filter_iso_date_str,
+            field_keys=field_keys,
+        )
 
     logger.info(f"{len(data)} to process.")
 
     if not data:
+        if watermark:
+            utils.postgrest.set_checkpoint(
+                client_postgrest, SERVICE_NAME, APP_ID, container, watermark, destination
+            )
         return
 
-    app.data[container] = [r["record"] for r in data]
+    # features are built in the same order as the records
+    record_ids = [record["id"] for record in data]
+
+    utils.knack.fill_missing_fields(data, app, container)
+    app.data[container] = data
     records = app.get(container)
 
     fields_names_to_sanitize = [
         f.name
-        for f in app.field_defs
+        for f in utils.knack.container_field_defs(app, container)
         if f.type in ["short_text", "paragraph_text"]
-        and (f.obj == container or container in f.views)
     ]
 
-    gis = arcgis.GIS(url=URL, username=USERNAME, password=PASSWORD)
-    service = gis.content.get(service_id)
-
-    if item_type == "layer":
-        layer = service.layers[layer_id]
-    elif item_type == "table":
-        layer = service.tables[layer_id]
-    else:
-        raise ValueError(f"Unknown item_type specified: {item_type}")
-
     logger.info("Building features...")
 
     features = [
@@ -125,7 +194,7 @@ def main():
         for record in records
     ]
 
-    if not args.date:
+    if not date and not args.sync_state:
         """
         Completely replace destination data. arcgis does have layer.manager.truncate()
         method, but this method is not supported on the parent layer of parent-child
@@ -156,23 +225,34 @@ def main():
         )
         """
         logger.info(f"Deleting {len(features)} features...")
-        key = "id"
-        keys = [f'\'{f["attributes"][key]}\'' for f in features]
-        for key_chunk in chunks(keys, 100):
-            key_list_stringified = ",".join(key_chunk)
-            res = resilient_layer_request(
-                layer.delete_features, {"where": f"{key} in ({key_list_stringified})"}
-            )
-            utils.agol.handle_response(res)
+        delete_features(layer, [f["attributes"]["id"] for f in features])
 
     logger.info("Uploading features...")
 
-    for features_chunk in chunks(features, 50):
+    for start in range(0, len(features), 50):
+        features_chunk = features[start : start + 50]
         logger.info("Uploading chunk...")
         res = resilient_layer_request(
             layer.edit_features, {"adds": features_chunk, "rollback_on_failure": False}
         )
         utils.agol.handle_response(res)
+        if args.sync_state:
+            # a retry resends only the records which were not uploaded
+            utils.postgrest.mark_synced(
+                client_postgrest,
+                APP_ID,
+                container,
+                destination,
+                {
+                    record_id: hashes[record_id]
+                    for record_id in record_ids[start : start + 50]
+                },
+            )
+
+    if watermark:
+        utils.postgrest.set_checkpoint(
+            client_postgrest, SERVICE_NAME, APP_ID, container, watermark, destination
+        )
 
 
 if __name__ == "__main__":
@@ -8,6 +8,8 @@ from config.knack import CONFIG
 from config.field_maps import FIELD_MAPS
 import utils
 
+SERVICE_NAME = "records_to_knack"
+
 
 def format_filter_date(date_from_args):
     return "1970-01-01" if not date_from_args else arrow.get(date_from_args).isoformat()
@@ -99,6 +101,53 @@ def handle_records(data_src, data_dest, field_map, app_name_dest):
     return todos
 
 
+def find_deleted_records(
+    client, tombstones, field_map, app_name_dest, app_id_dest, container_dest
+):
+    """Return the destination records (as `{"id": <id>}` dicts) whose primary key
+    matches a tombstoned source record, and the record IDs of the tombstones whose
+    primary key is unknown.
+
+    A tombstone's primary key is mapped from its last record. If the tombstone has no
+    record, its record ID is used when it is the source primary key."""
+    if not tombstones:
+        return [], []
+    pk_src, pk_dest = get_pks(field_map, app_name_dest)
+    pk_field = [f for f in field_map if f.get("primary_key")][0]
+    pks = set()
+    skipped = []
+    for t in tombstones:
+        if t["record"]:
+            mapped_record = create_mapped_record(t["record"], field_map, app_name_dest)
+            pks.add(mapped_record[pk_dest])
+        elif pk_src == "id":
+            handler_func = pk_field.get("handler")
+            pks.add(handler_func(t["record_id"]) if handler_func else t["record_id"])
+        else:
+            skipped.append(t["record_id"])
+    if skipped:
+        logger.warning(f"Skipping tombstones without a record: {skipped}")
+    data_dest = utils.postgrest.select_records(
+        client, app_id_dest, container_dest, field_keys=["id", pk_dest]
+    )
+    deletes = [{"id": rec["id"]} for rec in data_dest if rec[pk_dest] in pks]
+    return deletes, skipped
+
+
+def advance_checkpoint(client, app_id, container, watermark, app_name_dest):
+    """Store the checkpoint of a successful run, if checkpoints are in use"""
+    if watermark:
+        utils.postgrest.set_checkpoint(
+            client, SERVICE_NAME, app_id, container, watermark, app_name_dest
+        )
+
+
+def mark_synced(client, app_id, container, hashes, app_name_dest):
+    """Store the hashes of the published source records, if sync state is in use"""
+    if hashes:
+        utils.postgrest.mark_synced(client, app_id, container, app_name_dest, hashes)
+
+
 def main():
     APP_ID_SRC = os.getenv("KNACK_APP_ID_SRC")
     APP_ID_DEST = os.getenv("KNACK_APP_ID_DEST")
@@ -106,7 +155,17 @@ def main():
     PGREST_JWT = os.getenv("PGREST_JWT")
     PGREST_ENDPOINT = os.getenv("PGREST_ENDPOINT")
 
-    args = utils.args.cli_args(["app-name", "container", "date", "app-name-dest"])
+    args = utils.args.cli_args(
+        [
+            "app-name",
+            "container",
+            "date",
+            "app-name-dest",
+            "checkpoint",
+            "sync-state",
+            "tombstones",
+        ]
+    )
     logger.info(args)
     app_name_src = args.app_name
     app_name_dest = args.app_name_dest
@@ -116,26 +175,91 @@ def main():
     container_dest = config.get("dest_apps").get(app_name_dest).get("container")
     object_dest = config.get("dest_apps").get(app_name_dest).get("object")
     client_postgrest = utils.postgrest.Postgrest(PGREST_ENDPOINT, token=PGREST_JWT)
-    filter_iso_date_str = format_filter_date(args.date)
+
+    date = args.date
+    watermark = None
+    if args.checkpoint:
+        # read before selecting records, so records updated while this runs are
+        # published by the next run
+        watermark = utils.postgrest.get_max_updated_at(
+            client_postgrest, APP_ID_SRC, container_src
+        )
+        if not date:
+            date = utils.postgrest.get_checkpoint(
+                client_postgrest, SERVICE_NAME, APP_ID_SRC, container_src, app_name_dest
+            )
+            logger.info(f"Processing records updated since checkpoint: {date}")
+
+    filter_iso_date_str = format_filter_date(date)
 
     logger.info(
         f"Downloading records from app {APP_ID_SRC} ({app_name_src}), container {container_src}."
     )
 
-    data_src = client_postgrest.select(
-        "knack",
-        params={
-            "select": "record",
-            "app_id": f"eq.{APP_ID_SRC}",
-            "container_id": f"eq.{container_src}",
-            "updated_at": f"gte.{filter_iso_date_str}",
-        },
-        order_by="id",
-    )
+    field_map = FIELD_MAPS.get(app_name_src).get(container_src)
+
+    if args.tombstones and (date or args.sync_state):
+        # propagate records which have been deleted from the source app since the
+        # last run. without a date, every tombstone ever recorded would be processed
+        tombstones = utils.postgrest.select_tombstones(
+            client_postgrest,
+            APP_ID_SRC,
+            container_src,
+            deleted_since=date,
+            destination=app_name_dest if args.sync_state else None,
+        )
+        deletes, skipped = find_deleted_records(
+            client_postgrest,
+            tombstones,
+            field_map,
+            app_name_dest,
+            APP_ID_DEST,
+            container_dest,
+        )
+        logger.info(f"Deleting {len(deletes)} records in the destination app.")
+        utils.knack.write_records(
+            deletes,
+            app_id=APP_ID_DEST,
+            api_key=API_KEY_DEST,
+            obj=object_dest,
+            method="delete",
+        )
+        if args.sync_state:
+            utils.postgrest.clear_synced(
+                client_postgrest,
+                APP_ID_SRC,
+                container_src,
+                app_name_dest,
+                # skipped records stay in sync state, so they are retried
+                [t["record_id"] for t in tombstones if t["record_id"] not in skipped],
+            )
+
+    # only select the fields which are mapped to the destination app
+    field_keys = ["id"] + [field["src"] for field in field_map if field["src"]]
+    hashes = None
+    if args.sync_state:
+        data_src, hashes = utils.postgrest.select_unsynced_records(
+            client_postgrest,
+            APP_ID_SRC,
+            container_src,
+            app_name_dest,
+            field_keys=field_keys,
+        )
+    else:
+        data_src = utils.postgrest.select_records(
+            client_postgrest,
+            APP_ID_SRC,
+            container_src,
+            updated_since=filter_iso_date_str,
+            field_keys=field_keys,
+        )
 
     logger.info(f"{len(data_src)} records to process")
 
     if not data_src:
+        advance_checkpoint(
+            client_postgrest, APP_ID_SRC, container_src, watermark, app_name_dest
+        )
         return
 
     logger.info(
@@ -143,26 +267,23 @@ def main():
     )
 
     # existing data in destination knack app
-    data_dest = client_postgrest.select(
-        "knack",
-        params={
-            "select": "record",
-            "app_id": f"eq.{APP_ID_DEST}",
-            "container_id": f"eq.{container_dest}",
-        },
-        order_by="id",
+    data_dest = utils.postgrest.select_records(
+        client_postgrest,
+        APP_ID_DEST,
+        container_dest,
+        field_keys=["id"] + [field[app_name_dest] for field in field_map],
     )
 
-    data_src = [r["record"] for r in data_src]
-    data_dest = [r["record"] for r in data_dest]
-    field_map = FIELD_MAPS.get(app_name_src).get(container_src)
-
     # identify new/changed records and map to destination Knack app schema
     todos = handle_records(data_src, data_dest, field_map, app_name_dest)
 
     logger.info(f"Updating/creating {len(todos)} records in the destination app.")
 
     if not todos:
+        mark_synced(client_postgrest, APP_ID_SRC, container_src, hashes, app_name_dest)
+        advance_checkpoint(
+            client_postgrest, APP_ID_SRC, container_src, watermark, app_name_dest
+        )
         return
 
     count = 0
@@ -179,6 +300,12 @@ def main():
         )
         count += 1
 
+    # source records which match the destination are in sync, too
+    mark_synced(client_postgrest, APP_ID_SRC, container_src, hashes, app_name_dest)
+    advance_checkpoint(
+        client_postgrest, APP_ID_SRC, container_src, watermark, app_name_dest
+    )
+
 
 if __name__ == "__main__":
     logger = utils.logging.getLogger(__file__)
@@ -4,26 +4,42 @@
 from multiprocessing.dummy import Pool
 import os
 
+import arrow
 import knackpy
+import requests
 
 from config.knack import CONFIG, APP_TIMEZONE
 import utils
 
+SERVICE_NAME = "records_to_postgrest"
+# the max fraction of a container's records which may be tombstoned in one run
+MAX_TOMBSTONED_FRACTION = 0.25
 
-def build_payload(
-    records, app_id, container,
-):
+
+def build_payload(records, app_id, container, dedupe=False):
+    """Build the rows to upsert to the knack table. If `dedupe` is True, rows
+    reference their record body by hash, and the distinct bodies are returned as well.
+
+    Returns:
+        tuple: a list of knack rows, and a list of knack_record_body rows
+    """
     payload = []
+    bodies = {}
     for record in records:
-        payload.append(
-            {
-                "record_id": record["id"],
-                "app_id": app_id,
-                "container_id": container,
-                "record": record,
-            }
-        )
-    return payload
+        row = {
+            "record_id": record["id"],
+            "app_id": app_id,
+            "container_id": container,
+            "record": record,
+            "record_hash": None,
+        }
+        if dedupe:
+            record_hash = utils.shared.json_hash(record)
+            bodies[record_hash] = {"record_hash": record_hash, "record": record}
+            row["record"] = None
+            row["record_hash"] = record_hash
+        payload.append(row)
+    return payload, list(bodies.values())
 
 
 def container_kwargs(container, config, obj=None, scene=None, view=None):
@@ -50,6 +66,47 @@ def upsert_wrapper(data):
     return data["client"].upsert("knack", data["payload"])
 
 
+def upsert_bodies_wrapper(data):
+    # bodies are immutable, so a body which is already stored only has its updated_at
+    # touched, which keeps it from being swept before its records are upserted
+    return data["client"].rpc("upsert_knack_record_bodies", {"bodies": data["payload"]})
+
+
+def tombstone_deleted(client, app_id, container, record_ids):
+    """Move the container's records which are not in `record_ids` to the tombstones
+    table, so that publishers run with --tombstones delete them downstream"""
+    if not record_ids:
+        # more likely a permissions or view misconfiguration than an empty container
+        logger.warning("No record IDs were returned from Knack. Nothing tombstoned.")
+        return
+    tombstoned = utils.postgrest.tombstone_records(
+        client, app_id, container, record_ids, max_fraction=MAX_TOMBSTONED_FRACTION
+    )
+    if tombstoned is None:
+        logger.warning(
+            f"Refused to tombstone more than {MAX_TOMBSTONED_FRACTION:.0%} of the "
+            f"container's records. Check that the container is configured correctly "
+            f"in Knack."
+        )
+        return
+    logger.info(f"Deleted records tombstoned: {tombstoned}")
+
+
+def refresh_flat_views(client, partition_args):
+    """Refresh any flattened views of this container. see generate_flat_views.py"""
+    try:
+        refreshed = client.rpc("refresh_knack_flat_views", partition_args)
+    except requests.exceptions.HTTPError as e:
+        if e.response is None or e.response.status_code != 404:
+            raise
+        # flattened views are opt-in, and the function does not exist until
+        # migration 002 is applied
+        logger.info("No flattened views to refresh")
+        return
+    if refreshed:
+        logger.info(f"Flattened views refreshed: {refreshed}")
+
+
 def main():
     CHUNK_SIZE = 200
     APP_ID = os.getenv("KNACK_APP_ID")
@@ -57,7 +114,9 @@ def main():
     PGREST_JWT = os.getenv("PGREST_JWT")
     PGREST_ENDPOINT = os.getenv("PGREST_ENDPOINT")
 
-    args = utils.args.cli_args(["app-name", "container", "date"])
+    args = utils.args.cli_args(
+        ["app-name", "container", "date", "dedupe", "checkpoint", "tombstones"]
+    )
     logger.info(args)
     container = args.container
     app_config = CONFIG.get(args.app_name).get(container)
@@ -67,10 +126,21 @@ def main():
             f"No config entry found for app: {args.app_name}, container: {container}"
         )
 
+    client = utils.postgrest.Postgrest(PGREST_ENDPOINT, token=PGREST_JWT)
+
+    date = args.date
+    if args.checkpoint and not date:
+        date = utils.postgrest.get_checkpoint(client, SERVICE_NAME, APP_ID, container)
+        logger.info(f"Processing records modified since checkpoint: {date}")
+
+    # the next checkpoint is the time this run started, so that records modified
+    # while it runs are processed by the next run
+    run_started = arrow.utcnow().isoformat()
+
     modified_date_field = app_config.get("modified_date_field")
 
     filters = utils.knack.date_filter_on_or_after(
-        args.date, modified_date_field, tzinfo=APP_TIMEZONE
+        date, modified_date_field, tzinfo=APP_TIMEZONE, use_time=True
     )
 
     logger.info("Downloading records from Knack...")
@@ -83,33 +153,75 @@ def main():
 
     logger.info(f"{len(records)} to process.")
 
-    if not records:
+    if not records and not (args.tombstones and date):
+        if args.checkpoint:
+            utils.postgrest.set_checkpoint(
+                client, SERVICE_NAME, APP_ID, container, run_started
+            )
         return
 
-    payload = build_payload(records, APP_ID, container)
-
-    client = utils.postgrest.Postgrest(PGREST_ENDPOINT, token=PGREST_JWT)
+    partition_args = {"app_id": APP_ID, "container_id": container}
 
-    if not args.date:
-        # if no date is provided, we do a full replace of the data
-        client.delete(
-            "knack",
-            params={"container_id": f"eq.{container}", "app_id": f"eq.{APP_ID}"},
+    if records:
+        payload, bodies = build_payload(
+            records, APP_ID, container, dedupe=args.dedupe
         )
 
-    chunked_payload = chunk_payload(client, payload, CHUNK_SIZE)
+        if not date:
+            if args.tombstones:
+                # every record was downloaded, so any others have been deleted
+                tombstone_deleted(client, APP_ID, container, [r["id"] for r in records])
+            # if no date is provided, we do a full replace of the data by truncating
+            # the container's partition of the knack table
+            client.rpc("truncate_knack_partition", partition_args)
+        else:
+            # create the container's partition if this is its first load
+            client.rpc("ensure_knack_partition", partition_args)
+
+        if bodies:
+            # bodies must exist before the rows which reference them
+            with Pool(processes=4) as pool:
+                pool.map(
+                    upsert_bodies_wrapper, chunk_payload(client, bodies, CHUNK_SIZE)
+                )
+            logger.info(f"Distinct record bodies: {len(bodies)}")
+
+        chunked_payload = chunk_payload(client, payload, CHUNK_SIZE)
+
+        with Pool(processes=4) as pool:
+            """
+            Increasing the number of processes (actually, threads because that's what
+            a dummy pool does), can definitely improve performance, but postgrest was
+            dropping connections pretty frequently under heavy loads. TODO: revisit
+            this when we have a production deployment with more compute. There is a
+            TBD sweet spot of chunk size vs # of threads.
+            """
+            pool.map(upsert_wrapper, chunked_payload)
+
+        logger.info(f"Records uploaded: {len(records)}")
+
+        if args.dedupe and not date:
+            # bodies are orphaned by full replaces, by incremental loads which change
+            # a record, and by tombstoning, so every orphaned body is swept on each
+            # full replace. bodies written by a concurrent load are kept
+            deleted = utils.postgrest.delete_orphaned_bodies(client)
+            logger.info(f"Orphaned record bodies deleted: {deleted}")
+
+    if args.tombstones and date:
+        # the IDs are fetched after the upload, so that records created while this
+        # runs are not mistaken for deleted records
+        logger.info("Downloading record IDs from Knack...")
+        record_ids = utils.knack.get_record_ids(
+            app_id=APP_ID, api_key=API_KEY, **kwargs
+        )
+        tombstone_deleted(client, APP_ID, container, record_ids)
 
-    with Pool(processes=4) as pool:
-        """
-        Increasing the number of processes (actually, threads because that's what a
-        dummy pool does), can definitely improve performance, but postgrest was
-        dropping connections pretty frequently under heavy loads. TODO: revisit
-        this when we have a production deployment with more compute. There is a TBD
-        sweet spot of chunk size vs # of threads.
-        """
-        pool.map(upsert_wrapper, chunked_payload)
+    refresh_flat_views(client, partition_args)
 
-    logger.info(f"Records uploaded: {len(records)}")
+    if args.checkpoint:
+        utils.postgrest.set_checkpoint(
+            client, SERVICE_NAME, APP_ID, container, run_started
+        )
 
     return
 
@@ -7,6 +7,8 @@ import knackpy
 from config.knack import CONFIG
 import utils
 
+SERVICE_NAME = "records_to_socrata"
+
 
 def handle_floating_timestamps(records, floating_timestamp_fields):
     """Socrata's fixed timestamp dataType does not allow tz info :(
@@ -111,6 +113,15 @@ def patch_formatters(field_defs, location_field_id, metadata_socrata):
     knackpy_field_def.formatter = formatter_func
 
 
+def delete_tombstoned(tombstones, resource_id, client_socrata):
+    """Delete records from a Socrata dataset whose row identifier is the Knack record
+    `id`, by upserting them with the `:deleted` flag"""
+    payload = [{"id": t["record_id"], ":deleted": True} for t in tombstones]
+    utils.socrata.publish(
+        method="upsert", resource_id=resource_id, payload=payload, client=client_socrata
+    )
+
+
 def format_filter_date(date_from_args):
     return "1970-01-01" if not date_from_args else arrow.get(date_from_args).isoformat()
 
@@ -120,7 +131,9 @@ def main():
     PGREST_JWT = os.getenv("PGREST_JWT")
     PGREST_ENDPOINT = os.getenv("PGREST_ENDPOINT")
 
-    args = utils.args.cli_args(["app-name", "container", "date"])
+    args = utils.args.cli_args(
+        ["app-name", "container", "date", "checkpoint", "sync-state", "tombstones"]
+    )
     logger.info(args)
 
     container = args.container
@@ -135,35 +148,86 @@ def main():
     client_postgrest = utils.postgrest.Postgrest(PGREST_ENDPOINT, token=PGREST_JWT)
     metadata_knack = utils.postgrest.get_metadata(client_postgrest, APP_ID)
     app = knackpy.App(app_id=APP_ID, metadata=metadata_knack)
-    filter_iso_date_str = format_filter_date(args.date)
+    resource_id = config["socrata_resource_id"]
+
+    date = args.date
+    watermark = None
+    if args.checkpoint:
+        # read before selecting records, so records updated while this runs are
+        # published by the next run
+        watermark = utils.postgrest.get_max_updated_at(
+            client_postgrest, APP_ID, container
+        )
+        if not date:
+            date = utils.postgrest.get_checkpoint(
+                client_postgrest, SERVICE_NAME, APP_ID, container, resource_id
+            )
+            logger.info(f"Processing records updated since checkpoint: {date}")
+
+    filter_iso_date_str = format_filter_date(date)
 
     logger.info(f"Downloading records from app {APP_ID}, container {container}.")
 
-    data = client_postgrest.select(
-        "knack",
-        params={
-            "select": "record",
-            "app_id": f"eq.{APP_ID}",
-            "container_id": f"eq.{container}",
-            "updated_at": f"gte.{filter_iso_date_str}",
-        },
-        order_by="id",
+    client_socrata = utils.socrata.get_client()
+    metadata_socrata = client_socrata.get_metadata(resource_id)
+
+    if args.tombstones and (date or args.sync_state):
+        # propagate records which have been deleted from Knack. a full replace of the
+        # dataset removes them anyway
+        tombstones = utils.postgrest.select_tombstones(
+            client_postgrest,
+            APP_ID,
+            container,
+            deleted_since=filter_iso_date_str,
+            destination=resource_id if args.sync_state else None,
+        )
+        logger.info(f"Deleting {len(tombstones)} deleted records...")
+        delete_tombstoned(tombstones, resource_id, client_socrata)
+        if args.sync_state:
+            utils.postgrest.clear_synced(
+                client_postgrest,
+                APP_ID,
+                container,
+                resource_id,
+                [t["record_id"] for t in tombstones],
+            )
+
+    # only select the fields which have a matching column in socrata
+    field_keys = utils.knack.field_keys_by_name(
+        app, container, [col["fieldName"] for col in metadata_socrata["columns"]]
     )
 
+    if args.sync_state:
+        data, hashes = utils.postgrest.select_unsynced_records(
+            client_postgrest, APP_ID, container, resource_id, field_keys=field_keys
+        )
+    else:
+        data = utils.postgrest.select_records(
+            client_postgrest,
+            APP_ID,
+            container,
+            updated_since=filter_iso_date_str,
+            field_keys=field_keys,
+        )
+
     logger.info(f"{len(data)} records to process")
 
     if not data:
+        if watermark:
+            utils.postgrest.set_checkpoint(
+                client_postgrest, SERVICE_NAME, APP_ID, container, watermark, resource_id
+            )
         return
 
-    client_socrata = utils.socrata.get_client()
-    resource_id = config["socrata_resource_id"]
-    metadata_socrata = client_socrata.get_metadata(resource_id)
+    # the payload is built in the same order as the records
+    record_ids = [record["id"] for record in data]
 
     if location_field_id:
         patch_formatters(app.field_defs, location_field_id, metadata_socrata)
 
     # side-load knack data so we can utilize knackpy Record class for formatting
-    app.data[container] = [r["record"] for r in data]
+    utils.knack.fill_missing_fields(data, app, container)
+    app.data[container] = data
 
     records = app.get(container)
 
@@ -186,7 +250,7 @@ def main():
     if timestamp_key:
         utils.socrata.append_current_timestamp(payload, timestamp_key)
 
-    method = "replace" if not args.date else "upsert"
+    method = "replace" if not date and not args.sync_state else "upsert"
 
     if config.get("no_replace_socrata") and method == "replace":
         raise ValueError(
@@ -196,11 +260,31 @@ def main():
             """
         )
 
+    def mark_synced(start, stop):
+        # a chunk is marked as soon as it is published, so a retry resends only the
+        # records which were not
+        utils.postgrest.mark_synced(
+            client_postgrest,
+            APP_ID,
+            container,
+            resource_id,
+            {record_id: hashes[record_id] for record_id in record_ids[start:stop]},
+        )
+
     utils.socrata.publish(
-        method=method, resource_id=resource_id, payload=payload, client=client_socrata
+        method=method,
+        resource_id=resource_id,
+        payload=payload,
+        client=client_socrata,
+        on_chunk=mark_synced if args.sync_state else None,
     )
     logger.info(f"{len(payload)} records processed.")
 
+    if watermark:
+        utils.postgrest.set_checkpoint(
+            client_postgrest, SERVICE_NAME, APP_ID, container, watermark, resource_id
+        )
+
 
 if __name__ == "__main__":
     logger = utils.logging.getLogger(__file__)
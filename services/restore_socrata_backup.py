@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Restore a Socrata dataset backup written by backup_socrata.py in delta mode, by
+merging the most recent full snapshot with the deltas which follow it"""
+import argparse
+import csv
+import datetime
+import gzip
+import io
+import os
+
+import boto3
+
+from config.knack import CONFIG
+from backup_socrata import (
+    DELTA_FOLDER,
+    DELTA_SUFFIX,
+    FULL_SUFFIX,
+    IDS_SUFFIX,
+    list_objects,
+)
+import utils
+
+BUCKET = os.getenv("BUCKET")
+AWS_ACCESS_ID = os.getenv("AWS_ACCESS_ID")
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+STAMP_FORMAT = "%y_%m_%d_%H%M%S"
+
+
+def parse_key(key, prefix):
+    """Return the timestamp and kind (the file suffix) of a delta mode backup file"""
+    name = key[len(prefix) :]
+    for suffix in (FULL_SUFFIX, DELTA_SUFFIX, IDS_SUFFIX):
+        if name.endswith(f"_{suffix}"):
+            stamp = name[: -len(suffix) - 1]
+            return datetime.datetime.strptime(stamp, STAMP_FORMAT), suffix
+    return None, None
+
+
+def select_files(objects, prefix, as_of):
+    """Return the keys of the latest full snapshot at or before `as_of`, and of the
+    delta and id list files which follow it, in order"""
+    files = []
+    for obj in objects:
+        timestamp, kind = parse_key(obj["Key"], prefix)
+        if timestamp and timestamp <= as_of:
+            files.append((timestamp, kind, obj["Key"]))
+    files.sort()
+
+    snapshots = [i for i, (_, kind, _) in enumerate(files) if kind == FULL_SUFFIX]
+    if not snapshots:
+        raise Exception(f"No full snapshot found in {prefix} on or before {as_of}")
+    return [(kind, key) for _, kind, key in files[snapshots[-1] :]]
+
+
+def read_csv(client, key):
+    """Yield the header and then each row of a gzipped CSV in s3"""
+    body = client.get_object(Bucket=BUCKET, Key=key)["Body"]
+    with gzip.GzipFile(fileobj=body) as gz:
+        reader = csv.reader(io.TextIOWrapper(gz, encoding="utf-8", newline=""))
+        yield from reader
+
+
+def restore(client, prefix, as_of):
+    """Merge a snapshot and its deltas.
+
+    Returns:
+        tuple: the list of column names, and a dict of rows (lists) keyed by `:id`
+    """
+    columns = []
+    rows = {}
+    for kind, key in select_files(list_objects(client, prefix), prefix, as_of):
+        logger.info(f"Applying {key}")
+        reader = read_csv(client, key)
+        header = next(reader, [])
+        if kind == IDS_SUFFIX:
+            # drop rows which were deleted from the dataset
+            ids = set(row[0] for row in reader)
+            rows = {row_id: row for row_id, row in rows.items() if row_id in ids}
+            continue
+        if kind == FULL_SUFFIX:
+            rows = {}
+        # columns may have been added to the dataset since the snapshot
+        columns += [col for col in header if col not in columns]
+        id_index = header.index(":id")
+        for row in reader:
+            rows[row[id_index]] = dict(zip(header, row))
+    return columns, rows
+
+
+def main(args):
+    if args.app_name and args.container:
+        resource_id = CONFIG[args.app_name][args.container]["socrata_resource_id"]
+    elif args.dataset:
+        resource_id = args.dataset
+    else:
+        raise Exception("No Socrata resource argument supplied.")
+
+    as_of = (
+        datetime.datetime.fromisoformat(args.date)
+        if args.date
+        else datetime.datetime.now()
+    )
+    if args.date and len(args.date) == 10:
+        # a date without a time restores the backups taken at any time that day
+        as_of = as_of.replace(hour=23, minute=59, second=59)
+
+    client = boto3.client(
+        "s3",
+        aws_access_key_id=AWS_ACCESS_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    )
+    prefix = f"{resource_id.replace('-', '_')}/{DELTA_FOLDER}/"
+    columns, rows = restore(client, prefix, as_of)
+
+    if not args.system_fields:
+        columns = [col for col in columns if not col.startswith(":")]
+
+    opener = gzip.open if args.output.endswith(".gz") else open
+    with opener(args.output, "wt", newline="", encoding="utf-8") as fout:
+        writer = csv.DictWriter(fout, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows.values())
+    logger.info(f"Restored {len(rows)} rows to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-a",
+        "--app-name",
+        type=str,
+        help="str: Name of the Knack App in knack.py config file",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--container",
+        type=str,
+        help="str: AKA API view in the config.py file with the selected socrata_resource_id to restore.",
+    )
+
+    parser.add_argument(
+        "-f",
+        "--dataset",
+        type=str,
+        help="str: Alternatively to app name/container, the Socrata resource ID (AKA 4x4).",
+    )
+
+    parser.add_argument(
+        "-d",
+        "--date",
+        type=str,
+        help="str: An ISO 8601 date or datetime to restore the dataset as of. Defaults to the latest backup.",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        required=True,
+        help="str: The path of the restored CSV. It is gzipped if the path ends with .gz",
+    )
+
+    parser.add_argument(
+        "--system-fields",
+        action="store_true",
+        help="Include Socrata system fields such as :id and :updated_at in the output",
+    )
+
+    args = parser.parse_args()
+
+    logger = utils.logging.getLogger(__file__)
+
+    main(args)
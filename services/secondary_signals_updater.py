@@ -3,13 +3,14 @@
 Update traffic signal records with secondary signal relationships
 """
 import argparse
-import collections
+import json
 import os
 
+import arrow
 import knackpy
 
 from config.field_maps import SECONDARY_SIGNALS
-from config.knack import CONFIG
+from config.knack import CONFIG, APP_TIMEZONE
 import utils
 
 APP_ID = os.getenv("KNACK_APP_ID")
@@ -79,86 +80,180 @@ def get_old_prim_signals(signals, field_maps):
     return signals_with_children
 
 
-def main(args):
-    # Parse Arguments
-    app_name = args.app_name
-    container = args.container
-    logger.info(args)
+def get_primary_signal_id(signal, field_maps):
+    """Return the id of a signal's primary signal, or None"""
+    try:
+        return signal[field_maps["PRIMARY_SIGNAL"]][0]["id"]
+    except (IndexError, AttributeError, KeyError, TypeError):
+        return None
 
-    # Selecting correct config for the view
-    config = CONFIG[app_name][container]
-    field_mapping = SECONDARY_SIGNALS[app_name][container]
 
-    # Get Signals Knack Data
-    kwargs = {"scene": config["scene"], "view": container}
-    data = knackpy.api.get(app_id=APP_ID, api_key=API_KEY, **kwargs)
+def invert_parents(parents):
+    """Convert a {secondary: primary} dict to a {primary: [secondaries]} dict"""
+    signals_with_children = {}
+    for child_id, parent_id in parents.items():
+        signals_with_children.setdefault(parent_id, []).append(child_id)
+    return signals_with_children
 
-    primary_signals_old = get_old_prim_signals(data, field_mapping)
-    primary_signals_new = get_new_prim_signals(data, field_mapping)
 
+def build_payload(primary_signals_new, primary_signals_old, update_field, signal_ids):
     """
+    Compare the primary signals' secondaries from the 'primary_signal' field (new)
+    against the values in the 'secondary_signals' field (old), for the given signal
+    IDs, and return the record updates needed to bring the latter in sync.
+
     Checking for three separate cases where we need to update Knack
     1. A new secondary signal was added to a primary signal
     2. Secondary signal(s) was/were changed that are attached a primary signal
-    3. A secondary signal was removed from a primary signal 
+    3. A secondary signal was removed from a primary signal
     """
-
     payload = []
-
-    for signal_id in primary_signals_new:
-        """
-        identify new and changed primary-secondary relationships
-        """
-        if signal_id in primary_signals_old:
-            new_secondaries = collections.Counter(primary_signals_new[signal_id])
-            old_secondaries = collections.Counter(primary_signals_old[signal_id])
-
-            # Checking if things have changed
-            if old_secondaries != new_secondaries:
-                logger.info(
-                    f"Changed primary <> secondary signal relationship detected for signal {signal_id}"
-                )
-                payload.append(
-                    {
-                        "id": signal_id,
-                        field_mapping["update_field"]: primary_signals_new[signal_id],
-                    }
-                )
-
-        # Catching new primary-secondary relationship
-        else:
+    for signal_id in signal_ids:
+        new_secondaries = frozenset(primary_signals_new.get(signal_id, []))
+        old_secondaries = frozenset(primary_signals_old.get(signal_id, []))
+        if new_secondaries == old_secondaries:
+            continue
+        if not new_secondaries:
             logger.info(
-                f"New primary <> secondary signal relationship detected for signal {signal_id}"
+                f"Deleted primary <> secondary signal relationship detected for signal {signal_id}"
             )
-            payload.append(
-                {
-                    "id": signal_id,
-                    field_mapping["update_field"]: primary_signals_new[signal_id],
-                }
+        elif not old_secondaries:
+            logger.info(
+                f"New primary <> secondary signal relationship detected for signal {signal_id}"
             )
-
-    for signal_id in primary_signals_old:
-        """
-        identify primary-secondary relationships that have been removed
-        """
-        if signal_id not in primary_signals_new:
+        else:
             logger.info(
-                f"Deleted primary <> secondary signal relationship detected for signal {signal_id}"
+                f"Changed primary <> secondary signal relationship detected for signal {signal_id}"
             )
-            payload.append({"id": signal_id, field_mapping["update_field"]: []})
+        payload.append(
+            {"id": signal_id, update_field: primary_signals_new.get(signal_id, [])}
+        )
+    return payload
 
-    if len(payload) == 0:
-        logger.info("No changes detected in Knack, doing nothing.")
-        return 0
-    logger.info(payload)
-    for record in payload:
-        res = knackpy.api.record(
+
+def load_state(state_path):
+    try:
+        with open(state_path) as fin:
+            return json.load(fin)
+    except FileNotFoundError:
+        return None
+
+
+def save_state(state_path, state):
+    with open(state_path, "w") as fout:
+        json.dump(state, fout)
+
+
+def main(args):
+    # Parse Arguments
+    app_name = args.app_name
+    container = args.container
+    logger.info(args)
+
+    # Selecting correct config for the view
+    config = CONFIG[app_name][container]
+    field_mapping = SECONDARY_SIGNALS[app_name][container]
+    kwargs = {"scene": config["scene"], "view": container}
+    run_start = arrow.utcnow().isoformat()
+
+    """
+    The adjacency maps from the last run are persisted locally:
+    - parents: {secondary id: primary id}, from the 'primary_signal' field
+    - secondaries: {primary id: [secondary ids]}, the 'secondary_signals' field
+    """
+    state_path = utils.shared.cache_path(
+        f"secondary_signals_{app_name}_{container}.json"
+    )
+    state = load_state(state_path) if args.incremental else None
+
+    if state:
+        # Get only the signals modified since the last run
+        filters = utils.knack.date_filter_on_or_after(
+            state["last_run"],
+            config["modified_date_field"],
+            tzinfo=APP_TIMEZONE,
+            use_time=True,
+        )
+        data = knackpy.api.get(
+            app_id=APP_ID, api_key=API_KEY, filters=filters, **kwargs
+        )
+        logger.info(f"{len(data)} signals modified since {state['last_run']}")
+        parents = state["parents"]
+        primary_signals_old = state["secondaries"]
+        # signals whose relationships may have changed: the modified signals and
+        # their previous and current primary signals
+        signal_ids = set()
+        # signals deleted from Knack are never returned as modified, so they are
+        # pruned from the saved relationships, and their primaries are re-checked
+        record_ids = set(
+            utils.knack.get_record_ids(app_id=APP_ID, api_key=API_KEY, **kwargs)
+        )
+        deleted_ids = set(parents) | set(parents.values()) | set(primary_signals_old)
+        deleted_ids -= record_ids
+        for child_id, parent_id in list(parents.items()):
+            if child_id in deleted_ids or parent_id in deleted_ids:
+                del parents[child_id]
+                if parent_id not in deleted_ids:
+                    signal_ids.add(parent_id)
+        for signal_id in deleted_ids:
+            primary_signals_old.pop(signal_id, None)
+        if deleted_ids:
+            logger.info(f"{len(deleted_ids)} deleted signals pruned")
+        for signal in data:
+            signal_ids.add(signal["id"])
+            if signal["id"] in parents:
+                signal_ids.add(parents.pop(signal["id"]))
+            primary_signal_id = get_primary_signal_id(signal, field_mapping)
+            if primary_signal_id:
+                parents[signal["id"]] = primary_signal_id
+                signal_ids.add(primary_signal_id)
+        observed_secondaries = get_old_prim_signals(data, field_mapping)
+        for signal in data:
+            if signal["id"] in observed_secondaries:
+                primary_signals_old[signal["id"]] = observed_secondaries[signal["id"]]
+            else:
+                primary_signals_old.pop(signal["id"], None)
+    else:
+        # Get Signals Knack Data
+        data = knackpy.api.get(app_id=APP_ID, api_key=API_KEY, **kwargs)
+        parents = {
+            signal["id"]: get_primary_signal_id(signal, field_mapping)
+            for signal in data
+            if get_primary_signal_id(signal, field_mapping)
+        }
+        primary_signals_old = get_old_prim_signals(data, field_mapping)
+        signal_ids = set(invert_parents(parents)) | set(primary_signals_old)
+
+    primary_signals_new = invert_parents(parents)
+
+    payload = build_payload(
+        primary_signals_new,
+        primary_signals_old,
+        field_mapping["update_field"],
+        sorted(signal_ids),
+    )
+
+    if payload:
+        logger.info(payload)
+        utils.knack.write_records(
+            payload,
             app_id=APP_ID,
             api_key=API_KEY,
             obj=config["object"],
             method="update",
-            data=record,
         )
+        for record in payload:
+            if record[field_mapping["update_field"]]:
+                primary_signals_old[record["id"]] = record[field_mapping["update_field"]]
+            else:
+                primary_signals_old.pop(record["id"], None)
+    else:
+        logger.info("No changes detected in Knack, doing nothing.")
+
+    save_state(
+        state_path,
+        {"last_run": run_start, "parents": parents, "secondaries": primary_signals_old},
+    )
 
     return len(payload)
 
@@ -181,6 +276,12 @@ if __name__ == "__main__":
         help="str: AKA API view that was created for downloading the location data",
     )
 
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only fetch signals modified since the last run, and compare them against the relationships saved by that run",
+    )
+
     args = parser.parse_args()
 
     logger = utils.logging.getLogger(__file__)
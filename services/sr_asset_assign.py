@@ -68,6 +68,39 @@ def point_in_poly(service_name, layer_id, params):
     return res.json()
 
 
+def find_assets(layer_config, point, token, cache=None, batch=None):
+    """
+    Return the asset features near a point, either from AGOL, from the local
+    reference layer cache, or from the features fetched for a batch of points
+    """
+    if cache or batch:
+        if cache:
+            local_layer = cache.get_layer(
+                layer_config["service_name"], layer_config["layer_id"], out_sr=2277
+            )
+        else:
+            local_layer = batch.get_layer(
+                layer_config["service_name"],
+                layer_config["layer_id"],
+                distance=layer_config.get("distance"),
+                units=layer_config.get("units"),
+            )
+        features = local_layer.query(
+            point, distance=layer_config.get("distance"), units=layer_config.get("units")
+        )
+        return {"features": features}
+    params = get_params(layer_config, point, token)
+    return point_in_poly(layer_config["service_name"], layer_config["layer_id"], params)
+
+
+def get_point(record, config):
+    # knack may format number values with thousands separators
+    return [
+        float(str(record[config["x_field"]]).replace(",", "")),
+        float(str(record[config["y_field"]]).replace(",", "")),
+    ]
+
+
 def asset_filter(field, value):
     """
     Provides a filter argument for a searching for matching knack records
@@ -172,19 +205,29 @@ def main(args):
     layer = ASSET_CONFIG[args.asset]
 
     token_knack = None
+    cache = (
+        utils.agol.ReferenceLayerCache(token=token_agol) if args.use_cache else None
+    )
 
-    for record in data:
+    batch = None
+
+    for i, record in enumerate(data):
+        if args.batch_size and i % args.batch_size == 0:
+            # query the asset layer once for all of the located SRs in this batch
+            batch = utils.agol.PointBatch(
+                [
+                    get_point(r, config)
+                    for r in data[i : i + args.batch_size]
+                    if r[config["x_field"]] and r[config["y_field"]]
+                ],
+                2277,
+                token=token_agol,
+            )
         if (
             record[config["x_field"]] and record[config["y_field"]]
         ):  # ignore records that have a null location data
-            point = [
-                record[config["x_field"]],
-                record[config["y_field"]],
-            ]
-            params = get_params(layer["layer"], point, token_agol)
-            res = point_in_poly(
-                layer["layer"]["service_name"], layer["layer"]["layer_id"], params
-            )
+            point = get_point(record, config)
+            res = find_assets(layer["layer"], point, token_agol, cache, batch)
             # we have to manually check for response errors. The API returns `200` regardless
             if res.get("error"):
                 raise Exception(str(res))
@@ -247,6 +290,19 @@ if __name__ == "__main__":
         choices=["signals"],
         help="str: Name of the asset to search for potential matches",
     )
+
+    parser.add_argument(
+        "--use-cache",
+        action="store_true",
+        help="Match SRs against a local cache of the asset layer, which is only re-downloaded when the layer has been edited",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        required=False,
+        help="Query the asset layer once per batch of this many SRs, instead of once per SR",
+    )
     args = parser.parse_args()
 
     logger = utils.logging.getLogger(__file__)
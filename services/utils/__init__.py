@@ -1,10 +1,13 @@
-from . import agol, args, logging, knack, postgrest, socrata
+from . import agol, args, geometry, logging, knack, postgrest, s3, segments, socrata
 
 __all__ = [
     "agol",
     "args",
+    "geometry",
     "logging",
     "knack",
     "postgrest",
+    "s3",
+    "segments",
     "socrata",
 ]
@@ -1,4 +1,14 @@
-from . import shared
+import json
+import sqlite3
+import threading
+import zlib
+
+import requests
+
+from . import geometry, shared
+
+# the City of Austin's ArcGIS Online organization
+SERVICES_URL = "https://services.arcgis.com/0L95CJ0VTaxqcmED/ArcGIS/rest/services"
 
 
 def sanitize_html(record, field_names):
@@ -83,3 +93,201 @@ def handle_response(response):
                 else:
                     raise ValueError(feature_status["error"])
     return
+
+
+def layer_url(service_name, layer_id):
+    return f"{SERVICES_URL}/{service_name}/FeatureServer/{layer_id}"
+
+
+def get_layer_info(service_name, layer_id, token=None):
+    """Fetch a feature layer's definition, which includes its
+    `editingInfo.lastEditDate`"""
+    params = {"f": "json", "token": token}
+    res = requests.get(layer_url(service_name, layer_id), params=params)
+    res.raise_for_status()
+    info = res.json()
+    # AGOL returns code 200 even for errors
+    if info.get("error"):
+        raise Exception(str(info))
+    return info
+
+
+def query_all_features(service_name, layer_id, params, token=None):
+    """Query a feature layer, paging with `resultOffset` until every matching
+    feature has been fetched.
+
+    Args:
+        service_name (str): the feature service name
+        layer_id (int): the layer ID within the feature service
+        params (dict): query request params. Geometry params must be JSON-encoded.
+        token (str, optional): an AGOL auth token
+
+    Returns:
+        list: Esri JSON feature dicts
+    """
+    url = f"{layer_url(service_name, layer_id)}/query"
+    params = {
+        "f": "json",
+        "where": "1=1",
+        "outFields": "*",
+        "returnGeometry": True,
+        **params,
+        "token": token,
+    }
+    features = []
+    while True:
+        params["resultOffset"] = len(features)
+        # post, because geometry and where params may exceed url length limits
+        res = requests.post(url, data=params)
+        res.raise_for_status()
+        data = res.json()
+        if data.get("error"):
+            raise Exception(str(data))
+        page = data.get("features", [])
+        features += page
+        if not page or not data.get("exceededTransferLimit"):
+            return features
+
+
+def query_features_near_points(
+    service_name,
+    layer_id,
+    points,
+    spatial_reference,
+    token=None,
+    distance=None,
+    units=None,
+):
+    """Fetch every feature which intersects any of the given points (optionally
+    buffered by a distance) with a single, paged, multipoint query.
+
+    Args:
+        service_name (str): the feature service name
+        layer_id (int): the layer ID within the feature service
+        points (list): a list of [x, y] coordinate pairs
+        spatial_reference (int): the wkid of the points. Features are returned in
+            this spatial reference.
+        token (str, optional): an AGOL auth token
+        distance (float, optional): the buffer distance
+        units (str, optional): the esriSRUnit of the buffer distance
+
+    Returns:
+        geometry.LocalLayer: the features, which can be matched to each point locally
+    """
+    multipoint = {"points": points, "spatialReference": {"wkid": spatial_reference}}
+    params = {
+        "geometry": json.dumps(multipoint),
+        "geometryType": "esriGeometryMultipoint",
+        "spatialRel": "esriSpatialRelIntersects",
+        "inSR": spatial_reference,
+        "outSR": spatial_reference,
+        "distance": distance,
+        "units": units,
+    }
+    features = query_all_features(service_name, layer_id, params, token=token)
+    return geometry.LocalLayer(features, spatial_reference)
+
+
+class PointBatch(object):
+    """A batch of points whose features are fetched with one multipoint query per
+    layer, rather than one query per point"""
+
+    def __init__(self, points, spatial_reference, token=None):
+        self.points = points
+        self.spatial_reference = spatial_reference
+        self.token = token
+        self.query_count = 0
+        self._layers = {}
+        self._lock = threading.Lock()
+
+    def get_layer(self, service_name, layer_id, distance=None, units=None):
+        """Return the layer's features near any point in the batch as a
+        `geometry.LocalLayer`. The layer is queried on first use."""
+        key = (service_name, layer_id, distance, units)
+        with self._lock:
+            if key not in self._layers:
+                self._layers[key] = query_features_near_points(
+                    service_name,
+                    layer_id,
+                    self.points,
+                    self.spatial_reference,
+                    token=self.token,
+                    distance=distance,
+                    units=units,
+                )
+                self.query_count += 1
+            return self._layers[key]
+
+
+class ReferenceLayerCache(object):
+    """An on-disk cache of AGOL reference layers, such as council districts.
+
+    Layer features are stored in a local SQLite database, keyed by service name,
+    layer ID and output spatial reference. A cached layer is re-used for as long as
+    the layer's `lastEditDate` is unchanged, so a run only downloads the layers which
+    have actually been edited.
+    """
+
+    def __init__(self, path=None, token=None):
+        self.path = path or shared.cache_path("agol_reference_layers.sqlite")
+        self.token = token
+        self.downloaded = []
+        self._layers = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            """create table if not exists layers (
+                service_name text not null,
+                layer_id integer not null,
+                out_sr integer not null,
+                last_edit_date integer,
+                features blob not null,
+                primary key (service_name, layer_id, out_sr)
+            )"""
+        )
+
+    def _read(self, key):
+        return self._conn.execute(
+            """select last_edit_date, features from layers
+            where service_name = ? and layer_id = ? and out_sr = ?""",
+            key,
+        ).fetchone()
+
+    def _write(self, key, last_edit_date, features):
+        blob = zlib.compress(json.dumps(features, separators=(",", ":")).encode())
+        with self._conn:
+            self._conn.execute(
+                "insert or replace into layers values (?, ?, ?, ?, ?)",
+                (*key, last_edit_date, blob),
+            )
+
+    def get_layer(self, service_name, layer_id, out_sr=4326):
+        """Return a layer's features as a `geometry.LocalLayer`, downloading them
+        only if the layer has been edited since it was cached.
+
+        Args:
+            service_name (str): the feature service name
+            layer_id (int): the layer ID within the feature service
+            out_sr (int, optional): the spatial reference of the features. Defaults
+                to 4326.
+
+        Returns:
+            geometry.LocalLayer: the layer's features
+        """
+        key = (service_name, layer_id, out_sr)
+        with self._lock:
+            if key in self._layers:
+                return self._layers[key]
+            info = get_layer_info(service_name, layer_id, token=self.token)
+            last_edit_date = info.get("editingInfo", {}).get("lastEditDate")
+            row = self._read(key)
+            if row and last_edit_date and row[0] == last_edit_date:
+                features = json.loads(zlib.decompress(row[1]))
+            else:
+                features = query_all_features(
+                    service_name, layer_id, {"outSR": out_sr}, token=self.token
+                )
+                self._write(key, last_edit_date, features)
+                self.downloaded.append(service_name)
+            self._layers[key] = geometry.LocalLayer(features, out_sr)
+            return self._layers[key]
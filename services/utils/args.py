@@ -33,6 +33,26 @@ ARG_DEFS = {
         "required": False,
         "help": "The name of the destination Knack app. Required for publishing between Knack apps."
     },
+    "dedupe": {
+        "action": "store_true",
+        "required": False,
+        "help": "Store each distinct record body once, keyed by its content hash",
+    },
+    "checkpoint": {
+        "action": "store_true",
+        "required": False,
+        "help": "Process the records modified since this service's last successful run, and advance its checkpoint. An explicit --date takes precedence over the stored checkpoint.",
+    },
+    "sync-state": {
+        "action": "store_true",
+        "required": False,
+        "help": "Publish only the records which have changed since they were last published to this destination. --date is ignored.",
+    },
+    "tombstones": {
+        "action": "store_true",
+        "required": False,
+        "help": "Propagate records which have been deleted from the Knack container, using the knack_tombstones table",
+    },
 }
 
 
@@ -49,5 +69,6 @@ def cli_args(arg_names):
     parser = argparse.ArgumentParser()
     for name in arg_names:
         flag = ARG_DEFS[name].pop("flag", None)
-        parser.add_argument(f"--{name}", flag, **ARG_DEFS[name])
+        flags = [f"--{name}", flag] if flag else [f"--{name}"]
+        parser.add_argument(*flags, **ARG_DEFS[name])
     return parser.parse_args()
@@ -0,0 +1,199 @@
+"""Planar geometry helpers for evaluating ArcGIS spatial queries locally.
+
+These are approximations of ArcGIS Online's `esriSpatialRelIntersects` relationship
+(optionally with a `distance` buffer), accurate enough for matching points to city
+boundaries and nearby assets. Geometries are Esri JSON dicts, see:
+https://developers.arcgis.com/documentation/common-data-types/geometry-objects.htm
+"""
+import math
+
+# approximate length of one degree of latitude, in meters
+METERS_PER_DEGREE = 111319.49
+
+METERS_PER_UNIT = {
+    "esriSRUnit_Meter": 1,
+    "esriSRUnit_Foot": 0.3048,
+    "esriSRUnit_SurveyFoot": 1200 / 3937,
+    "esriSRUnit_Kilometer": 1000,
+    "esriSRUnit_StatuteMile": 1609.344,
+}
+
+# the linear unit (in meters) of the projected spatial references we work with
+METERS_PER_SR_UNIT = {
+    # NAD83 / Texas Central (ftUS)
+    2277: 1200 / 3937,
+    102739: 1200 / 3937,
+}
+
+GEOGRAPHIC_SRS = [4326]
+
+
+def distance_in_meters(distance, units):
+    """Convert an AGOL query `distance` and `units` pair to meters"""
+    if not distance:
+        return 0
+    try:
+        return distance * METERS_PER_UNIT[units or "esriSRUnit_Meter"]
+    except KeyError:
+        raise ValueError(f"Unsupported distance units: {units}")
+
+
+def projector(origin, spatial_reference):
+    """Return a function which projects x/y coordinates to meters relative to the
+    `origin` point. Geographic coordinates are handled with an equirectangular
+    approximation, which is plenty accurate at the scale of a city."""
+    x0, y0 = origin
+    if spatial_reference in GEOGRAPHIC_SRS:
+        scale_x = METERS_PER_DEGREE * math.cos(math.radians(y0))
+        scale_y = METERS_PER_DEGREE
+    else:
+        try:
+            scale_x = scale_y = METERS_PER_SR_UNIT[spatial_reference]
+        except KeyError:
+            raise ValueError(f"Unsupported spatial reference: {spatial_reference}")
+
+    def project(x, y):
+        return (x - x0) * scale_x, (y - y0) * scale_y
+
+    return project
+
+
+def point_in_rings(x, y, rings):
+    """Ray-casting point-in-polygon test. Uses the even-odd rule across all rings,
+    so interior rings (holes) are handled without regard to ring orientation."""
+    inside = False
+    for ring in rings:
+        j = len(ring) - 1
+        for i in range(len(ring)):
+            xi, yi = ring[i][0], ring[i][1]
+            xj, yj = ring[j][0], ring[j][1]
+            if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+                inside = not inside
+            j = i
+    return inside
+
+
+def distance_to_segment(px, py, ax, ay, bx, by):
+    dx = bx - ax
+    dy = by - ay
+    if dx == 0 and dy == 0:
+        return math.hypot(px - ax, py - ay)
+    t = ((px - ax) * dx + (py - ay) * dy) / (dx * dx + dy * dy)
+    t = max(0, min(1, t))
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+
+def distance_to_paths(x, y, paths):
+    distance = math.inf
+    for path in paths:
+        if len(path) == 1:
+            distance = min(distance, math.hypot(x - path[0][0], y - path[0][1]))
+        for a, b in zip(path, path[1:]):
+            distance = min(distance, distance_to_segment(x, y, a[0], a[1], b[0], b[1]))
+    return distance
+
+
+def distance_to_geometry(point, geometry, spatial_reference):
+    """Return the distance in meters between a point ([x, y]) and an Esri JSON
+    geometry. Zero is returned if the point falls within a polygon.
+
+    Args:
+        point (list): an [x, y] coordinate pair
+        geometry (dict): an Esri JSON point, multipoint, polyline, or polygon
+        spatial_reference (int): the wkid of both the point and the geometry
+
+    Returns:
+        float: the distance in meters
+    """
+    project = projector(point, spatial_reference)
+
+    def project_paths(paths):
+        return [[project(v[0], v[1]) for v in path] for path in paths]
+
+    if "x" in geometry:
+        x, y = project(geometry["x"], geometry["y"])
+        return math.hypot(x, y)
+    elif "points" in geometry:
+        return min(
+            (math.hypot(*project(p[0], p[1])) for p in geometry["points"]),
+            default=math.inf,
+        )
+    elif "paths" in geometry:
+        return distance_to_paths(0, 0, project_paths(geometry["paths"]))
+    elif "rings" in geometry:
+        rings = project_paths(geometry["rings"])
+        if point_in_rings(0, 0, rings):
+            return 0
+        return distance_to_paths(0, 0, rings)
+    raise ValueError(f"Unsupported geometry: {list(geometry.keys())}")
+
+
+def extent(geometry):
+    """Return the (xmin, ymin, xmax, ymax) bounding box of an Esri JSON geometry"""
+    if "x" in geometry:
+        return geometry["x"], geometry["y"], geometry["x"], geometry["y"]
+    vertices = geometry.get("points") or [
+        vertex
+        for part in geometry.get("paths") or geometry.get("rings") or []
+        for vertex in part
+    ]
+    if not vertices:
+        return None
+    xs = [v[0] for v in vertices]
+    ys = [v[1] for v in vertices]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+class LocalLayer(object):
+    """A set of features which can be queried in-memory as an AGOL layer would be
+    queried with a point geometry and `esriSpatialRelIntersects`"""
+
+    def __init__(self, features, spatial_reference):
+        self.features = features
+        self.spatial_reference = spatial_reference
+        self.extents = [
+            extent(f["geometry"]) if f.get("geometry") else None for f in features
+        ]
+
+    def _buffer_in_sr_units(self, point, meters):
+        """Return the x and y buffer distances in the layer's coordinate units"""
+        if self.spatial_reference in GEOGRAPHIC_SRS:
+            y_buffer = meters / METERS_PER_DEGREE
+            x_buffer = y_buffer / max(math.cos(math.radians(point[1])), 0.01)
+            return x_buffer, y_buffer
+        buffer = meters / METERS_PER_SR_UNIT[self.spatial_reference]
+        return buffer, buffer
+
+    def query(self, point, distance=None, units=None):
+        """Return the features which intersect a point, optionally buffered.
+
+        Args:
+            point (list): an [x, y] coordinate pair in the layer's spatial reference
+            distance (float, optional): the buffer distance
+            units (str, optional): the esriSRUnit of the buffer distance. Meters
+                are assumed if not provided.
+
+        Returns:
+            list: the matching features, in layer order
+        """
+        x, y = float(point[0]), float(point[1])
+        meters = distance_in_meters(distance, units)
+        x_buffer, y_buffer = self._buffer_in_sr_units((x, y), meters)
+        matched = []
+        for feature, bbox in zip(self.features, self.extents):
+            if not bbox:
+                continue
+            xmin, ymin, xmax, ymax = bbox
+            if (
+                x < xmin - x_buffer
+                or x > xmax + x_buffer
+                or y < ymin - y_buffer
+                or y > ymax + y_buffer
+            ):
+                continue
+            dist = distance_to_geometry(
+                (x, y), feature["geometry"], self.spatial_reference
+            )
+            if dist <= meters:
+                matched.append(feature)
+        return matched
@@ -1,4 +1,17 @@
+from multiprocessing.dummy import Pool
+import threading
+import time
+
 import arrow
+import knackpy
+import requests
+
+from . import shared
+
+# the Knack API allows roughly 10 requests per second
+KNACK_RATE_LIMIT = 8
+KNACK_API_URL = "https://api.knack.com/v1"
+MAX_ROWS_PER_PAGE = 1000
 
 
 def socrata_formatter_location(value):
@@ -59,3 +72,148 @@ def date_filter_on_or_after(timestamp, date_field, tzinfo="US/Central", use_time
             {"field": f"{date_field}", "operator": "is after", "value": f"{date_str}"},
         ],
     }
+
+
+def container_field_defs(app, container):
+    """Return the knackpy field defs of the fields in an object or view"""
+    return [f for f in app.field_defs if f.obj == container or container in f.views]
+
+
+def field_keys_by_name(app, container, field_names):
+    """Return the keys, and raw keys, of a container's fields whose formatted names
+    (see shared.format_keys) are in `field_names`, for selecting only those fields from
+    Postgres. The record `id` is always included."""
+    field_names = [name.lower() for name in field_names]
+    keys = ["id"]
+    for field_def in container_field_defs(app, container):
+        if shared.format_key(field_def.name) in field_names:
+            keys += [field_def.key, f"{field_def.key}_raw"]
+    return keys
+
+
+def fill_missing_fields(records, app, container):
+    """Prepare records with a subset of fields for knackpy, which expects every field
+    of the container to be present.
+
+    Null `_raw` keys are removed, since Postgres returns null for keys which are
+    missing from a record and knackpy prefers the raw key when it is present. Fields
+    which were not selected are set to None.
+
+    Returns:
+        None: records are updated in-place
+    """
+    keys = [field_def.key for field_def in container_field_defs(app, container)]
+    for record in records:
+        for key in [k for k, v in record.items() if v is None and k.endswith("_raw")]:
+            record.pop(key)
+        for key in keys:
+            record.setdefault(key, None)
+
+
+def _get_page(url, headers, params, timeout, max_attempts, limiter):
+    """GET a page of records, retrying timeouts, connection errors and 5xx errors"""
+    attempts = 0
+    while True:
+        attempts += 1
+        limiter.wait()
+        try:
+            res = requests.get(url, headers=headers, params=params, timeout=timeout)
+            res.raise_for_status()
+            return res.json()
+        except requests.exceptions.RequestException as e:
+            response = getattr(e, "response", None)
+            if response is not None and response.status_code < 500:
+                raise
+            if attempts >= max_attempts:
+                raise
+            time.sleep(attempts)
+
+
+def get_record_ids(
+    *,
+    app_id,
+    api_key,
+    obj=None,
+    scene=None,
+    view=None,
+    timeout=30,
+    max_attempts=5,
+    rate=KNACK_RATE_LIMIT,
+):
+    """Return the IDs of every record in a Knack object or view.
+
+    The Knack API cannot select fields, so records are requested in raw format only
+    (without the formatted copy of each field) and all but their IDs are discarded
+    page by page. Requests are retried like knackpy's, and made under a rate limit.
+    An exception is raised if fewer IDs are returned than Knack reports records."""
+    if obj:
+        url = f"{KNACK_API_URL}/objects/{obj}/records"
+    else:
+        url = f"{KNACK_API_URL}/pages/{scene}/views/{view}/records"
+    headers = {"X-Knack-Application-Id": app_id, "X-Knack-REST-API-KEY": api_key}
+    limiter = RateLimiter(rate)
+    record_ids = []
+    page = 1
+    while True:
+        params = {"page": page, "rows_per_page": MAX_ROWS_PER_PAGE, "format": "raw"}
+        data = _get_page(url, headers, params, timeout, max_attempts, limiter)
+        record_ids += [record["id"] for record in data["records"]]
+        if not data["records"] or page >= int(data.get("total_pages") or 0):
+            break
+        page += 1
+
+    total_records = int(data.get("total_records") or 0)
+    if len(set(record_ids)) < total_records:
+        raise Exception(
+            f"Only {len(record_ids)} of {total_records} record IDs were returned"
+        )
+    return record_ids
+
+
+class RateLimiter(object):
+    """Spaces out calls to `wait()` so that, across all threads, no more than `rate`
+    calls proceed per second"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def write_records(
+    records, *, app_id, api_key, obj, method, workers=4, rate=KNACK_RATE_LIMIT
+):
+    """Create, update, or delete Knack records concurrently, under a rate limit.
+
+    Args:
+        records (list): Knack record dicts. Each must include an `id` unless creating
+        app_id (str): the Knack app ID
+        api_key (str): the Knack API key
+        obj (str): the Knack object key which holds the records
+        method (str): one of `create`, `update`, or `delete`
+        workers (int, optional): the number of concurrent requests. Defaults to 4.
+        rate (float, optional): the maximum number of requests per second.
+
+    Returns:
+        list: the Knack API response for each record, in order
+    """
+    if not records:
+        return []
+    limiter = RateLimiter(rate)
+
+    def write(record):
+        limiter.wait()
+        return knackpy.api.record(
+            app_id=app_id, api_key=api_key, obj=obj, method=method, data=record
+        )
+
+    with Pool(processes=workers) as pool:
+        return pool.map(write, records)
@@ -1,20 +1,387 @@
 from copy import deepcopy
+import glob
 import json
 import math
+import os
 
 import requests
 
+from . import shared
+
+# in-process cache of app metadata, keyed by (app_id, version_hash)
+_METADATA_CACHE = {}
+SYNC_STATE_CHUNK_SIZE = 1000
+# unsynced records are selected in pages of this many rows
+SYNC_STATE_PAGE_SIZE = 1000
+# record IDs are sent in the URL when deleting sync state
+SYNC_STATE_DELETE_CHUNK_SIZE = 200
+
+
+def metadata_version_hash(metadata):
+    """Return a sha256 hex digest of an app's metadata. See shared.json_hash"""
+    return shared.json_hash(metadata)
+
+
+def _field_set(fields):
+    """The attributes of a container's fields which determine how records are
+    formatted"""
+    return sorted(
+        [field.get("key"), field.get("name"), field.get("type"), field.get("format")]
+        for field in fields
+    )
+
+
+def container_fingerprints(metadata):
+    """Return a dict of sha256 fingerprints of the field set of each object and view in
+    an app's metadata, keyed by container key. A view's fingerprint also covers its
+    source object's fields."""
+    application = metadata["application"]
+    object_fields = {}
+    fingerprints = {}
+    for obj in application.get("objects", []):
+        object_fields[obj["key"]] = _field_set(obj.get("fields", []))
+        fingerprints[obj["key"]] = metadata_version_hash(object_fields[obj["key"]])
+    for scene in application.get("scenes", []):
+        for view in scene.get("views", []):
+            source_object = (view.get("source") or {}).get("object")
+            fingerprints[view["key"]] = metadata_version_hash(
+                {"fields": object_fields.get(source_object), "view": view}
+            )
+    return fingerprints
+
+
+def get_container_fingerprint(client, app_id, container):
+    """Fetch the stored field-set fingerprint of a single object or view, without
+    downloading the app's metadata. Returns None if there is none.
+
+    Consumers can compare this value to one saved alongside any transforms compiled
+    from the metadata to decide whether they need to be rebuilt."""
+    try:
+        results = client.select(
+            "knack_metadata",
+            params={
+                "app_id": f"eq.{app_id}",
+                "select": f"fingerprint:container_fingerprints->>{container}",
+                "limit": 1,
+            },
+            pagination=False,
+        )
+    except requests.exceptions.HTTPError:
+        # the container_fingerprints column does not exist until migration 008
+        return None
+    return results[0]["fingerprint"] if results else None
+
+
+def get_version_hash(client, app_id):
+    """Fetch the stored version hash of an app's metadata, or None if there is none"""
+    results = client.select(
+        "knack_metadata",
+        params={"app_id": f"eq.{app_id}", "select": "version_hash", "limit": 1},
+        pagination=False,
+    )
+    return results[0].get("version_hash") if results else None
+
+
+def _metadata_cache_path(app_id, version_hash):
+    return shared.cache_path(f"knack_metadata_{app_id}_{version_hash}.json")
+
+
+def cache_metadata(app_id, version_hash, metadata):
+    """Save an app's metadata to the in-process and on-disk caches, removing any
+    cached files of previous versions"""
+    _METADATA_CACHE[(app_id, version_hash)] = metadata
+    path = _metadata_cache_path(app_id, version_hash)
+    for stale_path in glob.glob(_metadata_cache_path(app_id, "*")):
+        if stale_path != path:
+            os.remove(stale_path)
+    # write to a temp file and rename, so concurrent readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as fout:
+        json.dump(metadata, fout)
+    os.replace(tmp_path, path)
+
+
+def _read_cached_metadata(app_id, version_hash):
+    metadata = _METADATA_CACHE.get((app_id, version_hash))
+    if metadata is not None:
+        return metadata
+    try:
+        with open(_metadata_cache_path(app_id, version_hash), "r") as fin:
+            metadata = json.load(fin)
+    except (OSError, ValueError):
+        return None
+    _METADATA_CACHE[(app_id, version_hash)] = metadata
+    return metadata
+
 
 def get_metadata(client, app_id):
-    """A helper func which fetches an app's metadata based on the provided app_id str"""
+    """A helper func which fetches an app's metadata based on the provided app_id str.
+
+    Only the metadata's `version_hash` is fetched from Postgres if that version is
+    already in the in-process or on-disk cache (see `KNACK_SERVICES_CACHE_DIR`)."""
+    try:
+        version_hash = get_version_hash(client, app_id)
+    except requests.exceptions.HTTPError:
+        # the version_hash column does not exist until migration 008 is applied
+        version_hash = None
+    if version_hash:
+        metadata = _read_cached_metadata(app_id, version_hash)
+        if metadata is not None:
+            return metadata
     results = client.select(
         "knack_metadata",
-        params={"app_id": f"eq.{app_id}", "limit": 1},
+        params={"app_id": f"eq.{app_id}", "select": "metadata", "limit": 1},
+        pagination=False,
+    )
+    if not results:
+        return None
+    metadata = results[0]["metadata"]
+    # the hash is recomputed rather than trusting the row, in case the row was
+    # updated between the two requests
+    cache_metadata(app_id, metadata_version_hash(metadata), metadata)
+    return metadata
+
+
+def select_records(client, app_id, container, updated_since=None, field_keys=None):
+    """Fetch the Knack records of a container, ordered by id.
+
+    Args:
+        client (Postgrest): a Postgrest client
+        app_id (str): the Knack app ID
+        container (str): the object or view key
+        updated_since (str, optional): an ISO date string. Only records updated at or
+            after this date are returned.
+        field_keys (list, optional): the record keys to select. Only these keys are
+            sent by the server (keys missing from a record are returned as None). If
+            not provided, entire records are returned.
+
+    Returns:
+        list: a list of Knack record dicts
+    """
+    params = {"app_id": f"eq.{app_id}", "container_id": f"eq.{container}"}
+    if updated_since:
+        params["updated_at"] = f"gte.{updated_since}"
+    if field_keys:
+        # de-duplicate keys, preserving order
+        field_keys = list(dict.fromkeys(field_keys))
+        params["select"] = ",".join(f"{key}:record->{key}" for key in field_keys)
+    else:
+        params["select"] = "record"
+    # the knack_records view resolves records whose body is stored by hash
+    data = client.select("knack_records", params=params, order_by="id")
+    return data if field_keys else [r["record"] for r in data]
+
+
+def delete_orphaned_bodies(client, grace="1 hour"):
+    """Delete the record bodies which no record references. Returns the number of
+    bodies deleted.
+
+    Bodies written within the `grace` interval are kept, because a concurrent load
+    may have written them but not yet upserted the records which reference them."""
+    return client.rpc("delete_orphaned_knack_record_bodies", {"grace": grace})
+
+
+def select_unsynced_records(client, app_id, container, destination, field_keys=None):
+    """Fetch the Knack records of a container which have changed since they were last
+    published to `destination`, or which have never been published to it, ordered by
+    id.
+
+    Args:
+        client (Postgrest): a Postgrest client
+        app_id (str): the Knack app ID
+        container (str): the object or view key
+        destination (str): the destination's identifier, e.g. a Socrata resource ID
+        field_keys (list, optional): the record keys to select. See `select_records`.
+
+    Returns:
+        tuple: a list of Knack record dicts, and a dict of the current hash of each
+            record, keyed by record ID, to pass to `mark_synced` once published
+    """
+    params = {"app_id": app_id, "container_id": container, "destination": destination}
+    if field_keys:
+        field_keys = list(dict.fromkeys(field_keys))
+        select = [f"{key}:record->{key}" for key in field_keys]
+    else:
+        select = ["record"]
+    params["select"] = ",".join(
+        select + ["_id:id", "_record_id:record_id", "_sync_hash:sync_hash"]
+    )
+    params["max_rows"] = SYNC_STATE_PAGE_SIZE
+    data = []
+    after_id = 0
+    while True:
+        # paged by id, because each offset page would re-run the function
+        params["after_id"] = after_id
+        page = client.select(
+            "rpc/select_unsynced_knack_records",
+            params=params,
+            pagination=False,
+            order_by="id",
+        )
+        if not page:
+            break
+        data += page
+        after_id = page[-1]["_id"]
+    for row in data:
+        row.pop("_id")
+    hashes = {row.pop("_record_id"): row.pop("_sync_hash") for row in data}
+    return (data if field_keys else [r["record"] for r in data]), hashes
+
+
+def mark_synced(client, app_id, container, destination, hashes):
+    """Record the hashes of records which have been published to `destination`
+
+    Args:
+        client (Postgrest): a Postgrest client
+        app_id (str): the Knack app ID
+        container (str): the object or view key
+        destination (str): the destination's identifier, e.g. a Socrata resource ID
+        hashes (dict): the hash of each published record, keyed by record ID, as
+            returned by `select_unsynced_records`
+    """
+    payload = [
+        {
+            "app_id": app_id,
+            "container_id": container,
+            "destination": destination,
+            "record_id": record_id,
+            "sync_hash": sync_hash,
+        }
+        for record_id, sync_hash in hashes.items()
+    ]
+    for i in range(0, len(payload), SYNC_STATE_CHUNK_SIZE):
+        client.upsert("knack_sync_state", payload[i : i + SYNC_STATE_CHUNK_SIZE])
+
+
+def tombstone_records(client, app_id, container, record_ids, max_fraction=0.25):
+    """Move the records of a container which are not in `record_ids` from the knack
+    table to the knack_tombstones table. Returns the number of records tombstoned.
+
+    `record_ids` must be the IDs of every record in the container, e.g. from
+    `utils.knack.get_record_ids`. As a guard against an incomplete list, nothing is
+    tombstoned and None is returned if more than `max_fraction` of the container's
+    records (and more than 10) would be tombstoned."""
+    return client.rpc(
+        "tombstone_knack_records",
+        {
+            "app_id": app_id,
+            "container_id": container,
+            "record_ids": record_ids,
+            "max_fraction": max_fraction,
+        },
+    )
+
+
+def select_tombstones(client, app_id, container, deleted_since=None, destination=None):
+    """Fetch the tombstones of a container's deleted records, ordered by record ID.
+
+    Args:
+        client (Postgrest): a Postgrest client
+        app_id (str): the Knack app ID
+        container (str): the object or view key
+        deleted_since (str, optional): an ISO date string. Only records deleted at or
+            after this date are returned.
+        destination (str, optional): a destination's identifier. If provided, only
+            the records which are still published to the destination according to
+            its sync state are returned, and `deleted_since` is ignored. Pass their
+            record IDs to `clear_synced` once they are deleted from the destination.
+
+    Returns:
+        list: a list of dicts with the `record_id` and last `record` of each deleted
+            record
+    """
+    if destination:
+        params = {
+            "app_id": app_id,
+            "container_id": container,
+            "destination": destination,
+        }
+        resource = "rpc/select_unsynced_knack_tombstones"
+    else:
+        params = {"app_id": f"eq.{app_id}", "container_id": f"eq.{container}"}
+        if deleted_since:
+            params["deleted_at"] = f"gte.{deleted_since}"
+        resource = "knack_tombstones"
+    params["select"] = "record_id,record"
+    return client.select(resource, params=params, order_by="record_id")
+
+
+def clear_synced(client, app_id, container, destination, record_ids):
+    """Remove the sync state of records which have been deleted from `destination`"""
+    for i in range(0, len(record_ids), SYNC_STATE_DELETE_CHUNK_SIZE):
+        chunk = record_ids[i : i + SYNC_STATE_DELETE_CHUNK_SIZE]
+        client.delete(
+            "knack_sync_state",
+            params={
+                "app_id": f"eq.{app_id}",
+                "container_id": f"eq.{container}",
+                "destination": f"eq.{destination}",
+                "record_id": f"in.({','.join(chunk)})",
+            },
+        )
+
+
+def get_max_updated_at(client, app_id, container):
+    """Fetch the latest `updated_at` of a container's records, or None if it has none.
+
+    Publishers read this before selecting records and store it as their checkpoint,
+    so that records updated while they run are picked up by the next run."""
+    results = client.select(
+        "knack",
+        params={
+            "select": "updated_at",
+            "app_id": f"eq.{app_id}",
+            "container_id": f"eq.{container}",
+            "limit": 1,
+        },
+        pagination=False,
+        order_by="updated_at.desc",
+    )
+    return results[0]["updated_at"] if results else None
+
+
+def get_checkpoint(client, service, app_id, container, destination=""):
+    """Fetch the watermark of a service's last successful run, or None if it has none
+
+    Args:
+        client (Postgrest): a Postgrest client
+        service (str): the name of the service, e.g. "records_to_socrata"
+        app_id (str): the Knack app ID
+        container (str): the object or view key
+        destination (str, optional): the destination the service publishes to, for
+            services which publish a container to more than one place
+
+    Returns:
+        str: an ISO timestamp, or None
+    """
+    results = client.select(
+        "knack_checkpoints",
+        params={
+            "select": "watermark",
+            "service": f"eq.{service}",
+            "app_id": f"eq.{app_id}",
+            "container_id": f"eq.{container}",
+            "destination": f"eq.{destination}",
+            "limit": 1,
+        },
         pagination=False,
     )
-    if results:
-        return results[0]["metadata"]
-    return None
+    return results[0]["watermark"] if results else None
+
+
+def set_checkpoint(client, service, app_id, container, watermark, destination=""):
+    """Advance a service's checkpoint to `watermark`. The checkpoint is left as is if
+    it is already later than `watermark`. Returns the stored watermark."""
+    return client.rpc(
+        "advance_knack_checkpoint",
+        {
+            "service": service,
+            "app_id": app_id,
+            "container_id": container,
+            "destination": destination,
+            "watermark": watermark,
+        },
+    )
 
 
 class Postgrest(object):
@@ -73,6 +440,14 @@ class Postgrest(object):
             resource=resource, method="post", headers=headers, data=data
         )
 
+    def rpc(self, function, data=None, headers=None):
+        """Call a Postgres function exposed by PostgREST, passing `data` as its named
+        arguments"""
+        headers = self._get_request_headers(headers)
+        return self._make_request(
+            resource=f"rpc/{function}", method="post", headers=headers, data=data or {}
+        )
+
     def delete(self, resource, params=None, headers=None):
         """This method is dangerous! It is possible to delete and modify records
         en masse. Read the PostgREST docs."""
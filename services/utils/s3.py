@@ -0,0 +1,96 @@
+"""Helpers for streaming uploads to AWS S3"""
+
+# S3 requires every part of a multipart upload except the last to be at least 5MB
+PART_SIZE = 8 * 1024 * 1024
+
+
+class S3MultipartWriter(object):
+    """A writable file-like object which uploads to an S3 key in parts, so that only
+    one part is held in memory at a time.
+
+    Call `close()` to complete the upload. If an exception is raised within a `with`
+    block, the upload is aborted and no object is created.
+
+    Args:
+        client (botocore.client.S3): a boto3 S3 client
+        bucket (str): the destination bucket name
+        key (str): the destination object key
+        part_size (int, optional): the number of bytes per uploaded part. Defaults
+            to PART_SIZE.
+        metadata (dict, optional): user-defined metadata to store with the object
+    """
+
+    def __init__(self, client, bucket, key, part_size=PART_SIZE, metadata=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._parts = []
+        self._upload_id = self.client.create_multipart_upload(
+            Bucket=bucket, Key=key, Metadata=metadata or {}
+        )["UploadId"]
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def _upload_part(self, body):
+        part_number = len(self._parts) + 1
+        res = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self._upload_id,
+            Body=body,
+        )
+        self._parts.append({"ETag": res["ETag"], "PartNumber": part_number})
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed S3MultipartWriter")
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[: self.part_size]))
+            del self._buffer[: self.part_size]
+        return len(data)
+
+    def tell(self):
+        return self.bytes_written
+
+    def flush(self):
+        # parts are uploaded as they fill, and the remainder on close()
+        pass
+
+    def close(self):
+        """Upload any buffered data and complete the multipart upload"""
+        if self.closed:
+            return
+        if self._buffer or not self._parts:
+            # an upload must have at least one part, even if it is empty
+            self._upload_part(bytes(self._buffer))
+            self._buffer = bytearray()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": self._parts},
+        )
+        self.closed = True
+
+    def abort(self):
+        """Abort the multipart upload, discarding any uploaded parts"""
+        if self.closed:
+            return
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+        )
+        self.closed = True
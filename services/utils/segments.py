@@ -0,0 +1,188 @@
+"""A local store of the COA street segment layer, shared by the segment-based services
+
+Segment attributes and geometries are kept in a SQLite database in the local cache
+directory and refreshed incrementally from the layer's `MODIFIED_DATE` field.
+Geometry paths are stored as flat coordinate arrays rather than lists of lists.
+"""
+import array
+import json
+import sqlite3
+import time
+
+import arrow
+
+from . import agol, shared
+
+# COA transportation_street_segment service
+# https://austin.maps.arcgis.com/home/item.html?id=a78db5b7a72640bcbb181dcb88817652
+SERVICE_NAME = "TRANSPORTATION_street_segment"
+LAYER_ID = 0
+SEGMENT_ID_FIELD = "SEGMENT_ID"
+MODIFIED_DATE_FIELD = "MODIFIED_DATE"
+# deltas do not capture deleted segments, so the store is periodically rebuilt
+FULL_REFRESH_DAYS = 7
+
+
+def pack_paths(paths):
+    """Convert Esri JSON paths to an array of path start offsets and a flat array of
+    x/y coordinates"""
+    offsets = array.array("I")
+    coordinates = array.array("d")
+    for path in paths:
+        offsets.append(len(coordinates) // 2)
+        for vertex in path:
+            coordinates.extend(vertex[:2])
+    return offsets, coordinates
+
+
+def unpack_paths(offsets, coordinates):
+    """Convert path offsets and flat coordinates back to Esri JSON paths"""
+    bounds = list(offsets) + [len(coordinates) // 2]
+    return [
+        [[coordinates[2 * i], coordinates[2 * i + 1]] for i in range(start, end)]
+        for start, end in zip(bounds, bounds[1:])
+    ]
+
+
+class SegmentStore(object):
+    """A local, incrementally-refreshed copy of the COA street segment layer.
+
+    Segments are held in memory once loaded, so lookups by segment ID do not touch
+    the network or the disk. Geometries are in the layer's native spatial reference
+    (NAD83 / Texas Central (ftUS)).
+    """
+
+    def __init__(self, path=None, token=None):
+        self.path = path or shared.cache_path("street_segments.sqlite")
+        self.token = token
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute(
+            """create table if not exists segments (
+                segment_id integer primary key,
+                attributes text not null,
+                path_offsets blob,
+                coordinates blob
+            )"""
+        )
+        self._conn.execute(
+            "create table if not exists state (key text primary key, value integer)"
+        )
+        self._segments = None
+
+    def _get_state(self, key):
+        row = self._conn.execute(
+            "select value from state where key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, key, value):
+        self._conn.execute("insert or replace into state values (?, ?)", (key, value))
+
+    def _load(self):
+        self._segments = {}
+        for segment_id, attributes, offsets, coordinates in self._conn.execute(
+            "select segment_id, attributes, path_offsets, coordinates from segments"
+        ):
+            self._segments[segment_id] = (
+                attributes,
+                array.array("I", offsets or b""),
+                array.array("d", coordinates or b""),
+            )
+
+    def refresh(self, full=False):
+        """Download the segments which have been modified since the last refresh.
+
+        Nothing is downloaded if the layer's `lastEditDate` is unchanged. The store
+        is rebuilt from scratch if `full` is True, if it is empty, or if it has not
+        been rebuilt for FULL_REFRESH_DAYS.
+
+        Args:
+            full (bool, optional): Rebuild the entire store. Defaults to False.
+
+        Returns:
+            int: the number of segments downloaded
+        """
+        info = agol.get_layer_info(SERVICE_NAME, LAYER_ID, token=self.token)
+        last_edit_date = info.get("editingInfo", {}).get("lastEditDate")
+        watermark = self._get_state("max_modified_date")
+        last_full_refresh = self._get_state("last_full_refresh")
+        now = int(time.time() * 1000)
+
+        if (
+            not watermark
+            or not last_full_refresh
+            or now - last_full_refresh > FULL_REFRESH_DAYS * 86400000
+        ):
+            full = True
+
+        if not full and last_edit_date and last_edit_date == self._get_state(
+            "last_edit_date"
+        ):
+            return 0
+
+        if full:
+            where = "1=1"
+        else:
+            watermark_str = arrow.get(watermark / 1000).format("YYYY-MM-DD HH:mm:ss")
+            where = f"{MODIFIED_DATE_FIELD} >= TIMESTAMP '{watermark_str}'"
+
+        features = agol.query_all_features(
+            SERVICE_NAME, LAYER_ID, {"where": where}, token=self.token
+        )
+
+        rows = []
+        for feature in features:
+            attributes = feature["attributes"]
+            paths = (feature.get("geometry") or {}).get("paths", [])
+            offsets, coordinates = pack_paths(paths)
+            rows.append(
+                (
+                    attributes[SEGMENT_ID_FIELD],
+                    json.dumps(attributes),
+                    offsets.tobytes(),
+                    coordinates.tobytes(),
+                )
+            )
+            watermark = max(watermark or 0, attributes.get(MODIFIED_DATE_FIELD) or 0)
+
+        with self._conn:
+            if full:
+                self._conn.execute("delete from segments")
+                self._set_state("last_full_refresh", now)
+            self._conn.executemany(
+                "insert or replace into segments values (?, ?, ?, ?)", rows
+            )
+            self._set_state("max_modified_date", watermark)
+            self._set_state("last_edit_date", last_edit_date)
+
+        self._segments = None
+        return len(rows)
+
+    def __contains__(self, segment_id):
+        if self._segments is None:
+            self._load()
+        return segment_id in self._segments
+
+    def __len__(self):
+        if self._segments is None:
+            self._load()
+        return len(self._segments)
+
+    def get_attributes(self, segment_id):
+        """Return a segment's attributes as a dict, or None if it is not found"""
+        if self._segments is None:
+            self._load()
+        segment = self._segments.get(segment_id)
+        return json.loads(segment[0]) if segment else None
+
+    def get_paths(self, segment_ids):
+        """Return a dict of Esri JSON geometry paths for the given segment IDs. IDs
+        which are not found are omitted."""
+        if self._segments is None:
+            self._load()
+        paths = {}
+        for segment_id in segment_ids:
+            segment = self._segments.get(segment_id)
+            if segment and segment[2]:
+                paths[segment_id] = unpack_paths(segment[1], segment[2])
+        return paths
@@ -1,7 +1,37 @@
+import hashlib
+import json
+import os
+import tempfile
+
+# local directory for on-disk caches. mount a volume here to persist caches across
+# container runs
+CACHE_DIR = os.getenv(
+    "KNACK_SERVICES_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "atd-knack-services"),
+)
+
+
+def format_key(key):
+    """Format a Knack field name by converting to lower case and replacing spaces and
+    hyphens with underscores"""
+    return key.lower().replace(" ", "_").replace("-", "_")
+
+
 def format_keys(record):
     """Format Knack record keys by converting to lower case and replacing space
     with underscores"""
-    return {
-        key.lower().replace(" ", "_").replace("-", "_"): val
-        for key, val in record.items()
-    }
+    return {format_key(key): val for key, val in record.items()}
+
+
+def cache_path(file_name):
+    """Return the path to a file in the local cache directory, creating the
+    directory if it does not exist"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, file_name)
+
+
+def json_hash(value):
+    """Return a sha256 hex digest of a JSON-serializable value, serialized canonically
+    so that the hash does not depend on key order"""
+    canonical = json.dumps(value, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
@@ -57,15 +57,18 @@ def get_client(host="datahub.austintexas.gov", timeout=30):
     )
 
 
-def publish(*, method, resource_id, payload, client):
-    """Just a sodapy wrapper that chunks payloads"""
+def publish(*, method, resource_id, payload, client, on_chunk=None):
+    """Just a sodapy wrapper that chunks payloads
+
+    `on_chunk`, if provided, is called with the start and stop index of each chunk of
+    the payload once it has been published."""
 
     def chunks(lst, n):
-        """Yield successive n-sized chunks from lst."""
+        """Yield the start index of, and successive n-sized chunks from, lst."""
         for i in range(0, len(lst), n):
-            yield lst[i : i + n]
+            yield i, lst[i : i + n]
 
-    for chunk in chunks(payload, 1000):
+    for start, chunk in chunks(payload, 1000):
         if method == "replace":
             # replace the dataset with first chunk
             # subsequent chunks will be upserted
@@ -73,3 +76,5 @@ def publish(*, method, resource_id, payload, client):
             method = "upsert"
         else:
             client.upsert(resource_id, chunk)
+        if on_chunk:
+            on_chunk(start, start + len(chunk))